@@ -0,0 +1,287 @@
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import umap
+from loguru import logger
+from sklearn.decomposition import PCA
+from sklearn.manifold import TSNE
+from sklearn.neighbors import NearestNeighbors
+
+from app.pydantic_models import ClusteringMode
+
+# Neighbours, among the fitted points, used to place a point projected with tSNE.
+KNN_NEIGHBOURS = 5
+
+
+def stratified_sample(
+    labels: List[str],
+    sample_size: int,
+    seed: Optional[int] = None,
+) -> np.ndarray:
+    """Draw a subsample of a labelled dataset, keeping the proportion of each label.
+
+    Each label gets a share of the sample proportional to its size, and at least one
+    point, so that the small classes are still represented in the fitted projection.
+
+    Args:
+        labels (List[str]): The label of each point.
+        sample_size (int): The number of points to draw.
+        seed (Optional[int], optional): The seed of the random generator. Defaults to None.
+
+    Returns:
+        np.ndarray: The sorted indices of the drawn points.
+    """
+    labels_array = np.asarray(labels)
+    if sample_size >= len(labels_array):
+        return np.arange(len(labels_array))
+
+    rng = np.random.default_rng(seed)
+    classes, counts = np.unique(labels_array, return_counts=True)
+    shares = np.maximum(1, np.floor(counts * sample_size / len(labels_array))).astype(
+        int,
+    )
+
+    # hand the points lost by the rounding to the largest classes
+    for idx in np.argsort(-counts)[: max(0, sample_size - shares.sum())]:
+        shares[idx] = min(counts[idx], shares[idx] + 1)
+
+    indices = [
+        rng.choice(np.flatnonzero(labels_array == label), size=share, replace=False)
+        for label, share in zip(classes, shares)
+    ]
+
+    return np.sort(np.concatenate(indices))
+
+
+def knn_place(
+    fitted_features: np.ndarray,
+    fitted_coords: np.ndarray,
+    features: np.ndarray,
+    n_neighbors: int = KNN_NEIGHBOURS,
+) -> np.ndarray:
+    """Place points in a 2D projection from their nearest fitted neighbours.
+
+    Used for the projections without a `transform`, like tSNE : each point is put at the
+    inverse-distance weighted mean of the coordinates of its nearest fitted points.
+
+    Args:
+        fitted_features (np.ndarray): The features of the fitted points, of shape (M, D).
+        fitted_coords (np.ndarray): The 2D coordinates of the fitted points, of shape (M, 2).
+        features (np.ndarray): The features of the points to place, of shape (K, D).
+        n_neighbors (int, optional): The number of neighbours. Defaults to KNN_NEIGHBOURS.
+
+    Returns:
+        np.ndarray: The 2D coordinates of the points, of shape (K, 2).
+    """
+    n_neighbors = min(n_neighbors, len(fitted_features))
+    distances, neighbours = (
+        NearestNeighbors(n_neighbors=n_neighbors)
+        .fit(fitted_features)
+        .kneighbors(features)
+    )
+
+    weights = 1 / np.maximum(distances, 1e-12)
+    weights /= weights.sum(axis=1, keepdims=True)
+
+    return np.einsum("kn,knd->kd", weights, fitted_coords[neighbours])
+
+
+class FittedProjection:
+    """A fitted PCA and UMAP projection, able to place new embeddings without a refit."""
+
+    def __init__(
+        self,
+        pca: Optional[PCA],
+        reducer: umap.UMAP,
+        features: np.ndarray,
+    ) -> None:
+        """Wrap a fitted projection.
+
+        Args:
+            pca (Optional[PCA]): The fitted PCA, if any.
+            reducer (umap.UMAP): The fitted UMAP reducer.
+            features (np.ndarray): The (reduced) features the reducer was fitted on, whose
+                mean and spread are the reference of `drift`.
+        """
+        self.pca = pca
+        self.reducer = reducer
+        self.num_fitted = len(features)
+        self.features_mean = features.mean(axis=0)
+        self.features_scale = max(float(np.sqrt(features.var(axis=0).sum())), 1e-12)
+
+    def features(self, logits: np.ndarray) -> np.ndarray:
+        """Reduce embeddings with the fitted PCA, if any."""
+        return logits if self.pca is None else self.pca.transform(logits)
+
+    def transform(self, logits: np.ndarray) -> np.ndarray:
+        """Place embeddings in the fitted 2D projection."""
+        return self.reducer.transform(self.features(logits))
+
+    def drift(self, logits: np.ndarray) -> float:
+        """Measure how far the mean of a set of embeddings moved from the fitted ones.
+
+        Args:
+            logits (np.ndarray): The embeddings, of shape (N, D).
+
+        Returns:
+            float: The distance between the means of the features, relative to the
+                spread of the fitted features.
+        """
+        shift = self.features(logits).mean(axis=0) - self.features_mean
+        return float(np.linalg.norm(shift) / self.features_scale)
+
+
+def compute_projection(
+    logits: np.ndarray,
+    mode: ClusteringMode,
+    labels: Optional[List[str]] = None,
+    sample_size: Optional[int] = None,
+    pca_components: Optional[int] = None,
+    seed: Optional[int] = None,
+) -> Tuple[np.ndarray, Dict[str, float]]:
+    """Project the embeddings of a dataset in 2D, fitting the projection on a subsample.
+
+    See `fit_projection`.
+
+    Returns:
+        Tuple[np.ndarray, Dict[str, float]]: The 2D coordinates, of shape (N, 2), and the
+            time, in seconds, of each stage, with the number of fitted points.
+    """
+    clusters, timings, _ = fit_projection(
+        logits=logits,
+        mode=mode,
+        labels=labels,
+        sample_size=sample_size,
+        pca_components=pca_components,
+        seed=seed,
+    )
+
+    return clusters, timings
+
+
+def fit_projection(
+    logits: np.ndarray,
+    mode: ClusteringMode,
+    labels: Optional[List[str]] = None,
+    sample_size: Optional[int] = None,
+    pca_components: Optional[int] = None,
+    seed: Optional[int] = None,
+) -> Tuple[np.ndarray, Dict[str, float], Optional[FittedProjection]]:
+    """Project the embeddings of a dataset in 2D, fitting the projection on a subsample.
+
+    The stages are :
+    - an optional randomized PCA, fitted on the subsample, reducing the embeddings to
+      `pca_components` dimensions,
+    - the fit of tSNE or UMAP on a stratified subsample of `sample_size` points,
+    - the projection of the other points, with `UMAP.transform`, or from their nearest
+      fitted neighbours for tSNE, see `knn_place`.
+
+    Without `sample_size` and `pca_components`, tSNE or UMAP is fitted on all the raw
+    embeddings.
+
+    Args:
+        logits (np.ndarray): The embeddings, of shape (N, D).
+        mode (ClusteringMode): The projection method.
+        labels (Optional[List[str]], optional): The label of each point, used to stratify
+            the subsample. Defaults to None, a uniform subsample.
+        sample_size (Optional[int], optional): The number of points the projection is
+            fitted on. Defaults to None, all the points.
+        pca_components (Optional[int], optional): The number of PCA dimensions. Defaults
+            to None, no PCA.
+        seed (Optional[int], optional): The seed of the subsampling, PCA and projection.
+            Defaults to None.
+
+    Returns:
+        Tuple[np.ndarray, Dict[str, float], Optional[FittedProjection]]: The 2D
+            coordinates, of shape (N, 2), the time, in seconds, of each stage, with the
+            number of fitted points, and the fitted projection for UMAP (None for tSNE,
+            which cannot place new points).
+    """
+    num_points = len(logits)
+    if labels is None:
+        labels = [""] * num_points
+
+    timings: Dict[str, float] = {}
+
+    start = time.perf_counter()
+    if sample_size is None:
+        fitted = np.arange(num_points)
+    else:
+        fitted = stratified_sample(labels=labels, sample_size=sample_size, seed=seed)
+    timings["sample_time"] = time.perf_counter() - start
+    timings["fitted"] = int(len(fitted))
+
+    start = time.perf_counter()
+    features = logits
+    pca = None
+    if pca_components is not None:
+        pca = PCA(
+            n_components=min(pca_components, len(fitted), logits.shape[1]),
+            svd_solver="randomized",
+            random_state=seed,
+        ).fit(logits[fitted])
+        features = pca.transform(logits)
+    timings["pca_time"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if mode == ClusteringMode.tsne:
+        reducer = TSNE(
+            n_components=2,
+            learning_rate="auto",
+            init="random",
+            perplexity=min(30.0, len(fitted) - 1),
+            random_state=seed,
+        )
+    elif mode == ClusteringMode.umap:
+        reducer = umap.UMAP(random_state=seed)
+    fitted_coords = reducer.fit_transform(features[fitted])
+    timings["fit_time"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    clusters = np.empty((num_points, 2), dtype=np.float64)
+    clusters[fitted] = fitted_coords
+
+    remaining = np.setdiff1d(np.arange(num_points), fitted)
+    if len(remaining):
+        if mode == ClusteringMode.umap:
+            clusters[remaining] = reducer.transform(features[remaining])
+        else:
+            clusters[remaining] = knn_place(
+                fitted_features=features[fitted],
+                fitted_coords=fitted_coords,
+                features=features[remaining],
+            )
+    timings["transform_time"] = time.perf_counter() - start
+
+    logger.info(
+        f"{mode.value} fitted on {len(fitted)} of {num_points} points in "
+        + f"{timings['fit_time']:.2f}s, {len(remaining)} points projected in "
+        + f"{timings['transform_time']:.2f}s.",
+    )
+
+    projection = None
+    if mode == ClusteringMode.umap:
+        projection = FittedProjection(
+            pca=pca,
+            reducer=reducer,
+            features=features[fitted],
+        )
+
+    return clusters, timings, projection
+
+
+def format_timings(timings: Dict[str, float]) -> Dict[str, str]:
+    """Format the timings of a clustering, as response headers.
+
+    Args:
+        timings (Dict[str, float]): The time, in seconds, of each stage, and the counts
+            of fitted points, see `compute_projection`.
+
+    Returns:
+        Dict[str, str]: The formatted timings.
+    """
+    return {
+        name: f"{value:.3f}" if isinstance(value, float) else str(value)
+        for name, value in timings.items()
+    }
@@ -0,0 +1,344 @@
+import hashlib
+import os
+import sqlite3
+import time
+from contextlib import closing
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from loguru import logger
+from PIL import Image, UnidentifiedImageError
+
+from app.config import settings
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY,
+    parent TEXT,
+    mtime_ns INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS directories_parent ON directories (parent);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    directory TEXT NOT NULL,
+    label TEXT NOT NULL,
+    extension TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    width INTEGER,
+    height INTEGER
+);
+CREATE INDEX IF NOT EXISTS files_directory ON files (directory);
+CREATE INDEX IF NOT EXISTS files_extension_label ON files (extension, label);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value REAL NOT NULL
+);
+"""
+
+
+def _image_size(path: str) -> Tuple[Optional[int], Optional[int]]:
+    """Read the width and height of an image from its header, without decoding it."""
+    try:
+        with Image.open(path) as image:
+            return image.size
+    except (UnidentifiedImageError, OSError):
+        return None, None
+
+
+class DatasetIndex:
+    """Persistent index of the files of a dataset directory.
+
+    The index is a SQLite database storing, for each file, its label (the name of its
+    parent directory), extension, size, modification time and, for images, dimensions.
+    It is shared by all the gunicorn workers.
+
+    A refresh only rescans the directories whose modification time changed, i.e. the
+    directories in which files were added, removed or renamed. A file rewritten in place
+    keeps its directory unchanged, use `refresh(force=True)` to pick up such changes. The
+    symbolic links to directories are not followed.
+    """
+
+    def __init__(self, directory: str, index_dir: Optional[str] = None) -> None:
+        """Open the index of a dataset directory, creating it if needed.
+
+        Args:
+            directory (str): The dataset directory.
+            index_dir (Optional[str], optional): The directory storing the indexes.
+                Defaults to `settings.dataset_index_dir`.
+        """
+        self.root = str(Path(directory).absolute())
+
+        index_dir = Path(index_dir or settings.dataset_index_dir)
+        index_dir.mkdir(parents=True, exist_ok=True)
+        root_hash = hashlib.sha1(self.root.encode()).hexdigest()[:16]
+        self.db_path = index_dir / f"{root_hash}.sqlite"
+
+        with closing(self._connect()) as connection:
+            connection.executescript(_SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.db_path, timeout=60)
+        connection.execute("PRAGMA journal_mode=WAL")
+        return connection
+
+    def _rescan_directory(
+        self,
+        connection: sqlite3.Connection,
+        directory: str,
+    ) -> Tuple[List[str], List[Tuple], List[str]]:
+        """Compare the files of a directory with the index, without writing to it.
+
+        The symbolic links to directories are not followed, as a link to one of its
+        parents would make the dataset infinitely deep.
+
+        Args:
+            connection (sqlite3.Connection): The connection to the index.
+            directory (str): The directory to rescan.
+
+        Returns:
+            Tuple[List[str], List[Tuple], List[str]]: The subdirectories, the rows of the
+                new or changed files, and the paths of the removed files.
+        """
+        indexed = {
+            path: (size, mtime_ns)
+            for path, size, mtime_ns in connection.execute(
+                "SELECT path, size, mtime_ns FROM files WHERE directory = ?",
+                (directory,),
+            )
+        }
+
+        subdirectories = []
+        rows = []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirectories.append(entry.path)
+                    continue
+                if not entry.is_file():
+                    continue
+
+                stat = entry.stat()
+                if indexed.pop(entry.path, None) == (stat.st_size, stat.st_mtime_ns):
+                    continue
+
+                width, height = _image_size(entry.path)
+                rows.append(
+                    (
+                        entry.path,
+                        directory,
+                        Path(directory).stem,
+                        Path(entry.name).suffix,
+                        stat.st_size,
+                        stat.st_mtime_ns,
+                        width,
+                        height,
+                    ),
+                )
+
+        return subdirectories, rows, list(indexed)
+
+    def refresh(self, force: bool = False) -> int:
+        """Bring the index up to date with the dataset directory.
+
+        The refresh is skipped if the index has been refreshed less than
+        `settings.dataset_index_refresh_interval` seconds ago. The directories are
+        scanned, and the headers of the new images read, before taking the write lock of
+        the index, which is then only held to write the changes, so that the other
+        workers do not wait for the whole scan.
+
+        Args:
+            force (bool, optional): Rescan every directory, and ignore the refresh
+                interval. Defaults to False.
+
+        Returns:
+            int: The number of files added, changed or removed.
+        """
+        with closing(self._connect()) as connection:
+            refreshed_at = self._refreshed_at(connection)
+            if (
+                not force
+                and refreshed_at is not None
+                and time.time() - refreshed_at < settings.dataset_index_refresh_interval
+            ):
+                return 0
+
+            known = dict(connection.execute("SELECT path, mtime_ns FROM directories"))
+            seen = set()
+            directories = []
+            rows: List[Tuple] = []
+            removed_files: List[str] = []
+
+            stack = [(self.root, None)]
+            while stack:
+                directory, parent = stack.pop()
+                if directory in seen:
+                    continue
+                try:
+                    mtime_ns = os.stat(directory).st_mtime_ns
+                except FileNotFoundError:
+                    continue
+                seen.add(directory)
+
+                if not force and known.get(directory) == mtime_ns:
+                    stack.extend(
+                        (child, directory)
+                        for (child,) in connection.execute(
+                            "SELECT path FROM directories WHERE parent = ?",
+                            (directory,),
+                        )
+                    )
+                    continue
+
+                (
+                    subdirectories,
+                    directory_rows,
+                    directory_removed,
+                ) = self._rescan_directory(connection=connection, directory=directory)
+                directories.append((directory, parent, mtime_ns))
+                rows.extend(directory_rows)
+                removed_files.extend(directory_removed)
+                stack.extend((child, directory) for child in subdirectories)
+
+            removed = [(path,) for path in known if path not in seen]
+
+            with connection:
+                # serialize the writes of the gunicorn workers
+                connection.execute("BEGIN IMMEDIATE")
+                if self._refreshed_at(connection) != refreshed_at and not force:
+                    # another worker refreshed the index during the scan
+                    return 0
+
+                connection.executemany(
+                    "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    rows,
+                )
+                connection.executemany(
+                    "DELETE FROM files WHERE path = ?",
+                    [(path,) for path in removed_files],
+                )
+                connection.executemany(
+                    "INSERT OR REPLACE INTO directories VALUES (?, ?, ?)",
+                    directories,
+                )
+                connection.executemany(
+                    "DELETE FROM directories WHERE path = ?",
+                    removed,
+                )
+                connection.executemany("DELETE FROM files WHERE directory = ?", removed)
+                connection.execute(
+                    "INSERT OR REPLACE INTO meta VALUES ('refreshed_at', ?)",
+                    (time.time(),),
+                )
+
+        updated = len(rows) + len(removed_files)
+        if directories:
+            logger.info(
+                f"Dataset index refreshed : {len(directories)} directories rescanned, "
+                + f"{updated} files updated.",
+            )
+
+        return updated
+
+    @staticmethod
+    def _refreshed_at(connection: sqlite3.Connection) -> Optional[float]:
+        row = connection.execute(
+            "SELECT value FROM meta WHERE key = 'refreshed_at'",
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def query(
+        self,
+        extension: Optional[str] = None,
+        label: Optional[str] = None,
+    ) -> List[Dict]:
+        """Return the indexed files, without touching the dataset directory.
+
+        Args:
+            extension (Optional[str], optional): Only return the files with this
+                extension, e.g. ".png". Defaults to None.
+            label (Optional[str], optional): Only return the files with this label.
+                Defaults to None.
+
+        Returns:
+            List[Dict]: The path, label, extension, size, mtime_ns, width and height of the files.
+        """
+        clauses = []
+        params = []
+        if extension is not None:
+            clauses.append("extension = ?")
+            params.append(extension)
+        if label is not None:
+            clauses.append("label = ?")
+            params.append(label)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+
+        with closing(self._connect()) as connection:
+            connection.row_factory = sqlite3.Row
+            rows = connection.execute(
+                "SELECT path, label, extension, size, mtime_ns, width, height "
+                + f"FROM files {where}",
+                params,
+            ).fetchall()
+
+        return [dict(row) for row in rows]
+
+    def paths(
+        self,
+        extension: Optional[str] = None,
+        label: Optional[str] = None,
+    ) -> List[Path]:
+        """Return the sorted paths of the indexed files.
+
+        Args:
+            extension (Optional[str], optional): Only return the files with this
+                extension, e.g. ".png". Defaults to None.
+            label (Optional[str], optional): Only return the files with this label.
+                Defaults to None.
+
+        Returns:
+            List[Path]: The sorted absolute paths.
+        """
+        return sorted(
+            Path(row["path"]) for row in self.query(extension=extension, label=label)
+        )
+
+    def fingerprint(
+        self,
+        extension: Optional[str] = None,
+        label: Optional[str] = None,
+        stat_files: bool = False,
+    ) -> str:
+        """Compute a fingerprint of the indexed files, changing when any of them changes.
+
+        Args:
+            extension (Optional[str], optional): Only fingerprint the files with this
+                extension, e.g. ".png". Defaults to None.
+            label (Optional[str], optional): Only fingerprint the files with this label.
+                Defaults to None.
+            stat_files (bool, optional): Read the sizes and modification times from the
+                files rather than from the index, so that the files rewritten in place
+                since the last rescan of their directory change the fingerprint too.
+                Defaults to False.
+
+        Returns:
+            str: The fingerprint, built from the paths, sizes and modification times.
+        """
+        rows = self.query(extension=extension, label=label)
+        if stat_files:
+            files = []
+            for row in rows:
+                try:
+                    stat = os.stat(row["path"])
+                except FileNotFoundError:
+                    continue
+                files.append((row["path"], stat.st_size, stat.st_mtime_ns))
+            files.sort()
+        else:
+            files = sorted((row["path"], row["size"], row["mtime_ns"]) for row in rows)
+
+        digest = hashlib.sha1()
+        for path, size, mtime_ns in files:
+            digest.update(f"{path}\0{size}\0{mtime_ns}\n".encode())
+
+        return digest.hexdigest()
@@ -0,0 +1,208 @@
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from app.dependancies.metrics import get_registry, span
+
+# the modes supported by `Image.reduce`
+_REDUCIBLE_MODES = {"L", "LA", "La", "RGB", "RGBA", "RGBa", "RGBX", "CMYK", "I", "F"}
+
+
+class DecodeStats:
+    """Thread-safe counters of the work saved by the reduced-resolution decoding."""
+
+    def __init__(self) -> None:
+        self.num_images = 0
+        self.decode_time = 0.0
+        self.native_pixels = 0
+        self.decoded_pixels = 0
+        self._lock = threading.Lock()
+
+    def record(
+        self,
+        native_size: Tuple[int, int],
+        decoded_size: Tuple[int, int],
+        elapsed: float,
+    ) -> None:
+        """Record the decoding of an image.
+
+        Args:
+            native_size (Tuple[int, int]): The (width, height) of the image file.
+            decoded_size (Tuple[int, int]): The (width, height) of the decoded image.
+            elapsed (float): The time, in seconds, taken by the decoding.
+        """
+        with self._lock:
+            self.num_images += 1
+            self.decode_time += elapsed
+            self.native_pixels += native_size[0] * native_size[1]
+            self.decoded_pixels += decoded_size[0] * decoded_size[1]
+
+    def merge(self, other: "DecodeStats") -> None:
+        """Add the counters of another `DecodeStats`, e.g. one filled in a worker process.
+
+        Args:
+            other (DecodeStats): The counters to add.
+        """
+        with self._lock:
+            self.num_images += other.num_images
+            self.decode_time += other.decode_time
+            self.native_pixels += other.native_pixels
+            self.decoded_pixels += other.decoded_pixels
+
+    def __getstate__(self) -> Dict[str, Any]:
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @property
+    def reduction(self) -> float:
+        """The ratio between the pixels of the image files and the pixels decoded."""
+        return self.native_pixels / self.decoded_pixels if self.decoded_pixels else 1.0
+
+    def report(self) -> Dict[str, str]:
+        """Return the counters, as response headers.
+
+        Returns:
+            Dict[str, str]: The number of decoded images, the total decoding time and
+                the pixels reduction factor.
+        """
+        return {
+            "decoded_images": str(self.num_images),
+            "decode_time": f"{self.decode_time:.3f}",
+            "decode_reduction": f"{self.reduction:.1f}",
+        }
+
+
+def reduction_factor(size: Tuple[int, int], target_size: Tuple[int, int]) -> int:
+    """Return the largest integer factor keeping an image at least as large as a target size.
+
+    Args:
+        size (Tuple[int, int]): The (width, height) of the image.
+        target_size (Tuple[int, int]): The minimal (width, height) of the reduced image.
+
+    Returns:
+        int: The reduction factor, at least 1.
+    """
+    return max(1, min(size[0] // target_size[0], size[1] // target_size[1]))
+
+
+def open_image(
+    image_path: Path,
+    scale: int = 1,
+    target_size: Optional[Tuple[int, int]] = None,
+    stats: Optional[DecodeStats] = None,
+) -> Image.Image:
+    """Decode an image at a reduced resolution.
+
+    JPEG images are decoded with the DCT scaling of libjpeg (`Image.draft`), which skips
+    most of the decoding work at the 1/2, 1/4 and 1/8 scales. The remaining reduction, and
+    the reduction of the other formats, is done with a box filter (`Image.reduce`, or
+    `Image.resize` when the scale is not a multiple of the DCT scale). The modes which
+    cannot be averaged, such as palette images, are resized with the nearest neighbour
+    instead. Whatever the format, the reduced image has a size of
+    ceil(native size / factor).
+
+    Args:
+        image_path (Path): The path of the image.
+        scale (int, optional): The reduction factor of the width and height. Defaults to 1,
+            which decodes the image at its native resolution.
+        target_size (Optional[Tuple[int, int]], optional): If given, the (width, height)
+            the image will be resized to : the image is reduced as much as possible while
+            staying at least as large, and `scale` is ignored. Defaults to None.
+        stats (Optional[DecodeStats], optional): If given, the decoding is recorded
+            in it. Defaults to None.
+
+    Raises:
+        ValueError: If `scale` is lower than 1.
+
+    Returns:
+        Image.Image: The decoded image.
+    """
+    if scale < 1:
+        raise ValueError(f"The decoding scale must be at least 1, got {scale}.")
+
+    start = time.perf_counter()
+
+    image = Image.open(image_path)
+    native_size = image.size
+    if target_size is not None:
+        scale = reduction_factor(native_size, target_size)
+
+    if scale > 1:
+        requested = (-(-native_size[0] // scale), -(-native_size[1] // scale))
+        if image.format == "JPEG":
+            image.draft(image.mode, requested)
+        image.load()
+
+        # the factor of the DCT scaling, 1 for the other formats
+        drafted = max(1, round(native_size[0] / image.size[0]))
+        if image.mode in _REDUCIBLE_MODES:
+            if scale % drafted == 0 and scale > drafted:
+                image = image.reduce(scale // drafted)
+            if image.size != requested:
+                # e.g. a JPEG image at a scale which is not a power of 2
+                image = image.resize(requested, Image.BOX)
+        else:
+            # e.g. a palette or 16-bit image, whose values cannot be averaged
+            image = image.resize(requested, Image.NEAREST)
+    else:
+        image.load()
+
+    if stats is not None:
+        stats.record(native_size, image.size, time.perf_counter() - start)
+
+    return image
+
+
+def load_array(
+    image_path: Path,
+    scale: int = 1,
+    stats: Optional[DecodeStats] = None,
+) -> np.ndarray:
+    """Decode an image into a np.array, at a reduced resolution, see `open_image`.
+
+    Args:
+        image_path (Path): The path of the image.
+        scale (int, optional): The reduction factor of the width and height. Defaults to 1.
+        stats (Optional[DecodeStats], optional): If given, the decoding is recorded
+            in it. Defaults to None.
+
+    Returns:
+        np.ndarray: The decoded image.
+    """
+    with open_image(image_path, scale=scale, stats=stats) as image:
+        return np.asarray(image)
+
+
+def with_decode_stats(
+    func: Callable[..., Any],
+    *args,
+    **kwargs,
+) -> Tuple[Any, Dict[str, str]]:
+    """Call a function with a fresh `DecodeStats`, passed as its `decode_stats` argument.
+
+    The function is module-level, so it can be sent to the process pool. Its duration,
+    the images it decoded and their decoding time are recorded in the metrics, under the
+    name of the function.
+
+    Returns:
+        Tuple[Any, Dict[str, str]]: The result of the function, and the report of the counters.
+    """
+    stats = DecodeStats()
+    with span(func.__name__) as current:
+        result = func(*args, decode_stats=stats, **kwargs)
+        current.images = stats.num_images
+    get_registry().increment(
+        "decode_seconds_total",
+        stats.decode_time,
+        stage=func.__name__,
+    )
+    return result, stats.report()
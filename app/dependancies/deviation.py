@@ -0,0 +1,317 @@
+from io import BytesIO
+from pathlib import Path
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+from loguru import logger
+from matplotlib import cm
+from PIL import Image
+
+from app.config import settings
+from app.dependancies.decoding import DecodeStats, load_array, open_image
+from app.dependancies.eda_functions import encode_mean_image
+from app.dependancies.errors import (
+    ChannelNotFoundError,
+    EmptyDatasetError,
+    validate_same_shape,
+)
+from app.dependancies.rendering import (
+    encode_heatmap,
+    render_png,
+    reusable_figure,
+    thumbnail_array,
+)
+from app.dependancies.result_cache import ResultCache, dataset_cache_key
+from app.dependancies.sharding import sharded_images_sum
+from app.dependancies.utils import get_items_list
+from app.pydantic_models import DeviationMetric, Extension
+
+# The order of the columns of the deviation scores.
+METRICS = [DeviationMetric.l2, DeviationMetric.l1, DeviationMetric.ssim]
+
+# Side of the non-overlapping blocks the SSIM-like score is computed on, and the SSIM
+# stabilization constants for 8-bit images.
+SSIM_BLOCK = 8
+SSIM_C1 = (0.01 * 255) ** 2
+SSIM_C2 = (0.03 * 255) ** 2
+
+# ITU-R 601 luma weights, used by the SSIM-like score of RGB images.
+LUMA_WEIGHTS = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+# Largest side, in pixels, of the diff heatmaps.
+HEATMAP_SIZE = 64
+
+
+def cached_mean_image(
+    extension: Extension,
+    scale: int = 1,
+    decode_stats: Optional[DecodeStats] = None,
+) -> np.ndarray:
+    """Return the mean image of the dataset, as cached by `/eda/dataset_mean_image`.
+
+    The mean image is computed, with `sharded_images_sum`, and put in the result cache
+    when it is not cached yet, so both endpoints share it.
+
+    Args:
+        extension (Extension): The extension of the images of the dataset.
+        scale (int, optional): The decoding scale of the images. Defaults to 1.
+        decode_stats (Optional[DecodeStats], optional): If given, the decoding of the
+            images is recorded in it. Defaults to None.
+
+    Raises:
+        EmptyDatasetError: If the dataset has no image of the extension.
+
+    Returns:
+        np.ndarray: The mean image, rounded to uint8 as served by `/eda/dataset_mean_image`.
+    """
+    key = dataset_cache_key(
+        endpoint="dataset_mean_image",
+        params={"extension": extension.value, "scale": scale},
+    )
+    cache = ResultCache()
+
+    cached = cache.get(key)
+    if cached is not None:
+        logger.info("Mean image served from the result cache.")
+        content = cached[0]
+    else:
+        images_paths = get_items_list(
+            directory=settings.data_dir,
+            extension=extension.value,
+        )
+        if not images_paths:
+            raise EmptyDatasetError(extension.value)
+        images_sum, num_images = sharded_images_sum(
+            images_paths=images_paths,
+            scale=scale,
+            decode_stats=decode_stats,
+        )
+        content = encode_mean_image(images_sum=images_sum, num_images=num_images)
+        cache.put(key, content, "image/png")
+
+    with Image.open(BytesIO(content)) as image:
+        return np.asarray(image)
+
+
+def _with_channels(images: np.ndarray, image_ndim: int) -> np.ndarray:
+    # grayscale images have no channel axis
+    return images[..., np.newaxis] if image_ndim == 2 else images
+
+
+def _luminance(images: np.ndarray) -> np.ndarray:
+    if images.shape[-1] >= 3:
+        return images[..., :3] @ LUMA_WEIGHTS
+    return images.mean(axis=-1)
+
+
+def _block_means(images: np.ndarray, block: int) -> np.ndarray:
+    num_images, height, width = images.shape
+    blocks = images[:, : height // block * block, : width // block * block].reshape(
+        num_images,
+        height // block,
+        block,
+        width // block,
+        block,
+    )
+    return blocks.mean(axis=(2, 4))
+
+
+def deviation_scores(images: np.ndarray, mean_image: np.ndarray) -> np.ndarray:
+    """Score how far each image of a batch is from the mean image of the dataset.
+
+    The scores are :
+    - l2, the root mean square of the pixel differences,
+    - l1, the mean absolute pixel difference,
+    - ssim, 1 minus the mean SSIM of the luminance, computed on non-overlapping
+      `SSIM_BLOCK` x `SSIM_BLOCK` blocks instead of a sliding window, so it is fully
+      vectorized over the batch.
+
+    Args:
+        images (np.ndarray): The batch of images, of shape (B, H, W, C) or (B, H, W).
+        mean_image (np.ndarray): The mean image, of shape (H, W, C) or (H, W).
+
+    Returns:
+        np.ndarray: The scores, of shape (B, 3), in the order of `METRICS`.
+    """
+    images = _with_channels(images, images.ndim - 1).astype(np.float32)
+    mean_image = _with_channels(mean_image, mean_image.ndim).astype(np.float32)
+
+    diff = images - mean_image
+    l2 = np.sqrt(np.mean(np.square(diff), axis=(1, 2, 3)))
+    l1 = np.mean(np.abs(diff), axis=(1, 2, 3))
+    del diff
+
+    block = max(1, min(SSIM_BLOCK, *images.shape[1:3]))
+    x = _luminance(images)
+    y = _luminance(mean_image)[np.newaxis]
+
+    mu_x = _block_means(x, block)
+    mu_y = _block_means(y, block)
+    var_x = _block_means(x * x, block) - mu_x**2
+    var_y = _block_means(y * y, block) - mu_y**2
+    cov = _block_means(x * y, block) - mu_x * mu_y
+
+    ssim = ((2 * mu_x * mu_y + SSIM_C1) * (2 * cov + SSIM_C2)) / (
+        (mu_x**2 + mu_y**2 + SSIM_C1) * (var_x + var_y + SSIM_C2)
+    )
+
+    return np.stack([l2, l1, 1 - ssim.mean(axis=(1, 2))], axis=1)
+
+
+def rank_deviations(
+    images_paths: List[Path],
+    mean_image: np.ndarray,
+    metric: DeviationMetric = DeviationMetric.l2,
+    top_k: int = 20,
+    scale: int = 1,
+    progress: Optional[Callable[[int], None]] = None,
+    decode_stats: Optional[DecodeStats] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Score every image of a dataset against its mean image, in one streaming pass.
+
+    The images are decoded into a reused chunk, and each chunk is scored at once, see
+    `deviation_scores`. The chunks are sized so that their float32 copy fits in
+    `settings.deviation_chunk_bytes`. Only the scores are kept, so the memory used does
+    not depend on the number of images.
+
+    Args:
+        images_paths (List[Path]): The paths of the images.
+        mean_image (np.ndarray): The mean image of the dataset, decoded at the same scale.
+        metric (DeviationMetric, optional): The score the images are ranked by.
+            Defaults to DeviationMetric.l2.
+        top_k (int, optional): The number of images returned. Defaults to 20.
+        scale (int, optional): Decode the images at 1/scale of their width and height.
+            Defaults to 1.
+        progress (Optional[Callable[[int], None]], optional): Called with the number of
+            images of each chunk once it is scored. Defaults to None.
+        decode_stats (Optional[DecodeStats], optional): If given, the decoding of the
+            images is recorded in it. Defaults to None.
+
+    Raises:
+        EmptyDatasetError: If there is no image to score.
+        HeightWidthMismatchError: If an image does not have the height and width of the
+            mean image.
+        ChannelNotFoundError: If an image does not have the channels of the mean image,
+            or is not an 8-bit image, as the chunks the images are decoded into.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The scores of all the images, of shape (N, 3) in
+            the order of `METRICS`, and the indices of the `top_k` most atypical images,
+            from the most atypical.
+    """
+    num_images = len(images_paths)
+    if not num_images:
+        raise EmptyDatasetError("no image to score")
+    chunk_size = max(1, settings.deviation_chunk_bytes // (4 * mean_image.size))
+    chunk = np.empty((min(chunk_size, num_images), *mean_image.shape), dtype=np.uint8)
+    scores = np.empty((num_images, len(METRICS)), dtype=np.float32)
+
+    for start in range(0, num_images, chunk_size):
+        stop = min(start + chunk_size, num_images)
+        for idx, image_path in enumerate(images_paths[start:stop]):
+            image = load_array(image_path, scale=scale, stats=decode_stats)
+            validate_same_shape(reference=mean_image, image=image)
+            # e.g. a 16-bit image, which the chunk would truncate
+            if image.dtype != chunk.dtype:
+                raise ChannelNotFoundError(image.shape, image.dtype)
+            chunk[idx] = image
+        scores[start:stop] = deviation_scores(chunk[: stop - start], mean_image)
+
+        if progress is not None:
+            progress(stop - start)
+
+    column = scores[:, METRICS.index(metric)]
+    top_k = min(top_k, num_images)
+    top = np.argpartition(-column, top_k - 1)[:top_k]
+    top = top[np.argsort(-column[top])]
+
+    logger.info(
+        f"{num_images} images scored against the mean image, in chunks of {chunk_size}.",
+    )
+
+    return scores, top
+
+
+def deviation_heatmaps(
+    images_paths: List[Path],
+    mean_image: np.ndarray,
+    scale: int = 1,
+) -> List[bytes]:
+    """Render the absolute difference between each image and the mean image.
+
+    The differences are averaged over the channels, reduced to at most `HEATMAP_SIZE`
+    pixels of side, and colored on a scale shared by all the heatmaps.
+
+    Args:
+        images_paths (List[Path]): The paths of the images, e.g. the most atypical ones.
+        mean_image (np.ndarray): The mean image of the dataset, decoded at the same scale.
+        scale (int, optional): Decode the images at 1/scale of their width and height.
+            Defaults to 1.
+
+    Returns:
+        List[bytes]: The heatmaps, as PNG images.
+    """
+    mean = _with_channels(mean_image, mean_image.ndim).astype(np.float32)
+
+    diffs = []
+    for image_path in images_paths:
+        image = load_array(image_path, scale=scale)
+        diff = np.abs(_with_channels(image, image.ndim) - mean).mean(axis=-1)
+        diffs.append(thumbnail_array(diff, max_size=HEATMAP_SIZE))
+
+    vmax = max([float(diff.max()) for diff in diffs] + [1.0])
+
+    return [
+        encode_heatmap(diff, vmin=0, vmax=vmax, colormap=cm.inferno) for diff in diffs
+    ]
+
+
+def plot_deviations(
+    images_paths: List[Path],
+    scores: np.ndarray,
+    heatmaps: List[bytes],
+    metric: DeviationMetric,
+) -> bytes:
+    """Plot the most atypical images of a dataset next to their diff heatmaps.
+
+    Args:
+        images_paths (List[Path]): The paths of the most atypical images.
+        scores (np.ndarray): Their scores, of shape (K, 3), see `deviation_scores`.
+        heatmaps (List[bytes]): Their heatmaps, see `deviation_heatmaps`.
+        metric (DeviationMetric): The score the images are ranked by.
+
+    Returns:
+        bytes: The plot, as a PNG image.
+    """
+    ncols = 4
+    nrows = max(1, -(-len(images_paths) // (ncols // 2)))
+
+    with reusable_figure("deviations", figsize=(3 * ncols, 3 * nrows)) as fig:
+        fig.suptitle(f"Most atypical images, by {metric.value} deviation from the mean")
+
+        for idx, (image_path, score, heatmap) in enumerate(
+            zip(images_paths, scores, heatmaps),
+        ):
+            with open_image(image_path, target_size=(HEATMAP_SIZE,) * 2) as image:
+                thumbnail = np.asarray(image)
+
+            ax = fig.add_subplot(nrows, ncols, 2 * idx + 1)
+            ax.imshow(thumbnail, cmap="gray")
+            ax.set_title(
+                f"{Path(image_path).parent.stem}/{Path(image_path).name}",
+                fontsize=8,
+            )
+            ax.axis("off")
+
+            ax = fig.add_subplot(nrows, ncols, 2 * idx + 2)
+            with Image.open(BytesIO(heatmap)) as heatmap_image:
+                ax.imshow(np.asarray(heatmap_image))
+            ax.set_title(
+                f"{metric.value} = {score[METRICS.index(metric)]:.3f}",
+                fontsize=8,
+            )
+            ax.axis("off")
+
+        fig.tight_layout()
+
+        return render_png(fig)
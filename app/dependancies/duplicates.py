@@ -0,0 +1,572 @@
+import hashlib
+import os
+import sqlite3
+from contextlib import closing
+from itertools import combinations
+from math import comb
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from loguru import logger
+from PIL import Image
+
+from app.config import settings
+from app.dependancies.decoding import DecodeStats, open_image
+from app.dependancies.utils import shard_bounds
+from app.pydantic_models import DuplicateKind, PerceptualHash
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS hashes (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    ahash INTEGER NOT NULL,
+    dhash INTEGER NOT NULL,
+    phash INTEGER NOT NULL
+);
+"""
+
+# The order of the columns of the perceptual hashes.
+HASHES = [PerceptualHash.ahash, PerceptualHash.dhash, PerceptualHash.phash]
+
+# Side of the hashes, each one is HASH_SIZE * HASH_SIZE = 64 bits, and side of the
+# grayscale thumbnail the DCT of the pHash is computed on.
+HASH_SIZE = 8
+PHASH_SIZE = 32
+
+# The number of set bits of each byte value, to count bits without `np.bitwise_count`.
+_POPCOUNT = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
+# The maximal number of (hash, probe) couples looked up at once in a bucket table, and
+# the widest segment bucketed in a direct-address table, the wider ones are searched.
+_PROBES_CHUNK = 1 << 22
+_DIRECT_TABLE_BITS = 22
+
+
+def _dct_matrix(size: int) -> np.ndarray:
+    """Return the orthonormal DCT-II matrix of a given size."""
+    rows = np.arange(size)[:, np.newaxis]
+    cols = np.arange(size)[np.newaxis, :]
+    matrix = np.cos(np.pi * (2 * cols + 1) * rows / (2 * size)) * np.sqrt(2 / size)
+    matrix[0] /= np.sqrt(2)
+    return matrix.astype(np.float32)
+
+
+_DCT = _dct_matrix(PHASH_SIZE)
+
+
+class HashStore:
+    """On-disk store of the content and perceptual hashes of the images.
+
+    The hashes are rows of a SQLite database, shared by the gunicorn workers, along with
+    the size and modification time the file had when it was hashed. An image whose size
+    or modification time changed is hashed again. The 64-bit perceptual hashes are
+    stored as signed integers, the type of the SQLite integers.
+    """
+
+    def __init__(self, directory: Optional[str] = None) -> None:
+        """Open the store, creating it if needed.
+
+        Args:
+            directory (Optional[str], optional): The directory of the store. Defaults to
+                `settings.hashes_cache_dir`.
+        """
+        directory = Path(directory or settings.hashes_cache_dir)
+        directory.mkdir(parents=True, exist_ok=True)
+        self.db_path = directory / "hashes.sqlite"
+
+        with closing(self._connect()) as connection:
+            connection.executescript(_SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.db_path, timeout=60)
+        connection.execute("PRAGMA journal_mode=WAL")
+        return connection
+
+    def lookup(
+        self,
+        images_paths: List[Path],
+    ) -> Tuple[List[str], np.ndarray, List[int]]:
+        """Find the stored hashes of a list of images.
+
+        Args:
+            images_paths (List[Path]): The paths of the images.
+
+        Returns:
+            Tuple[List[str], np.ndarray, List[int]]: The SHA-256 digests and the
+                perceptual hashes, of shape (N, 3) in the order of `HASHES`, of all the
+                images (empty and 0 for the missing ones), and the positions in
+                `images_paths` of the images missing from the store, or changed since
+                they were hashed.
+        """
+        with closing(self._connect()) as connection:
+            stored = {
+                path: row
+                for path, *row in connection.execute(
+                    "SELECT path, size, mtime_ns, sha256, ahash, dhash, phash "
+                    + "FROM hashes",
+                )
+            }
+
+        digests = [""] * len(images_paths)
+        hashes = np.zeros((len(images_paths), len(HASHES)), dtype=np.int64)
+        missing = []
+        for idx, image_path in enumerate(images_paths):
+            row = stored.get(str(image_path))
+            stat = os.stat(image_path)
+            if row is None or (row[0], row[1]) != (stat.st_size, stat.st_mtime_ns):
+                missing.append(idx)
+                continue
+            digests[idx] = row[2]
+            hashes[idx] = row[3:]
+
+        return digests, hashes.view(np.uint64), missing
+
+    def update(
+        self,
+        images_paths: List[Path],
+        digests: List[str],
+        hashes: np.ndarray,
+    ) -> None:
+        """Store the hashes of a list of images.
+
+        Args:
+            images_paths (List[Path]): The paths of the images.
+            digests (List[str]): Their SHA-256 digests.
+            hashes (np.ndarray): Their perceptual hashes, of shape (N, 3).
+        """
+        rows = []
+        for image_path, digest, row in zip(
+            images_paths,
+            digests,
+            np.ascontiguousarray(hashes).view(np.int64),
+        ):
+            stat = os.stat(image_path)
+            rows.append(
+                (
+                    str(image_path),
+                    stat.st_size,
+                    stat.st_mtime_ns,
+                    digest,
+                    *row.tolist(),
+                ),
+            )
+
+        with closing(self._connect()) as connection, connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+
+
+def content_digest(file_path: Path, chunk_size: int = 1 << 20) -> str:
+    """Compute the SHA-256 digest of a file, read in chunks.
+
+    Args:
+        file_path (Path): The path of the file.
+        chunk_size (int, optional): The number of bytes read at once. Defaults to 1 MiB.
+
+    Returns:
+        str: The hexadecimal digest.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_hash_thumbnails(
+    image_path: Path,
+    decode_stats: Optional[DecodeStats] = None,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Decode an image into the grayscale thumbnails its perceptual hashes come from.
+
+    The image is decoded at the lowest resolution still larger than the pHash thumbnail,
+    see `app.dependancies.decoding.open_image`.
+
+    Args:
+        image_path (Path): The path of the image.
+        decode_stats (Optional[DecodeStats], optional): If given, the decoding is
+            recorded in it. Defaults to None.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: The uint8 thumbnails of the aHash, of
+            shape (8, 8), of the dHash, of shape (8, 9), and of the pHash, of shape
+            (32, 32).
+    """
+    with open_image(
+        image_path,
+        target_size=(PHASH_SIZE, PHASH_SIZE),
+        stats=decode_stats,
+    ) as image:
+        gray = image.convert("L")
+
+    return (
+        np.asarray(gray.resize((HASH_SIZE, HASH_SIZE), Image.BOX)),
+        np.asarray(gray.resize((HASH_SIZE + 1, HASH_SIZE), Image.BOX)),
+        np.asarray(gray.resize((PHASH_SIZE, PHASH_SIZE), Image.BOX)),
+    )
+
+
+def pack_bits(bits: np.ndarray) -> np.ndarray:
+    """Pack 64 booleans per row into a 64-bit integer, the first one as the highest bit.
+
+    Args:
+        bits (np.ndarray): The booleans, of shape (B, 64).
+
+    Returns:
+        np.ndarray: The uint64 integers, of shape (B,).
+    """
+    return np.packbits(bits, axis=1).view(">u8").ravel().astype(np.uint64)
+
+
+def perceptual_hashes(
+    small: np.ndarray,
+    wide: np.ndarray,
+    large: np.ndarray,
+) -> np.ndarray:
+    """Compute the aHash, dHash and pHash of a batch of thumbnails at once.
+
+    - aHash : the pixels of the 8x8 thumbnail brighter than its mean,
+    - dHash : the pixels of the 8x9 thumbnail brighter than their left neighbour,
+    - pHash : the 8x8 lowest frequencies of the DCT of the 32x32 thumbnail larger than
+      their median.
+
+    Args:
+        small (np.ndarray): The aHash thumbnails, of shape (B, 8, 8).
+        wide (np.ndarray): The dHash thumbnails, of shape (B, 8, 9).
+        large (np.ndarray): The pHash thumbnails, of shape (B, 32, 32).
+
+    Returns:
+        np.ndarray: The uint64 hashes, of shape (B, 3), in the order of `HASHES`.
+    """
+    num_images = len(small)
+
+    small = small.astype(np.float32)
+    ahash = small > small.mean(axis=(1, 2), keepdims=True)
+
+    wide = wide.astype(np.int16)
+    dhash = wide[:, :, 1:] > wide[:, :, :-1]
+
+    low = (_DCT @ large.astype(np.float32) @ _DCT.T)[:, :HASH_SIZE, :HASH_SIZE]
+    low = low.reshape(num_images, -1)
+    phash = low > np.median(low, axis=1, keepdims=True)
+
+    return np.stack(
+        [pack_bits(bits.reshape(num_images, -1)) for bits in (ahash, dhash, phash)],
+        axis=1,
+    )
+
+
+def hamming_distance(first: np.ndarray, second: np.ndarray) -> np.ndarray:
+    """Count the differing bits of 64-bit hashes, element-wise.
+
+    Args:
+        first (np.ndarray): The uint64 hashes.
+        second (np.ndarray): The uint64 hashes, broadcastable with `first`.
+
+    Returns:
+        np.ndarray: The Hamming distances.
+    """
+    xor = np.ascontiguousarray(np.bitwise_xor(first, second), dtype=np.uint64)
+    if hasattr(np, "bitwise_count"):  # numpy >= 2.0
+        return np.bitwise_count(xor)
+    return _POPCOUNT[xor.view(np.uint8)].reshape(*xor.shape, 8).sum(axis=-1)
+
+
+def compute_hashes(
+    images_paths: List[Path],
+    batch_size: int = 256,
+    progress: Optional[Callable[[int], None]] = None,
+    decode_stats: Optional[DecodeStats] = None,
+) -> Tuple[List[str], np.ndarray, int]:
+    """Compute the content and perceptual hashes of a dataset, only hashing new images.
+
+    The images missing from the `HashStore`, or changed since they were hashed, are
+    decoded into reused batches of thumbnails, hashed one batch at a time, and stored.
+
+    Args:
+        images_paths (List[Path]): The paths of the images.
+        batch_size (int, optional): The number of images hashed at once.
+            Defaults to 256.
+        progress (Optional[Callable[[int], None]], optional): Called with the number of
+            images done at each step. Defaults to None.
+        decode_stats (Optional[DecodeStats], optional): If given, the decoding of the
+            new images is recorded in it. Defaults to None.
+
+    Returns:
+        Tuple[List[str], np.ndarray, int]: The SHA-256 digests, the perceptual hashes,
+            of shape (N, 3) in the order of `HASHES`, and the number of images hashed.
+    """
+    store = HashStore()
+    digests, hashes, missing = store.lookup(images_paths=images_paths)
+    logger.info(
+        f"{len(images_paths) - len(missing)} hashes found in store, "
+        + f"{len(missing)} to compute.",
+    )
+
+    if progress is not None and len(images_paths) > len(missing):
+        progress(len(images_paths) - len(missing))
+
+    size = min(batch_size, len(missing))
+    small = np.empty((size, HASH_SIZE, HASH_SIZE), dtype=np.uint8)
+    wide = np.empty((size, HASH_SIZE, HASH_SIZE + 1), dtype=np.uint8)
+    large = np.empty((size, PHASH_SIZE, PHASH_SIZE), dtype=np.uint8)
+
+    for start in range(0, len(missing), batch_size):
+        batch = missing[start : start + batch_size]
+        batch_paths = [images_paths[idx] for idx in batch]
+
+        for idx, image_path in enumerate(batch_paths):
+            small[idx], wide[idx], large[idx] = load_hash_thumbnails(
+                image_path,
+                decode_stats=decode_stats,
+            )
+            digests[batch[idx]] = content_digest(image_path)
+
+        count = len(batch)
+        hashes[batch] = perceptual_hashes(small[:count], wide[:count], large[:count])
+        store.update(
+            images_paths=batch_paths,
+            digests=[digests[idx] for idx in batch],
+            hashes=hashes[batch],
+        )
+
+        if progress is not None:
+            progress(count)
+
+    return digests, hashes, len(missing)
+
+
+def _segment_masks(width: int, radius: int) -> np.ndarray:
+    """Return the masks of the keys of `width` bits within `radius` bits of a key."""
+    masks = [0]
+    for num_bits in range(1, radius + 1):
+        masks.extend(
+            sum(1 << bit for bit in bits)
+            for bits in combinations(range(width), num_bits)
+        )
+    return np.array(masks, dtype=np.uint64)
+
+
+def _num_segments(num_hashes: int, max_distance: int) -> int:
+    """Choose the number of segments of the multi-index search of `near_pairs`.
+
+    More segments mean smaller probing radiuses, but narrower segments, so fuller
+    buckets : the number chosen minimizes the expected number of probes and candidates.
+    """
+
+    def cost(num_segments: int) -> float:
+        width = 64 // num_segments
+        radius = max_distance // num_segments
+        probes = sum(comb(width, bits) for bits in range(radius + 1))
+        return num_segments * probes * (1 + num_hashes / 2**width)
+
+    return min(range(1, max_distance + 2), key=cost)
+
+
+def near_pairs(hashes: np.ndarray, max_distance: int) -> np.ndarray:
+    """Find the pairs of distinct 64-bit hashes within a Hamming distance, without
+    comparing every pair.
+
+    This is a multi-index hashing search. The hashes are split in m contiguous segments,
+    and two hashes within `max_distance` bits agree within `max_distance // m` bits on
+    at least one segment (pigeonhole principle). Each segment is a bucket table, sorted
+    by segment value, in which each hash looks up the keys within that radius of its
+    own. The candidates found are checked on the full hashes. The number of segments is
+    chosen so that the segments are about log2(N) bits wide when the radius allows it,
+    so a bucket holds few hashes, and the search is near-linear in the number of hashes.
+
+    Args:
+        hashes (np.ndarray): The distinct uint64 hashes, of shape (N,).
+        max_distance (int): The maximal Hamming distance of a pair.
+
+    Returns:
+        np.ndarray: The positions (i, j), with i < j, of the pairs, of shape (P, 2).
+    """
+    num_hashes = len(hashes)
+    if num_hashes < 2 or max_distance < 1:
+        return np.empty((0, 2), dtype=np.int64)
+
+    num_segments = _num_segments(num_hashes, max_distance)
+    radius = max_distance // num_segments
+    found = []
+
+    for start, stop in shard_bounds(64, num_segments):
+        width = stop - start
+        keys = (hashes >> np.uint64(64 - stop)) & np.uint64((1 << width) - 1)
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        masks = _segment_masks(width, radius)
+
+        if width <= _DIRECT_TABLE_BITS:
+            # the bucket of key k is order[table[k] : table[k + 1]]
+            sorted_keys, masks = sorted_keys.astype(np.int64), masks.astype(np.int64)
+            table = np.zeros((1 << width) + 1, dtype=np.int32)
+            np.cumsum(np.bincount(sorted_keys, minlength=1 << width), out=table[1:])
+
+        # probing the sorted keys with one mask at a time keeps the lookups close to
+        # sequential in memory
+        for mask in masks:
+            for first in range(0, num_hashes, _PROBES_CHUNK):
+                probes = sorted_keys[first : first + _PROBES_CHUNK] ^ mask
+                if width <= _DIRECT_TABLE_BITS:
+                    lefts = table[probes]
+                    counts = table[probes + 1] - lefts
+                else:
+                    lefts = np.searchsorted(sorted_keys, probes, side="left")
+                    counts = np.searchsorted(sorted_keys, probes, side="right") - lefts
+
+                hit = np.flatnonzero(counts)
+                if not len(hit):
+                    continue
+                counts = counts[hit]
+                sources = np.repeat(order[first + hit], counts)
+                offsets = np.arange(counts.sum()) - np.repeat(
+                    np.cumsum(counts) - counts,
+                    counts,
+                )
+                targets = order[np.repeat(lefts[hit], counts) + offsets]
+
+                keep = sources < targets
+                sources, targets = sources[keep], targets[keep]
+                distances = hamming_distance(hashes[sources], hashes[targets])
+                close = distances <= max_distance
+                found.append(sources[close] * num_hashes + targets[close])
+
+    if not found:
+        return np.empty((0, 2), dtype=np.int64)
+
+    pairs = np.unique(np.concatenate(found))
+    return np.stack([pairs // num_hashes, pairs % num_hashes], axis=1)
+
+
+class UnionFind:
+    """Disjoint sets of integers, merged with union by size and path halving."""
+
+    def __init__(self, size: int) -> None:
+        self.parent = list(range(size))
+        self.size = [1] * size
+
+    def find(self, item: int) -> int:
+        """Return the representative of the set of an item."""
+        parent = self.parent
+        while parent[item] != item:
+            parent[item] = parent[parent[item]]
+            item = parent[item]
+        return item
+
+    def union(self, first: int, second: int) -> None:
+        """Merge the sets of two items."""
+        first, second = self.find(first), self.find(second)
+        if first == second:
+            return
+        if self.size[first] < self.size[second]:
+            first, second = second, first
+        self.parent[second] = first
+        self.size[first] += self.size[second]
+
+    def groups(self) -> List[List[int]]:
+        """Return the sets of more than one item, by decreasing size."""
+        members: Dict[int, List[int]] = {}
+        for item in range(len(self.parent)):
+            members.setdefault(self.find(item), []).append(item)
+        return sorted(
+            (group for group in members.values() if len(group) > 1),
+            key=lambda group: (-len(group), group[0]),
+        )
+
+
+def group_duplicates(
+    digests: List[str],
+    hashes: np.ndarray,
+    max_distance: int,
+) -> List[Tuple[DuplicateKind, List[int]]]:
+    """Group the images with the same content, or perceptual hashes within a distance.
+
+    The images with equal hashes are merged first, so the pair search only runs on the
+    distinct hashes.
+
+    Args:
+        digests (List[str]): The SHA-256 digests of the images.
+        hashes (np.ndarray): One perceptual hash of each image, of shape (N,).
+        max_distance (int): The maximal Hamming distance of near duplicates.
+
+    Returns:
+        List[Tuple[DuplicateKind, List[int]]]: The groups of positions of duplicate
+            images, by decreasing size, "exact" when all the files are identical.
+    """
+    sets = UnionFind(len(digests))
+
+    first_of_digest: Dict[str, int] = {}
+    for idx, digest in enumerate(digests):
+        sets.union(first_of_digest.setdefault(digest, idx), idx)
+
+    distinct, first_of_hash, inverse = np.unique(
+        hashes,
+        return_index=True,
+        return_inverse=True,
+    )
+    for idx, value in enumerate(inverse.ravel().tolist()):
+        sets.union(int(first_of_hash[value]), idx)
+
+    pairs = near_pairs(distinct, max_distance=max_distance)
+    for first, second in first_of_hash[pairs].tolist():
+        sets.union(first, second)
+
+    logger.info(
+        f"{len(distinct)} distinct hashes out of {len(digests)}, "
+        + f"{len(pairs)} near pairs.",
+    )
+
+    return [
+        (
+            DuplicateKind.exact
+            if len({digests[idx] for idx in group}) == 1
+            else DuplicateKind.near,
+            group,
+        )
+        for group in sets.groups()
+    ]
+
+
+def find_duplicates(
+    images_paths: List[Path],
+    hash_function: PerceptualHash = PerceptualHash.phash,
+    max_distance: int = 4,
+    batch_size: int = 256,
+    progress: Optional[Callable[[int], None]] = None,
+    decode_stats: Optional[DecodeStats] = None,
+) -> Tuple[List[Tuple[DuplicateKind, List[int]]], int]:
+    """Find the groups of exact and near duplicates of a dataset.
+
+    See `compute_hashes` for the hashing of the images, and `group_duplicates` for the
+    grouping.
+
+    Args:
+        images_paths (List[Path]): The paths of the images.
+        hash_function (PerceptualHash, optional): The perceptual hash compared.
+            Defaults to PerceptualHash.phash.
+        max_distance (int, optional): The maximal Hamming distance, out of 64 bits, of
+            near duplicates. Defaults to 4.
+
+    Returns:
+        Tuple[List[Tuple[DuplicateKind, List[int]]], int]: The groups of positions of
+            duplicate images in `images_paths`, and the number of images hashed.
+    """
+    digests, hashes, num_hashed = compute_hashes(
+        images_paths=images_paths,
+        batch_size=batch_size,
+        progress=progress,
+        decode_stats=decode_stats,
+    )
+    groups = group_duplicates(
+        digests=digests,
+        hashes=hashes[:, HASHES.index(hash_function)],
+        max_distance=max_distance,
+    )
+
+    return groups, num_hashed
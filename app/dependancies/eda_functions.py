@@ -1,12 +1,169 @@
 from pathlib import Path
-from typing import List, Tuple
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
 
 import numpy as np
-from matplotlib import pyplot as plt
-from PIL import Image
+from matplotlib import cm
 
-from app.config import settings
-from app.dependancies.errors import HeightWidthMismatchError, validate_height_width
+from app.dependancies.decoding import DecodeStats, load_array
+from app.dependancies.errors import validate_rgb_images, validate_same_height_width
+from app.dependancies.rendering import (
+    encode_heatmap,
+    encode_png,
+    labels_colormap,
+    render_png,
+    reusable_figure,
+    thumbnail_array,
+)
+
+PIXEL_VALUES = 256
+CHANNELS = 3
+
+# Maximal number of labels whose mean images are contrasted pairwise, the largest labels
+# being kept, and largest side, in pixels, of the contrast images.
+MAX_CONTRAST_CLASSES = 8
+CONTRAST_SIZE = 128
+
+# Number of pixels reduced at once by `np.bincount`, bounds the size of the index buffer.
+_BINCOUNT_CHUNK = 1 << 16
+
+
+def compute_batch_channels_counts(images: np.ndarray) -> np.ndarray:
+    """Count the occurrences of each pixel value over each channels of a batch of 8-bit RGB images.
+
+    All the channels of all the images are counted with a single `np.bincount`, by
+    offsetting the values of each channel of each image into its own range of 256 bins.
+    The pixels are processed by chunks to keep the temporary index buffer small.
+
+    Args:
+        images (np.ndarray): The images, as a `uint8` np.array of shape (N, H, W, C), C >= 3.
+
+    Raises:
+        ChannelNotFoundError: If the images are not RGB images, e.g. grayscale images.
+        ValueError: If the images are not 8-bit images.
+
+    Returns:
+        np.ndarray: The counts, as an np.array of shape (N, 3, 256).
+    """
+    validate_rgb_images(images)
+    if images.dtype != np.uint8:
+        raise ValueError(f"Expected 8-bit images, got {images.dtype} images.")
+
+    num_images = images.shape[0]
+    pixels = images[..., :CHANNELS].reshape(num_images, -1, CHANNELS)
+
+    offsets = (
+        np.arange(num_images, dtype=np.intp)[:, None, None] * CHANNELS * PIXEL_VALUES
+        + np.arange(CHANNELS, dtype=np.intp)[None, None, :] * PIXEL_VALUES
+    )
+    num_bins = num_images * CHANNELS * PIXEL_VALUES
+    chunk = max(1, _BINCOUNT_CHUNK // num_images)
+
+    counts = np.zeros(num_bins, dtype=np.int64)
+    for idx in range(0, pixels.shape[1], chunk):
+        indices = pixels[:, idx : idx + chunk] + offsets
+        counts += np.bincount(indices.ravel(), minlength=num_bins)
+
+    return counts.reshape(num_images, CHANNELS, PIXEL_VALUES)
+
+
+def compute_channels_counts(image: np.ndarray) -> np.ndarray:
+    """Count the occurrences of each pixel value over each channels of an 8-bit RGB image.
+
+    Args:
+        image (np.ndarray): The image, as a `uint8` np.array of shape (H, W, C), C >= 3.
+
+    Returns:
+        np.ndarray: The counts, as an np.array of shape (3, 256).
+    """
+    return compute_batch_channels_counts(image[None])[0]
+
+
+def compute_channels_histograms(image: np.ndarray) -> np.ndarray:
+    """Compute the channels normed histograms of an 8-bit RGB image.
+
+    There is one bin per pixel value, from 0 to 255 included, so that the normed histogram of
+    each channel sums to 1.
+
+    Args:
+        image (np.ndarray): The image, as a `uint8` np.array of shape (H, W, C), C >= 3.
+
+    Returns:
+        np.ndarray: The normed histograms, as an np.array of shape (3, 256).
+    """
+    counts = compute_channels_counts(image)
+    return counts / counts.sum(axis=1, keepdims=True)
+
+
+def _stats_from_moments(
+    sums: np.ndarray,
+    squares_sums: np.ndarray,
+    num_pixels: int,
+) -> np.ndarray:
+    """Compute the channels means and stds from the sum and sum of squares of the pixels.
+
+    Args:
+        sums (np.ndarray): The sums of the pixel values, of shape (..., 3).
+        squares_sums (np.ndarray): The sums of the squared pixel values, of shape (..., 3).
+        num_pixels (int): The number of pixels per channel.
+
+    Returns:
+        np.ndarray: The RGB means followed by the RGB stds, of shape (..., 6).
+    """
+    means = sums / num_pixels
+    variances = np.maximum(squares_sums / num_pixels - means**2, 0)
+
+    return np.concatenate([means, np.sqrt(variances)], axis=-1)
+
+
+def compute_batch_channels_stats(images: np.ndarray) -> np.ndarray:
+    """Compute the mean and standard deviation over each channels of a batch of RGB images.
+
+    For 8-bit images, the per-channel sums and sums of squares are computed exactly, as
+    integers, from a single counting pass over the native `uint8` data (see
+    `compute_batch_channels_counts`). Other dtypes fall back to a float64 reduction.
+
+    Args:
+        images (np.ndarray): The images, as an np.array of shape (N, H, W, C), C >= 3.
+
+    Raises:
+        ChannelNotFoundError: If the images are not RGB images, e.g. grayscale images.
+
+    Returns:
+        np.ndarray: For each image, the RGB means followed by the RGB stds, as an np.array
+            of shape (N, 6).
+    """
+    validate_rgb_images(images)
+    num_pixels = images.shape[1] * images.shape[2]
+
+    if images.dtype == np.uint8:
+        counts = compute_batch_channels_counts(images).astype(np.uint64)
+        values = np.arange(PIXEL_VALUES, dtype=np.uint64)
+        sums = counts @ values
+        squares_sums = counts @ (values * values)
+    else:
+        pixels = images[..., :CHANNELS].reshape(images.shape[0], -1, CHANNELS)
+        sums = pixels.sum(axis=1, dtype=np.float64)
+        squares_sums = np.einsum("npc,npc->nc", pixels, pixels, dtype=np.float64)
+
+    return _stats_from_moments(
+        sums=sums.astype(np.float64),
+        squares_sums=squares_sums.astype(np.float64),
+        num_pixels=num_pixels,
+    )
+
+
+def compute_channels_stats(
+    image: np.ndarray,
+) -> Tuple[float, float, float, float, float, float]:
+    """Compute the mean and standard deviation over each channels of an RGB image.
+
+    Args:
+        image (np.ndarray): The image, as a np.array, for which you want to compute the stats.
+
+    Returns:
+        Tuple[float, float, float, float, float, float]: The RGB means followed by the RGB stds.
+    """
+    return tuple(compute_batch_channels_stats(image[None])[0].tolist())
 
 
 def compute_channels_mean(image: np.ndarray) -> Tuple[float, float, float]:
@@ -18,12 +175,7 @@ def compute_channels_mean(image: np.ndarray) -> Tuple[float, float, float]:
     Returns:
         Tuple[float, float, float]: The RGB means.
     """
-
-    red_mean_value = image[:, :, 0].mean()
-    green_mean_value = image[:, :, 1].mean()
-    blue_mean_value = image[:, :, 2].mean()
-
-    return red_mean_value, green_mean_value, blue_mean_value
+    return compute_channels_stats(image)[:CHANNELS]
 
 
 def compute_channels_std(image: np.ndarray) -> Tuple[float, float, float]:
@@ -35,234 +187,536 @@ def compute_channels_std(image: np.ndarray) -> Tuple[float, float, float]:
     Returns:
         Tuple[float, float, float]: The RGB stds.
     """
+    return compute_channels_stats(image)[CHANNELS:]
 
-    red_std_value = image[:, :, 0].std()
-    green_std_value = image[:, :, 1].std()
-    blue_std_value = image[:, :, 2].std()
 
-    return red_std_value, green_std_value, blue_std_value
+def compute_dataset_channels_stats(
+    images_paths: List[Path],
+    progress: Optional[Callable[[int], None]] = None,
+    scale: int = 1,
+    decode_stats: Optional[DecodeStats] = None,
+    out: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """Compute the mean and standard deviation over each channels of every image of a dataset.
 
+    The images are decoded one at a time, in their native dtype.
 
-def compute_histograms_channels(
-    image: np.ndarray,
-    filename: str,
-    timestamp: str,
-) -> Path:
+    Args:
+        images_paths (List[Path]): The paths of the images.
+        progress (Optional[Callable[[int], None]], optional): Called with the number of
+            images processed at each step. Defaults to None.
+        scale (int, optional): Decode the images at 1/scale of their width and height,
+            for an approximate result, see `app.dependancies.decoding.open_image`.
+            Defaults to 1.
+        decode_stats (Optional[DecodeStats], optional): If given, the decoding of the
+            images is recorded in it. Defaults to None.
+        out (Optional[np.ndarray], optional): A float64 array of shape (N, 6) to write
+            the statistics into, e.g. a shared-memory array. Defaults to None.
+
+    Returns:
+        np.ndarray: For each image, the RGB means followed by the RGB stds, as an np.array
+            of shape (N, 6).
+    """
+    if out is None:
+        out = np.empty((len(images_paths), 2 * CHANNELS), dtype=np.float64)
+    stats = out
+
+    for idx, image_path in enumerate(images_paths):
+        image = load_array(image_path, scale=scale, stats=decode_stats)
+        stats[idx] = compute_batch_channels_stats(image[None])[0]
+
+        if progress is not None:
+            progress(1)
+
+    return stats
+
+
+def compute_images_channels_stats(
+    images: Iterable[Tuple[str, np.ndarray]],
+    batch_size: int = 16,
+) -> Tuple[List[str], np.ndarray]:
+    """Compute the mean and standard deviation over each channels of a stream of RGB images.
+
+    Consecutive images of the same shape and dtype are stacked in batches of at most
+    `batch_size` images, reduced with `compute_batch_channels_stats`, then released, so the
+    memory used depends on the batch size only.
+
+    Args:
+        images (Iterable[Tuple[str, np.ndarray]]): The name and the image of each image.
+        batch_size (int, optional): The maximal number of images reduced at once. Defaults to 16.
+
+    Returns:
+        Tuple[List[str], np.ndarray]: The names of the images, and for each image the RGB
+            means followed by the RGB stds, as an np.array of shape (N, 6).
+    """
+    names: List[str] = []
+    stats: List[np.ndarray] = []
+    batch: List[np.ndarray] = []
+
+    def flush() -> None:
+        if batch:
+            stats.append(compute_batch_channels_stats(np.stack(batch)))
+            batch.clear()
+
+    for name, image in images:
+        if batch and (
+            len(batch) == batch_size
+            or image.shape != batch[0].shape
+            or image.dtype != batch[0].dtype
+        ):
+            flush()
+        batch.append(image)
+        names.append(name)
+    flush()
+
+    if not stats:
+        return names, np.empty((0, 2 * CHANNELS), dtype=np.float64)
+
+    return names, np.concatenate(stats)
+
+
+def compute_histograms_channels(image: np.ndarray, filename: str) -> bytes:
     """Compute the channels normed histograms of an image.
 
     The bins of the histograms are all of width 1, meaning that the normed histogram here defines a
     Probability mass function on each channels, i.e. the sum of all values for each channels is equal to 1.
 
-    See the following [StackOverflow post](https://stackoverflow.com/questions/21532667/numpy-histogram-cumulative-density-does-not-sum-to-1).
+    See the following [StackOverflow post](https://stackoverflow.com/questions/21532667/numpy-histogram-cumulative-density-does-not-sum-to-1),
+    and `compute_channels_histograms`.
 
     Args:
         image (np.ndarray): The image, as a np.array, for which you want to compute the channels normed histograms.
         filename (str): The name of the image file.
-        timestamp (str): The timestamp at which the endpoint has been called.
 
     Returns:
-        Path: The path to the histogram.
+        bytes: The histograms plot, as a PNG image.
+    """
+    return plot_histograms_channels(compute_channels_histograms(image), filename)
+
+
+def plot_histograms_channels(histograms: np.ndarray, filename: str) -> bytes:
+    """Plot the channels normed histograms of an image.
+
+    Only the histograms are needed, so they can be sent to a process of the process pool
+    rather than the whole image.
+
+    Args:
+        histograms (np.ndarray): The normed histograms, as returned by
+            `compute_channels_histograms`, of shape (3, 256).
+        filename (str): The name of the image file.
+
+    Returns:
+        bytes: The histograms plot, as a PNG image.
     """
     colors = ("red", "green", "blue")
-    channel_ids = (0, 1, 2)
 
-    pixel_range_value = 255
-    bins = np.arange(0, pixel_range_value)
+    pixel_values = np.arange(PIXEL_VALUES)
 
     # create the histogram plot, with three lines, one for
     # each color
-    plt.figure()
-    plt.xlim([0, pixel_range_value])
-    for channel_id, color in zip(channel_ids, colors):
-
-        histogram, bin_edges = np.histogram(
-            image[:, :, channel_id],
-            bins=bins,
-            range=(0, pixel_range_value),
-            density=True,
-        )
-        plt.plot(bin_edges[0:-1], histogram, color=color)
+    with reusable_figure("histograms", figsize=(6.4, 4.8)) as fig:
+        ax = fig.add_subplot()
+        ax.set_xlim([0, PIXEL_VALUES - 1])
+        for histogram, color in zip(histograms, colors):
+            ax.plot(pixel_values, histogram, color=color)
+
+        ax.set_title(f"Color Histogram of {filename}")
+        ax.set_xlabel("Color value")
+        ax.set_ylabel("Pixel density")
 
-    plt.title(f"Color Histogram of {filename}")
-    plt.xlabel("Color value")
-    plt.ylabel("Pixel density")
+        return render_png(fig)
 
-    saved_image_path = Path(
-        f"{settings.histograms_dir}/{filename}_{timestamp}.png",
-    ).resolve()
 
-    plt.savefig(saved_image_path)
+def accumulate_images_sum(
+    images_paths: List[Path],
+    progress: Optional[Callable[[int], None]] = None,
+    scale: int = 1,
+    decode_stats: Optional[DecodeStats] = None,
+    out: Optional[np.ndarray] = None,
+) -> Tuple[np.ndarray, int]:
+    """Sum the pixel values of an image dataset, reading one image at a time.
 
-    return saved_image_path
+    The images are decoded one by one and added into a single `uint64` buffer, so the
+    memory used does not depend on the number of images in the dataset, and the sum is
+    exact for 8-bit images.
 
+    Args:
+        images_paths (List[Path]): The paths of the images to sum.
+        progress (Optional[Callable[[int], None]], optional): Called with the number of
+            images processed at each step. Defaults to None.
+        scale (int, optional): Decode the images at 1/scale of their width and height,
+            for an approximate result, see `app.dependancies.decoding.open_image`.
+            Defaults to 1.
+        decode_stats (Optional[DecodeStats], optional): If given, the decoding of the
+            images is recorded in it. Defaults to None.
+        out (Optional[np.ndarray], optional): A zeroed uint64 array, of the shape of the
+            images, to add the images into, e.g. a shared-memory array. Defaults to None.
+
+    Raises:
+        HeightWidthMismatchError: If an image does not have the same height and width
+            as the first image of the dataset, or as `out`.
+        ValueError: If the dataset is empty.
 
-def compute_mean_image(images_list: List[np.ndarray], timestamp: str) -> Path:
+    Returns:
+        Tuple[np.ndarray, int]: The per-pixel sum of the images, and the number of images summed.
+    """
+    if not images_paths:
+        raise ValueError("Cannot compute the sum of an empty image dataset.")
+
+    images_sum = out
+
+    for image_path in images_paths:
+        image = load_array(image_path, scale=scale, stats=decode_stats)
+
+        if images_sum is None:
+            images_sum = np.zeros(image.shape, dtype=np.uint64)
+        else:
+            validate_same_height_width(reference=images_sum, image=image)
+
+        images_sum += image
+
+        if progress is not None:
+            progress(1)
+
+    return images_sum, len(images_paths)
+
+
+def compute_mean_image(
+    images_paths: List[Path],
+    progress: Optional[Callable[[int], None]] = None,
+    scale: int = 1,
+    decode_stats: Optional[DecodeStats] = None,
+) -> bytes:
     """Compute the mean image of an image dataset.
 
+    The images are streamed from disk and accumulated in a running sum, so the peak
+    memory does not depend on the size of the dataset.
+
     Args:
-        images_list (List[np.ndarray]): The image dataset on which you compute the mean image.
-        timestamp (str): The timestamp at which the endpoint has been called.
+        images_paths (List[Path]): The paths of the image dataset on which you compute the mean image.
+        progress (Optional[Callable[[int], None]], optional): Called with the number of
+            images processed at each step. Defaults to None.
+        scale (int, optional): Decode the images at 1/scale of their width and height,
+            for an approximate result, see `app.dependancies.decoding.open_image`.
+            Defaults to 1.
+        decode_stats (Optional[DecodeStats], optional): If given, the decoding of the
+            images is recorded in it. Defaults to None.
 
     Returns:
-        Path: The path to the mean image.
+        bytes: The mean image, as a PNG image.
     """
-    # Assuming all images are the same size, get dimensions of first image
-    height, width, _ = images_list[0].shape
+    images_sum, num_images = accumulate_images_sum(
+        images_paths=images_paths,
+        progress=progress,
+        scale=scale,
+        decode_stats=decode_stats,
+    )
 
-    try:
-        validate_height_width(images_list=images_list)
-    except HeightWidthMismatchError as err:
-        raise err
+    return encode_mean_image(images_sum=images_sum, num_images=num_images)
 
-    num_images = len(images_list)
 
-    # Create a numpy array of floats to store the average (assume RGB images)
-    arr = np.zeros((height, width, 3), dtype=np.float32)
+def encode_mean_image(images_sum: np.ndarray, num_images: int) -> bytes:
+    """Encode the mean image of an image dataset, from the sum of its images.
 
+    Args:
+        images_sum (np.ndarray): The per-pixel sum of the images, see `accumulate_images_sum`.
+        num_images (int): The number of images summed.
+
+    Returns:
+        bytes: The mean image, as a PNG image.
+    """
     # Build up average pixel intensities
-    arr = sum(images_list) / num_images
+    arr = images_sum / num_images
 
     # Round values in array and cast as 8-bit integer
     arr = np.array(np.round(arr), dtype=np.uint8)
 
-    # Generate, save final image
-    out = Image.fromarray(arr, mode="RGB")
-
-    saved_image_path = Path(
-        f"{settings.mean_image_dir}/average_{timestamp}.png",
-    ).resolve()
-
-    out.save(saved_image_path)
+    return encode_png(arr)
 
-    return saved_image_path
 
-
-def compute_scatterplot(images_paths: List[Path], timestamp: str) -> Path:
+def compute_scatterplot(
+    images_paths: List[Path],
+    progress: Optional[Callable[[int], None]] = None,
+    scale: int = 1,
+    decode_stats: Optional[DecodeStats] = None,
+) -> bytes:
     """Compute the mean vs std scatterplot of an image dataset.
 
     Args:
-        images_list (List[np.ndarray]): The image dataset on which you compute the mean vs std scatterplot.
-        timestamp (str): The timestamp at which the endpoint has been called.
+        images_paths (List[Path]): The paths of the image dataset on which you compute the mean vs std scatterplot.
+        progress (Optional[Callable[[int], None]], optional): Called with the number of
+            images processed at each step. Defaults to None.
+        scale (int, optional): Decode the images at 1/scale of their width and height,
+            for an approximate result, see `app.dependancies.decoding.open_image`.
+            Defaults to 1.
+        decode_stats (Optional[DecodeStats], optional): If given, the decoding of the
+            images is recorded in it. Defaults to None.
 
     Returns:
-        Path: The path to the scatterplot.
+        bytes: The scatterplot, as a PNG image.
     """
+    stats = compute_dataset_channels_stats(
+        images_paths=images_paths,
+        progress=progress,
+        scale=scale,
+        decode_stats=decode_stats,
+    )
+
+    return plot_scatterplot(stats=stats, images_paths=images_paths)
 
-    # colors = ("red", "green", "blue")
-    # channel_ids = (0, 1, 2)
 
+def plot_scatterplot(stats: np.ndarray, images_paths: List[Path]) -> bytes:
+    """Plot the mean vs std scatterplot of an image dataset, from the statistics of its images.
+
+    Args:
+        stats (np.ndarray): For each image, the RGB means followed by the RGB stds, see
+            `compute_dataset_channels_stats`.
+        images_paths (List[Path]): The paths of the images, labelled by their directory.
+
+    Returns:
+        bytes: The scatterplot, as a PNG image.
+    """
     images_labels = [Path(image_path).parent.stem for image_path in images_paths]
     labels_dict = {label: idx for idx, label in enumerate(sorted(set(images_labels)))}
     tags = [labels_dict[image_label] for image_label in images_labels]
 
-    images_list = [
-        np.array(Image.open(image), dtype=np.float32) / 255 for image in images_paths
+    # means-stds for each subplots, scaled in [0,1]
+    stats = stats / 255
+
+    cmap = labels_colormap()
+
+    with reusable_figure("scatterplot", figsize=(20, 15)) as fig:
+        # defines placeholders for subplots
+        axes = fig.subplots(nrows=1, ncols=CHANNELS, sharex=True, sharey=True)
+        fig.suptitle("Mean-std scatterplot. Pixel values in [0,1]")
+
+        # populate subplots
+        for channel, (ax, color) in enumerate(zip(axes, ("red", "green", "blue"))):
+            scatter = ax.scatter(
+                stats[:, channel],
+                stats[:, CHANNELS + channel],
+                c=tags,
+                alpha=0.5,
+                cmap=cmap,
+            )
+            ax.set_title(f"{color} channel")
+            ax.set_xlabel("means")
+            ax.set_ylabel("stds")
+
+        fig.legend(
+            handles=scatter.legend_elements()[0],
+            labels=sorted(labels_dict),
+            loc="upper left",
+        )
+
+        return render_png(fig)
+
+
+class ClassAccumulator:
+    """Running sums of the images of a label, see `accumulate_class_sums`."""
+
+    def __init__(self) -> None:
+        self.num_images = 0
+        self.images_sum: Optional[np.ndarray] = None
+        self.counts = np.zeros((CHANNELS, PIXEL_VALUES), dtype=np.int64)
+
+    def add(self, image: np.ndarray) -> None:
+        """Add an 8-bit RGB image to the sums.
+
+        Args:
+            image (np.ndarray): The image, as a `uint8` np.array of shape (H, W, C), C >= 3.
+
+        Raises:
+            HeightWidthMismatchError: If the image does not have the same height and
+                width as the images already added.
+        """
+        if self.images_sum is None:
+            self.images_sum = np.zeros(image.shape, dtype=np.uint64)
+        else:
+            validate_same_height_width(reference=self.images_sum, image=image)
+
+        self.images_sum += image
+        self.counts += compute_channels_counts(image)
+        self.num_images += 1
+
+    def mean_image(self) -> np.ndarray:
+        """Return the mean image of the label, as a float64 np.array."""
+        return self.images_sum / self.num_images
+
+    def channels_stats(self) -> np.ndarray:
+        """Return the RGB means followed by the RGB stds of all the pixels of the label."""
+        counts = self.counts.astype(np.uint64)
+        values = np.arange(PIXEL_VALUES, dtype=np.uint64)
+
+        return _stats_from_moments(
+            sums=(counts @ values).astype(np.float64),
+            squares_sums=(counts @ (values * values)).astype(np.float64),
+            num_pixels=int(self.counts[0].sum()),
+        )
+
+
+def accumulate_class_sums(
+    images_paths: List[Path],
+    progress: Optional[Callable[[int], None]] = None,
+    scale: int = 1,
+    decode_stats: Optional[DecodeStats] = None,
+) -> Dict[str, ClassAccumulator]:
+    """Sum the images of each label of a dataset, in a single pass over the dataset.
+
+    Each image is decoded once, and added to the accumulator of its label, its parent
+    directory : a `uint64` sum image and the 256-bin counts of each channel. The memory
+    used depends on the number of labels, not on the number of images, and the sums are
+    exact for 8-bit images.
+
+    Args:
+        images_paths (List[Path]): The paths of the images, labelled by their directory.
+        progress (Optional[Callable[[int], None]], optional): Called with the number of
+            images processed at each step. Defaults to None.
+        scale (int, optional): Decode the images at 1/scale of their width and height,
+            for an approximate result, see `app.dependancies.decoding.open_image`.
+            Defaults to 1.
+        decode_stats (Optional[DecodeStats], optional): If given, the decoding of the
+            images is recorded in it. Defaults to None.
+
+    Raises:
+        HeightWidthMismatchError: If an image does not have the same height and width
+            as the first image of its label.
+        ValueError: If the dataset is empty.
+
+    Returns:
+        Dict[str, ClassAccumulator]: The sums of each label, by label.
+    """
+    if not images_paths:
+        raise ValueError(
+            "Cannot compute the class statistics of an empty image dataset.",
+        )
+
+    accumulators: Dict[str, ClassAccumulator] = {}
+
+    for image_path in images_paths:
+        image = load_array(image_path, scale=scale, stats=decode_stats)
+        label = Path(image_path).parent.stem
+        accumulators.setdefault(label, ClassAccumulator()).add(image)
+
+        if progress is not None:
+            progress(1)
+
+    return dict(sorted(accumulators.items()))
+
+
+def contrast_labels(accumulators: Dict[str, ClassAccumulator]) -> List[str]:
+    """Select the labels whose mean images are contrasted pairwise.
+
+    Args:
+        accumulators (Dict[str, ClassAccumulator]): The sums of each label.
+
+    Returns:
+        List[str]: The `MAX_CONTRAST_CLASSES` largest labels sharing the size of the
+            largest label, in alphabetical order.
+    """
+    ranked = sorted(accumulators, key=lambda label: -accumulators[label].num_images)
+    shape = accumulators[ranked[0]].images_sum.shape
+
+    selected = [
+        label for label in ranked if accumulators[label].images_sum.shape == shape
     ]
+    return sorted(selected[:MAX_CONTRAST_CLASSES])
 
-    # defines placeholders for subplots
-    fig, (ax1, ax2, ax3) = plt.subplots(
-        nrows=1,
-        ncols=3,
-        sharex=True,
-        sharey=True,
-        figsize=(20, 15),
-    )
-    fig.suptitle("Mean-std scatterplot. Pixel values in [0,1]")
-    # fig = plt.figure(figsize=(20, 15))
-    # ax1 = fig.add_subplot(131)
-    # ax2 = fig.add_subplot(132)
-    # ax3 = fig.add_subplot(133)
-
-    # compute means-stds for each subplots
-    r_means = [compute_channels_mean(image)[0] for image in images_list]
-    r_stds = [compute_channels_std(image)[0] for image in images_list]
-
-    g_means = [compute_channels_mean(image)[1] for image in images_list]
-    g_stds = [compute_channels_std(image)[1] for image in images_list]
-
-    b_means = [compute_channels_mean(image)[2] for image in images_list]
-    b_stds = [compute_channels_std(image)[2] for image in images_list]
-
-    N = len(set(images_labels))
-
-    # define the colormap
-    cmap = plt.cm.jet
-    # extract all colors from the .jet map
-    cmaplist = [cmap(i) for i in range(cmap.N)]
-    # create the new map
-    cmap = cmap.from_list("Custom cmap", cmaplist, cmap.N)
-
-    # populate subplots
-    ax1.scatter(r_means, r_stds, c=tags, alpha=0.5, cmap=cmap)
-    ax2.scatter(g_means, g_stds, c=tags, alpha=0.5, cmap=cmap)
-    ax3.scatter(b_means, b_stds, c=tags, alpha=0.5, cmap=cmap)
-
-    ax1.set_title("red channel")
-    ax1.set_xlabel("means")
-    ax1.set_ylabel("stds")
-
-    ax2.set_title("green channel")
-    ax2.set_xlabel("means")
-    ax2.set_ylabel("stds")
-
-    ax3.set_title("blue channel")
-    ax3.set_xlabel("means")
-    ax3.set_ylabel("stds")
-
-    handles, labels = ax3.get_legend_handles_labels()
-    fig.legend(
-        handles=handles,
-        labels=labels,
-        loc="upper left",
-    )
 
-    # for channel, color in zip(channel_ids, colors):
-    #     means = [compute_channels_mean(image)[channel] for image in images_list]
-    #     stds = [compute_channels_std(image)[channel] for image in images_list]
+def compute_contrast_images(
+    accumulators: Dict[str, ClassAccumulator],
+) -> Dict[Tuple[str, str], np.ndarray]:
+    """Compute the difference between the mean images of each pair of labels.
 
-    # plt.scatter(means, stds, c=color, alpha=0.5)
+    The differences are averaged over the channels, reduced to at most
+    `CONTRAST_SIZE` pixels of side, and computed between the labels of
+    `contrast_labels` only, as their number grows with the square of the labels.
 
-    # plt.title("Mean-std scatterplot. Pixel values in [0,1]")
-    # plt.xlabel("means")
-    # plt.ylabel("stds")
+    Args:
+        accumulators (Dict[str, ClassAccumulator]): The sums of each label.
 
-    saved_image_path = Path(
-        f"{settings.scatterplots_dir}/scatter_{timestamp}.png",
-    ).resolve()
+    Returns:
+        Dict[Tuple[str, str], np.ndarray]: The mean image of the first label minus the
+            mean image of the second, for each pair of labels in alphabetical order.
+    """
+    labels = contrast_labels(accumulators)
+    means = {label: accumulators[label].mean_image() for label in labels}
 
-    plt.savefig(saved_image_path)
+    contrasts = {}
+    for idx, first in enumerate(labels):
+        for second in labels[idx + 1 :]:
+            diff = means[first] - means[second]
+            if diff.ndim == 3:
+                diff = diff.mean(axis=-1)
+            contrasts[(first, second)] = thumbnail_array(diff, max_size=CONTRAST_SIZE)
 
-    return saved_image_path
+    return contrasts
 
 
-# from sklearn.decomposition import PCA
-# from math import ceil
+def encode_contrast_images(
+    contrasts: Dict[Tuple[str, str], np.ndarray],
+) -> Dict[Tuple[str, str], bytes]:
+    """Color the contrast images on a diverging scale shared by all the pairs.
 
-# def eigenimages(full_mat, title, n_comp = 0.7, size = (64, 64)):
-#     # fit PCA to describe n_comp * variability in the class
-#     pca = PCA(n_components = n_comp, whiten = True)
-#     pca.fit(full_mat)
-#     print('Number of PC: ', pca.n_components_)
-#     return pca
+    Args:
+        contrasts (Dict[Tuple[str, str], np.ndarray]): See `compute_contrast_images`.
+
+    Returns:
+        Dict[Tuple[str, str], bytes]: The contrast images, as PNG images : red where the
+            first label is brighter, blue where the second one is.
+    """
+    vmax = max([float(np.abs(diff).max()) for diff in contrasts.values()] + [1.0])
+    colormap = cm.bwr
+
+    return {
+        pair: encode_heatmap(diff, vmin=-vmax, vmax=vmax, colormap=colormap)
+        for pair, diff in contrasts.items()
+    }
 
-# def plot_pca(pca, size = (64, 64)):
-#     # plot eigenimages in a grid
-#     n = pca.n_components_
-#     fig = plt.figure(figsize=(8, 8))
-#     r = int(n**.5)
-#     c = ceil(n/ r)
-#     for i in range(n):
-#         ax = fig.add_subplot(r, c, i + 1, xticks = [], yticks = [])
-#         ax.imshow(pca.components_[i].reshape(size),
-#                   cmap='Greys_r')
-#     plt.axis('off')
-#     plt.show()
 
-# plot_pca(eigenimages(normal_images, 'NORMAL'))
-# plot_pca(eigenimages(pnemonia_images, 'PNEUMONIA'))
+def plot_class_statistics(accumulators: Dict[str, ClassAccumulator]) -> bytes:
+    """Plot the mean image of each label, and the contrast between each pair of labels.
 
-# contrast_mean = norm_mean - pneu_mean
-# plt.imshow(contrast_mean, cmap='bwr')
-# plt.title(f'Difference Between Normal & Pneumonia Average')
-# plt.axis('off')
-# plt.show()
+    The labels of `contrast_labels` are laid out as a matrix : the mean images on the
+    diagonal, and the contrast images, see `compute_contrast_images`, above it.
+
+    Args:
+        accumulators (Dict[str, ClassAccumulator]): The sums of each label.
+
+    Returns:
+        bytes: The plot, as a PNG image.
+    """
+    labels = contrast_labels(accumulators)
+    contrasts = compute_contrast_images(accumulators)
+    vmax = max([float(np.abs(diff).max()) for diff in contrasts.values()] + [1.0])
+    size = len(labels)
+
+    with reusable_figure("class_statistics", figsize=(3 * size, 3 * size)) as fig:
+        fig.suptitle("Mean image of each label, and difference between the mean images")
+        axes = fig.subplots(nrows=size, ncols=size, squeeze=False)
+
+        for row, first in enumerate(labels):
+            for col, second in enumerate(labels):
+                ax = axes[row][col]
+                ax.axis("off")
+
+                if row == col:
+                    accumulator = accumulators[first]
+                    mean = np.round(accumulator.mean_image()).astype(np.uint8)
+                    ax.imshow(mean, cmap="gray")
+                    ax.set_title(
+                        f"{first} ({accumulator.num_images} images)",
+                        fontsize=8,
+                    )
+                elif row < col:
+                    ax.imshow(
+                        contrasts[(first, second)],
+                        cmap=cm.bwr,
+                        vmin=-vmax,
+                        vmax=vmax,
+                    )
+                    ax.set_title(f"{first} - {second}", fontsize=8)
+
+        fig.tight_layout()
+
+        return render_png(fig)
@@ -0,0 +1,233 @@
+from math import ceil
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from loguru import logger
+from PIL import Image
+from sklearn.decomposition import IncrementalPCA
+
+from app.dependancies.decoding import DecodeStats, open_image
+from app.dependancies.rendering import render_png, reusable_figure
+from app.dependancies.utils import shard_bounds
+
+# The (width, height) the images are resized to before the PCA.
+EIGEN_SIZE = (64, 64)
+
+# The number of components plotted for each label.
+MAX_PLOTTED_COMPONENTS = 8
+
+
+class Eigenimages:
+    """The principal components of a set of grayscale images, fitted with `IncrementalPCA`."""
+
+    def __init__(self, pca: IncrementalPCA, size: Tuple[int, int]) -> None:
+        """Wrap a fitted PCA.
+
+        Args:
+            pca (IncrementalPCA): The PCA, fitted on flattened images.
+            size (Tuple[int, int]): The (width, height) of the images.
+        """
+        self.size = size
+        self.num_images = int(pca.n_samples_seen_)
+        self.components = pca.components_.reshape(-1, size[1], size[0])
+        self.mean = pca.mean_.reshape(size[1], size[0])
+        self.explained_variance_ratio = pca.explained_variance_ratio_
+
+    def to_dict(self) -> Dict:
+        """Return the eigenimages as JSON-serializable lists, see `EigenimagesClass`."""
+        return {
+            "num_images": self.num_images,
+            "explained_variance_ratio": self.explained_variance_ratio.tolist(),
+            "mean": self.mean.tolist(),
+            "components": self.components.tolist(),
+        }
+
+
+def load_grayscale(
+    image_path: Path,
+    size: Tuple[int, int] = EIGEN_SIZE,
+    decode_stats: Optional[DecodeStats] = None,
+) -> np.ndarray:
+    """Decode an image as a flattened grayscale vector of a fixed size, in [0, 1].
+
+    The image is decoded at the lowest resolution still larger than `size`, see
+    `app.dependancies.decoding.open_image`, then resized.
+
+    Args:
+        image_path (Path): The path of the image.
+        size (Tuple[int, int], optional): The (width, height) of the vector. Defaults to
+            EIGEN_SIZE.
+        decode_stats (Optional[DecodeStats], optional): If given, the decoding is recorded
+            in it. Defaults to None.
+
+    Returns:
+        np.ndarray: The float32 vector, of shape (height * width,).
+    """
+    with open_image(image_path, target_size=size, stats=decode_stats) as image:
+        gray = image.convert("L").resize(size, Image.BILINEAR)
+
+    return np.asarray(gray, dtype=np.float32).ravel() / 255
+
+
+def fit_eigenimages(
+    images_paths: List[Path],
+    n_components: int = 16,
+    size: Tuple[int, int] = EIGEN_SIZE,
+    batch_size: int = 256,
+    progress: Optional[Callable[[int], None]] = None,
+    decode_stats: Optional[DecodeStats] = None,
+) -> Eigenimages:
+    """Fit the eigenimages of a set of images, streaming them in batches.
+
+    The images are decoded, resized to `size` and converted to grayscale one batch at a
+    time, and each batch updates an `IncrementalPCA`, so the memory used is bounded by
+    `batch_size`, and not by the number of images. The batches are made of at least
+    `n_components` images, as required by `IncrementalPCA.partial_fit`.
+
+    Args:
+        images_paths (List[Path]): The paths of the images.
+        n_components (int, optional): The number of eigenimages, at most the number of
+            images. Defaults to 16.
+        size (Tuple[int, int], optional): The (width, height) the images are resized to.
+            Defaults to EIGEN_SIZE.
+        batch_size (int, optional): The number of images decoded at once. Defaults to 256.
+        progress (Optional[Callable[[int], None]], optional): Called with the number of
+            images of each batch once it is fitted. Defaults to None.
+        decode_stats (Optional[DecodeStats], optional): If given, the decoding of the
+            images is recorded in it. Defaults to None.
+
+    Raises:
+        ValueError: If there are less than 2 images.
+
+    Returns:
+        Eigenimages: The fitted eigenimages.
+    """
+    num_images = len(images_paths)
+    if num_images < 2:
+        raise ValueError("Cannot compute the eigenimages of less than 2 images.")
+
+    n_components = min(n_components, num_images, size[0] * size[1])
+    batch_size = max(batch_size, n_components)
+    pca = IncrementalPCA(n_components=n_components)
+
+    # the remainder is spread over the batches, which hold from batch_size images to
+    # twice as many, so none is too small for partial_fit
+    batch = np.empty(
+        (min(2 * batch_size, num_images), size[0] * size[1]),
+        dtype=np.float32,
+    )
+    for start, stop in shard_bounds(num_images, max(1, num_images // batch_size)):
+        for idx, image_path in enumerate(images_paths[start:stop]):
+            batch[idx] = load_grayscale(
+                image_path,
+                size=size,
+                decode_stats=decode_stats,
+            )
+        pca.partial_fit(batch[: stop - start])
+
+        if progress is not None:
+            progress(stop - start)
+
+    logger.info(
+        f"{n_components} eigenimages fitted on {num_images} images, explaining "
+        + f"{pca.explained_variance_ratio_.sum():.1%} of the variance.",
+    )
+
+    return Eigenimages(pca=pca, size=size)
+
+
+def compute_eigenimages(
+    images_paths: List[Path],
+    per_label: bool = False,
+    n_components: int = 16,
+    size: Tuple[int, int] = EIGEN_SIZE,
+    batch_size: int = 256,
+    progress: Optional[Callable[[int], None]] = None,
+    decode_stats: Optional[DecodeStats] = None,
+) -> Dict[str, Eigenimages]:
+    """Fit the eigenimages of an image dataset, or of each of its labels.
+
+    See `fit_eigenimages` for the other arguments. The labels with less than 2 images are
+    skipped.
+
+    Args:
+        images_paths (List[Path]): The paths of the images, labelled by their directory.
+        per_label (bool, optional): Fit the eigenimages of each label separately.
+            Defaults to False, one fit on the whole dataset, under the label "all".
+
+    Raises:
+        ValueError: If no label has at least 2 images.
+
+    Returns:
+        Dict[str, Eigenimages]: The eigenimages of each label.
+    """
+    if per_label:
+        groups: Dict[str, List[Path]] = {}
+        for image_path in images_paths:
+            groups.setdefault(Path(image_path).parent.stem, []).append(image_path)
+    else:
+        groups = {"all": images_paths}
+
+    eigenimages = {}
+    for label, paths in sorted(groups.items()):
+        if len(paths) < 2:
+            logger.warning(f"Label {label} skipped, it has less than 2 images.")
+            if progress is not None:
+                progress(len(paths))
+            continue
+
+        eigenimages[label] = fit_eigenimages(
+            images_paths=paths,
+            n_components=n_components,
+            size=size,
+            batch_size=batch_size,
+            progress=progress,
+            decode_stats=decode_stats,
+        )
+
+    if not eigenimages:
+        raise ValueError("Cannot compute the eigenimages of less than 2 images.")
+
+    return eigenimages
+
+
+def plot_eigenimages(eigenimages: Dict[str, Eigenimages]) -> bytes:
+    """Plot the first eigenimages and the explained-variance curve of each label.
+
+    Args:
+        eigenimages (Dict[str, Eigenimages]): The eigenimages of each label.
+
+    Returns:
+        bytes: The plot, as a PNG image.
+    """
+    num_plotted = max(
+        min(len(eigen.components), MAX_PLOTTED_COMPONENTS)
+        for eigen in eigenimages.values()
+    )
+    # the eigenimages of a label fill 2 rows, next to its explained-variance curve
+    per_row = ceil(num_plotted / 2)
+    ncols = per_row + 2
+    nrows = 2 * len(eigenimages)
+
+    with reusable_figure("eigenimages", figsize=(2.5 * ncols, 2.5 * nrows)) as fig:
+        grid = fig.add_gridspec(nrows=nrows, ncols=ncols)
+
+        for row, (label, eigen) in enumerate(eigenimages.items()):
+            ax = fig.add_subplot(grid[2 * row : 2 * row + 2, :2])
+            ratios = np.cumsum(eigen.explained_variance_ratio)
+            ax.plot(np.arange(1, len(ratios) + 1), ratios, marker="o")
+            ax.set_ylim([0, 1])
+            ax.set_title(f"{label} ({eigen.num_images} images)")
+            ax.set_xlabel("components")
+            ax.set_ylabel("cumulated explained variance")
+
+            for idx, component in enumerate(eigen.components[:num_plotted]):
+                ax = fig.add_subplot(grid[2 * row + idx // per_row, 2 + idx % per_row])
+                ax.imshow(component, cmap="Greys_r")
+                ax.set_title(f"PC {idx + 1}", fontsize=8)
+                ax.axis("off")
+
+        fig.tight_layout()
+
+        return render_png(fig)
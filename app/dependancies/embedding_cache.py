@@ -0,0 +1,343 @@
+import json
+import os
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from loguru import logger
+
+from app.config import settings
+from app.dependancies.decoding import DecodeStats
+from app.dependancies.embedding_function import EmbeddingEngine
+from app.dependancies.utils import file_lock
+from app.pydantic_models import EmbeddingsModel
+
+
+def file_signature(image_path: Path) -> Tuple[int, int]:
+    """Return the size and modification time of a file, used to detect changed files.
+
+    Args:
+        image_path (Path): The path of the file.
+
+    Returns:
+        Tuple[int, int]: The size, in bytes, and the modification time, in ns.
+    """
+    stat = os.stat(image_path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+class EmbeddingStore:
+    """On-disk store of the embeddings computed by a model.
+
+    The embeddings are rows of a `.npy` file, read through a memory map. An `index.json`
+    file maps each image path to its row, along with the size and modification time the
+    file had when it was embedded. An image whose size or modification time changed is
+    considered as a new image. Writes are serialized between processes with a lock file.
+    """
+
+    def __init__(self, model: EmbeddingsModel, directory: Optional[str] = None) -> None:
+        """Open the store of a model.
+
+        Args:
+            model (EmbeddingsModel): The model whose embeddings are stored.
+            directory (Optional[str], optional): The root directory of the stores.
+                Defaults to `settings.embeddings_cache_dir`.
+        """
+        self.directory = Path(directory or settings.embeddings_cache_dir) / model.value
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        self.embeddings_path = self.directory / "embeddings.npy"
+        self.index_path = self.directory / "index.json"
+        self.lock_path = self.directory / ".lock"
+
+    def _read_index(self) -> Dict:
+        if not self.index_path.exists():
+            return {"count": 0, "entries": {}}
+
+        with open(self.index_path, "r") as index_file:
+            return json.load(index_file)
+
+    def _write_index(self, index: Dict) -> None:
+        tmp_path = self.index_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as index_file:
+            json.dump(index, index_file)
+        os.replace(tmp_path, self.index_path)
+
+    def _grow(self, capacity: int, dim: int) -> np.ndarray:
+        """Return a writable memory map of the embeddings holding at least `capacity` rows.
+
+        Args:
+            capacity (int): The number of rows needed.
+            dim (int): The dimension of the embeddings.
+
+        Returns:
+            np.ndarray: The writable memory map.
+        """
+        if self.embeddings_path.exists():
+            embeddings = np.load(self.embeddings_path, mmap_mode="r+")
+            if embeddings.shape[0] >= capacity:
+                return embeddings
+            new_capacity = max(capacity, 2 * embeddings.shape[0])
+        else:
+            embeddings = None
+            new_capacity = capacity
+
+        tmp_path = self.embeddings_path.with_suffix(".tmp.npy")
+        grown = np.lib.format.open_memmap(
+            tmp_path,
+            mode="w+",
+            dtype=np.float32,
+            shape=(new_capacity, dim),
+        )
+        if embeddings is not None:
+            grown[: embeddings.shape[0]] = embeddings
+            del embeddings
+        grown.flush()
+        os.replace(tmp_path, self.embeddings_path)
+
+        return grown
+
+    def lookup(
+        self,
+        images_paths: List[Path],
+    ) -> Tuple[np.ndarray, List[int]]:
+        """Find the stored embeddings of a list of images.
+
+        An image deleted since it was listed is missing, and its embedding is dropped
+        from the store, see `discard`.
+
+        Args:
+            images_paths (List[Path]): The paths of the images.
+
+        Returns:
+            Tuple[np.ndarray, List[int]]: The stored embeddings of the images found in the
+                store, in order, and the positions in `images_paths` of the images
+                missing from the store, or changed since they were stored.
+        """
+        rows = []
+        missing = []
+        deleted = []
+        with file_lock(self.lock_path, shared=True):
+            entries = self._read_index()["entries"]
+
+            for idx, image_path in enumerate(images_paths):
+                entry = entries.get(str(image_path))
+                if entry is None:
+                    missing.append(idx)
+                    continue
+                try:
+                    signature = file_signature(image_path)
+                except FileNotFoundError:
+                    deleted.append(image_path)
+                    missing.append(idx)
+                    continue
+                if (entry["size"], entry["mtime_ns"]) == signature:
+                    rows.append(entry["row"])
+                else:
+                    missing.append(idx)
+
+            if rows:
+                embeddings = np.load(self.embeddings_path, mmap_mode="r")[rows]
+            else:
+                embeddings = np.empty((0, 0), dtype=np.float32)
+
+        if deleted:
+            self.discard(deleted)
+
+        return embeddings, missing
+
+    def entries(self) -> Dict[str, Dict]:
+        """Return the size, modification time and row of each stored image, by path."""
+        with file_lock(self.lock_path, shared=True):
+            return self._read_index()["entries"]
+
+    def rows(self, rows: List[int]) -> np.ndarray:
+        """Read the embeddings stored in given rows.
+
+        Args:
+            rows (List[int]): The rows, see `entries`.
+
+        Returns:
+            np.ndarray: A copy of the embeddings, of shape (len(rows), dim).
+        """
+        with file_lock(self.lock_path, shared=True):
+            embeddings = np.load(self.embeddings_path, mmap_mode="r")
+            return np.array(embeddings[rows])
+
+    def version(self) -> Optional[Tuple[int, int]]:
+        """Return a marker changing with every update of the store.
+
+        Returns:
+            Optional[Tuple[int, int]]: The size and modification time of the index of the
+                store, None if nothing is stored.
+        """
+        if not self.index_path.exists():
+            return None
+        return file_signature(self.index_path)
+
+    def update(self, images_paths: List[Path], embeddings: np.ndarray) -> None:
+        """Store the embeddings of a list of images.
+
+        Images already in the store keep their row, which is overwritten.
+
+        Args:
+            images_paths (List[Path]): The paths of the images.
+            embeddings (np.ndarray): The embeddings, of shape (len(images_paths), dim).
+        """
+        if not images_paths:
+            return
+
+        with file_lock(self.lock_path):
+            index = self._read_index()
+            entries = index["entries"]
+
+            rows = []
+            stored_idx = []
+            for idx, image_path in enumerate(images_paths):
+                try:
+                    size, mtime_ns = file_signature(image_path)
+                except FileNotFoundError:
+                    # deleted since it was embedded, see `lookup`
+                    continue
+
+                entry = entries.get(str(image_path))
+                if entry is None:
+                    row = index["count"]
+                    index["count"] += 1
+                else:
+                    row = entry["row"]
+
+                entries[str(image_path)] = {
+                    "size": size,
+                    "mtime_ns": mtime_ns,
+                    "row": row,
+                }
+                rows.append(row)
+                stored_idx.append(idx)
+
+            stored = self._grow(capacity=index["count"], dim=embeddings.shape[1])
+            stored[rows] = embeddings[stored_idx]
+            stored.flush()
+            del stored
+
+            self._write_index(index)
+
+    def prune(self, images_paths: Iterable[Path]) -> int:
+        """Drop the embeddings of the images which are not in a dataset anymore.
+
+        The remaining embeddings are moved to the first rows, in order, so the store does
+        not grow with the deleted images. This renumbers the rows, see
+        `app.dependancies.neighbours_index.NeighboursIndex`.
+
+        Args:
+            images_paths (Iterable[Path]): The paths of the images of the dataset, as
+                listed by the dataset index.
+
+        Returns:
+            int: The number of embeddings dropped.
+        """
+        kept_paths = {str(image_path) for image_path in images_paths}
+
+        return self._compact(keep=lambda path: path in kept_paths)
+
+    def discard(self, images_paths: Iterable[Path]) -> int:
+        """Drop the embeddings of given images, e.g. deleted since they were listed.
+
+        The rows are renumbered as by `prune`.
+
+        Args:
+            images_paths (Iterable[Path]): The paths of the images.
+
+        Returns:
+            int: The number of embeddings dropped.
+        """
+        discarded_paths = {str(image_path) for image_path in images_paths}
+
+        return self._compact(keep=lambda path: path not in discarded_paths)
+
+    def _compact(self, keep: Callable[[str], bool]) -> int:
+        with file_lock(self.lock_path):
+            index = self._read_index()
+            entries = index["entries"]
+            kept = sorted(
+                (entry["row"], path) for path, entry in entries.items() if keep(path)
+            )
+            dropped = len(entries) - len(kept)
+            if not dropped:
+                return 0
+
+            stored = np.load(self.embeddings_path, mmap_mode="r")
+            tmp_path = self.embeddings_path.with_suffix(".tmp.npy")
+            compacted = np.lib.format.open_memmap(
+                tmp_path,
+                mode="w+",
+                dtype=np.float32,
+                shape=(max(len(kept), 1), stored.shape[1]),
+            )
+            compacted[: len(kept)] = stored[[row for row, _ in kept]]
+            for new_row, (_, path) in enumerate(kept):
+                entries[path]["row"] = new_row
+            compacted.flush()
+            del compacted, stored
+            os.replace(tmp_path, self.embeddings_path)
+
+            index["entries"] = {path: entries[path] for _, path in kept}
+            index["count"] = len(kept)
+            self._write_index(index)
+
+        logger.info(f"{dropped} embeddings of deleted images dropped from the store.")
+
+        return dropped
+
+
+def compute_embeddings(
+    engine: EmbeddingEngine,
+    images_paths: List[Path],
+    batch_size: int,
+    progress: Optional[Callable[[int], None]] = None,
+    decode_stats: Optional[DecodeStats] = None,
+) -> Tuple[np.ndarray, int, float]:
+    """Compute the embeddings of a dataset, only running the model on new or changed images.
+
+    Args:
+        engine (EmbeddingEngine): The engine used to embed the new images.
+        images_paths (List[Path]): The paths of the images of the dataset.
+        batch_size (int): The number of images per inference batch.
+        progress (Optional[Callable[[int], None]], optional): Called with the number of
+            images done at each step. Defaults to None.
+        decode_stats (Optional[DecodeStats], optional): If given, the decoding of the
+            new images is recorded in it. Defaults to None.
+
+    Returns:
+        Tuple[np.ndarray, int, float]: The embeddings, of shape (len(images_paths), dim),
+            the number of images that went through the model, and the inference
+            throughput in images/s (0 if every embedding was stored).
+    """
+    store = EmbeddingStore(model=engine.model_name)
+
+    stored, missing = store.lookup(images_paths=images_paths)
+    logger.info(f"{len(stored)} embeddings found in store, {len(missing)} to compute.")
+
+    if progress is not None and len(stored):
+        progress(len(stored))
+
+    if not missing:
+        return stored, 0, 0.0
+
+    missing_paths = [images_paths[idx] for idx in missing]
+    computed, throughput = engine.embed(
+        images_paths=missing_paths,
+        batch_size=batch_size,
+        progress=progress,
+        decode_stats=decode_stats,
+    )
+    store.update(images_paths=missing_paths, embeddings=computed)
+
+    embeddings = np.empty((len(images_paths), computed.shape[1]), dtype=np.float32)
+    is_missing = np.zeros(len(images_paths), dtype=bool)
+    is_missing[missing] = True
+    embeddings[is_missing] = computed
+    if len(stored):
+        embeddings[~is_missing] = stored
+
+    return embeddings, len(missing), throughput
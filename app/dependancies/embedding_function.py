@@ -1,23 +1,34 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import List
+from typing import Callable, Dict, List, Optional, Tuple
 
 import numpy as np
-import onnxruntime as rt
-import umap
 from loguru import logger
-from matplotlib import pyplot as plt
-from PIL import Image
-from sklearn.manifold import TSNE
 
 from app.config import settings
+from app.dependancies.clustering import compute_projection
+from app.dependancies.decoding import DecodeStats, open_image
+from app.dependancies.metrics import span
+from app.dependancies.rendering import labels_colormap, render_png, reusable_figure
+from app.dependancies.sessions import create_session
+from app.dependancies.utils import generate_batch
 from app.pydantic_models import ClusteringMode, EmbeddingsModel, Providers
 
+INPUT_SIZE = (224, 224)
+
 
 class EmbeddingEngine:
     """_summary_"""
 
     def __init__(
-        self, model: EmbeddingsModel, provider: Providers, *args, **kwargs
+        self,
+        model: EmbeddingsModel,
+        provider: Providers,
+        *args,
+        **kwargs,
     ) -> None:
         """_summary_
 
@@ -32,6 +43,9 @@ class EmbeddingEngine:
         super().__init__(*args, **kwargs)
         if model == EmbeddingsModel.resnet50v2:
             self.model = settings.resnet50v2
+        elif model == EmbeddingsModel.resnet50v2_int8:
+            # produced offline from resnet50v2, see `app.dependancies.quantization`
+            self.model = settings.resnet50v2_int8
         else:
             raise NotImplementedError
 
@@ -41,71 +55,277 @@ class EmbeddingEngine:
             logger.warning("GPU support not implemented, please chose cpu support.")
             raise NotImplementedError
 
-        self.loaded_model = rt.InferenceSession(self.model, providers=self.provider)
+        self.model_name = model
+        self.provider_name = provider
+        self.profile_name = settings.session_profile
+        self.warmup_time = None
+        self.batch_size = settings.default_batch_size
+        self.batch_throughputs: Dict[int, float] = {}
+        self._warmup_lock = threading.Lock()
+
+        start = time.perf_counter()
+        self.loaded_model, self.model_file = create_session(
+            model_path=self.model,
+            providers=self.provider,
+            profile_name=self.profile_name,
+        )
+        self.load_time = time.perf_counter() - start
+
+    def warmup(self, batch_size: int = 1) -> float:
+        """Run a dummy batch through the model, once, to trigger the lazy initializations.
 
-    def infer(self, images_paths) -> np.ndarray:
-        """_summary_
+        If `settings.batch_autotune` is set, the batch size is then tuned, see `autotune`.
+
+        Args:
+            batch_size (int, optional): The size of the dummy batch. Defaults to 1.
+
+        Returns:
+            float: The time, in seconds, taken by the warm-up.
+        """
+        with self._warmup_lock:
+            if self.warmup_time is None:
+                dummy = np.zeros((batch_size, *INPUT_SIZE, 3), dtype=np.float32)
+                start = time.perf_counter()
+                self.loaded_model.run(["avg_pool"], {"input": dummy})
+                self.warmup_time = time.perf_counter() - start
+                logger.info(
+                    f"{self.model_name.value} warmed up in {self.warmup_time:.3f}s.",
+                )
+
+                if settings.batch_autotune:
+                    self.autotune()
+
+        return self.warmup_time
+
+    def autotune(
+        self,
+        batch_sizes: Optional[List[int]] = None,
+        runs: Optional[int] = None,
+    ) -> int:
+        """Benchmark the model on a few batch sizes, and keep the one with the best throughput.
+
+        The batch sizes are tried in increasing order, each with an untimed run then `runs`
+        timed runs on a dummy batch. The search stops at the first batch size slower than
+        the best one so far, as larger batches only add memory past the optimum.
 
         Args:
-            images_paths (_type_): _description_
+            batch_sizes (Optional[List[int]], optional): The candidate batch sizes.
+                Defaults to `settings.autotune_batch_sizes`.
+            runs (Optional[int], optional): The number of timed runs per batch size.
+                Defaults to `settings.autotune_runs`.
 
         Returns:
-            np.ndarray: _description_
+            int: The selected batch size, also stored in `batch_size`.
         """
+        batch_sizes = sorted(batch_sizes or settings.autotune_batch_sizes)
+        runs = runs or settings.autotune_runs
+
+        throughputs: Dict[int, float] = {}
+        for batch_size in batch_sizes:
+            dummy = np.zeros((batch_size, *INPUT_SIZE, 3), dtype=np.float32)
+            self.loaded_model.run(["avg_pool"], {"input": dummy})
+
+            start = time.perf_counter()
+            for _ in range(runs):
+                self.loaded_model.run(["avg_pool"], {"input": dummy})
+            throughputs[batch_size] = batch_size * runs / (time.perf_counter() - start)
+
+            if throughputs[batch_size] < max(throughputs.values()):
+                break
+
+        self.batch_throughputs = throughputs
+        self.batch_size = max(throughputs, key=throughputs.get)
+        logger.info(
+            f"{self.model_name.value} batch size tuned to {self.batch_size}, "
+            + f"{throughputs[self.batch_size]:.1f} images/s.",
+        )
+
+        return self.batch_size
 
-        images_list = [Image.open(image).resize((224, 224)) for image in images_paths]
+    @staticmethod
+    def load_image(
+        image_path: Path,
+        out: np.ndarray,
+        decode_stats: Optional[DecodeStats] = None,
+    ) -> None:
+        """Decode, resize and normalize an image into a preallocated buffer.
 
-        images = [np.asarray(image, dtype="float32") / 255 for image in images_list]
+        If `settings.embedding_reduced_decoding` is set, the image is decoded at the
+        smallest resolution still larger than the input of the model, see
+        `app.dependancies.decoding.open_image`, before the final resize.
 
-        images = np.reshape(images, (-1, 224, 224, 3))
+        Args:
+            image_path (Path): The path of the image.
+            out (np.ndarray): The float32 buffer, of shape (224, 224, 3), to write into.
+            decode_stats (Optional[DecodeStats], optional): If given, the decoding of the
+                image is recorded in it. Defaults to None.
+        """
+        target_size = INPUT_SIZE if settings.embedding_reduced_decoding else None
+        with span("embedding_decode", images=1), open_image(
+            image_path,
+            target_size=target_size,
+            stats=decode_stats,
+        ) as image:
+            resized = image.resize(INPUT_SIZE)
 
-        logits = self.loaded_model.run(["avg_pool"], {"input": images})
+        # the alpha channel, if any, is dropped
+        np.divide(np.asarray(resized)[..., :3], 255, out=out, dtype=np.float32)
+
+    def infer(self, images_paths: List[Path]) -> np.ndarray:
+        """Compute the embeddings of a batch of images.
+
+        Args:
+            images_paths (List[Path]): The paths of the images of the batch.
+
+        Returns:
+            np.ndarray: The embeddings, of shape (len(images_paths), embedding dim).
+        """
+        images = np.empty((len(images_paths), *INPUT_SIZE, 3), dtype=np.float32)
+        for idx, image_path in enumerate(images_paths):
+            self.load_image(image_path, out=images[idx])
+
+        with span("session_run", images=len(images_paths)):
+            logits = self.loaded_model.run(["avg_pool"], {"input": images})
         return logits[0]
 
-    def compute_clustering(
+    def embed(
         self,
-        logits: np.ndarray,
-        mode: ClusteringMode,
-    ) -> np.ndarray:
-        """_summary_
+        images_paths: List[Path],
+        batch_size: int,
+        num_workers: Optional[int] = None,
+        queue_depth: Optional[int] = None,
+        progress: Optional[Callable[[int], None]] = None,
+        decode_stats: Optional[DecodeStats] = None,
+    ) -> Tuple[np.ndarray, float]:
+        """Compute the embeddings of a dataset, decoding the next batches during inference.
+
+        A thread pool decodes and resizes the images of the `queue_depth` next batches
+        into a ring of preallocated (batch_size, 224, 224, 3) float32 buffers, while the
+        current batch is in `session.run`. A buffer is handed back to the decoders as soon
+        as its batch has been run.
 
         Args:
-            logits (np.ndarray): _description_
-            mode (ClusteringMode): _description_
+            images_paths (List[Path]): The paths of the images of the dataset.
+            batch_size (int): The number of images per inference batch.
+            num_workers (Optional[int], optional): The number of decoding threads.
+                Defaults to `settings.embedding_workers`.
+            queue_depth (Optional[int], optional): The number of batches decoded ahead of
+                the one being inferred. Defaults to `settings.embedding_queue_depth`.
+            progress (Optional[Callable[[int], None]], optional): Called with the number
+                of images of each batch once it has been inferred. Defaults to None.
+            decode_stats (Optional[DecodeStats], optional): If given, the decoding of the
+                images is recorded in it. Defaults to None.
 
         Returns:
-            np.ndarray: _description_
+            Tuple[np.ndarray, float]: The embeddings, of shape (len(images_paths), embedding dim),
+                and the throughput in images/s.
         """
+        num_workers = num_workers or settings.embedding_workers
+        queue_depth = queue_depth or settings.embedding_queue_depth
+
+        batches = list(generate_batch(lst=images_paths, batch_size=batch_size))
+        buffers = [
+            np.empty((batch_size, *INPUT_SIZE, 3), dtype=np.float32)
+            for _ in range(min(queue_depth + 1, len(batches)))
+        ]
+        logits = []
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+
+            def submit(batch_idx: int) -> List[Future]:
+                buffer = buffers[batch_idx % len(buffers)]
+                return [
+                    executor.submit(
+                        self.load_image,
+                        image_path,
+                        buffer[idx],
+                        decode_stats,
+                    )
+                    for idx, image_path in enumerate(batches[batch_idx])
+                ]
+
+            pending = deque(submit(batch_idx) for batch_idx in range(len(buffers)))
+
+            for batch_idx, batch in enumerate(batches):
+                # the time inference waits for its batch to be decoded
+                with span("embedding_decode_wait"):
+                    for future in pending.popleft():
+                        future.result()
+
+                buffer = buffers[batch_idx % len(buffers)]
+                with span("session_run", images=len(batch)):
+                    batch_logits = self.loaded_model.run(
+                        ["avg_pool"],
+                        {"input": buffer[: len(batch)]},
+                    )
+                logits.append(batch_logits[0])
+
+                if batch_idx + len(buffers) < len(batches):
+                    pending.append(submit(batch_idx + len(buffers)))
+
+                if progress is not None:
+                    progress(len(batch))
+
+        throughput = len(images_paths) / (time.perf_counter() - start)
+        logger.info(f"Inference done at {throughput:.1f} images/s.")
+
+        return np.vstack(logits), throughput
+
+    @staticmethod
+    def compute_clustering(
+        logits: np.ndarray,
+        mode: ClusteringMode,
+        labels: Optional[List[str]] = None,
+        sample_size: Optional[int] = None,
+        pca_components: Optional[int] = None,
+        seed: Optional[int] = None,
+    ) -> Tuple[np.ndarray, Dict[str, float]]:
+        """Project the embeddings of a dataset in 2D.
 
-        if mode == ClusteringMode.tsne:
-            clusters = TSNE(
-                n_components=2,
-                learning_rate="auto",
-                init="random",
-            ).fit_transform(logits)
-        elif mode == ClusteringMode.umap:
-            reducer = umap.UMAP()
-            clusters = reducer.fit_transform(logits)
+        See `app.dependancies.clustering.compute_projection` for the subsampling and
+        PCA pre-reduction.
 
-        return clusters
+        Args:
+            logits (np.ndarray): The embeddings, of shape (N, embedding dim).
+            mode (ClusteringMode): The projection method.
+            labels (Optional[List[str]], optional): The label of each image, used to
+                stratify the subsample. Defaults to None.
+            sample_size (Optional[int], optional): The number of images the projection
+                is fitted on. Defaults to None, all the images.
+            pca_components (Optional[int], optional): The number of PCA dimensions.
+                Defaults to None, no PCA.
+            seed (Optional[int], optional): The random seed. Defaults to None.
 
+        Returns:
+            Tuple[np.ndarray, Dict[str, float]]: The 2D coordinates, of shape (N, 2), and
+                the time of each stage.
+        """
+        return compute_projection(
+            logits=logits,
+            mode=mode,
+            labels=labels,
+            sample_size=sample_size,
+            pca_components=pca_components,
+            seed=seed,
+        )
+
+    @staticmethod
     def plot(
-        self,
         logits: np.ndarray,
         images_paths: List[Path],
-        timestamp: str,
         mode: ClusteringMode,
-    ) -> Path:
-        """_summary_
+    ) -> bytes:
+        """Plot the 2D projection of the embeddings of a dataset, colored by label.
 
         Args:
-            logits (np.ndarray): _description_
-            images_paths (List[Path]): _description_
-            timestamp (str): _description_
-            mode (ClusteringMode): _description_
+            logits (np.ndarray): The 2D projection of the embeddings, of shape (N, 2).
+            images_paths (List[Path]): The paths of the images, their labels are the names
+                of their parent directories.
+            mode (ClusteringMode): The method used to compute the projection.
 
         Returns:
-            Path: _description_
+            bytes: The scatterplot, as a PNG image.
         """
 
         images_labels = [Path(image_path).parent.stem for image_path in images_paths]
@@ -114,35 +334,74 @@ class EmbeddingEngine:
         }
         tags = [labels_dict[image_label] for image_label in images_labels]
 
-        N = len(set(images_labels))
-
-        # define the colormap
-        cmap = plt.cm.jet
-        # extract all colors from the .jet map
-        cmaplist = [cmap(i) for i in range(cmap.N)]
-        # create the new map
-        cmap = cmap.from_list("Custom cmap", cmaplist, cmap.N)
-
-        plt.figure(figsize=(20, 20))
-        scatter = plt.scatter(logits[:, 0], logits[:, 1], c=tags, cmap=cmap)
-
-        if mode == ClusteringMode.tsne:
-            plt.title("tSNE scatterplot with ResNet50v2 preprocess")
-        if mode == ClusteringMode.umap:
-            plt.title("UMAP scatterplot with ResNet50v2 preprocess")
-
-        plt.xlabel("Dimension 1")
-        plt.ylabel("Dimension 2")
-        plt.legend(
-            handles=scatter.legend_elements()[0],
-            labels=sorted(set(images_labels)),
-            title="Labels",
-        )
-
-        saved_image_path = Path(
-            f"{settings.scatterplots_dir}/tSNE_scatter_{timestamp}.png",
-        ).resolve()
-
-        plt.savefig(saved_image_path)
-
-        return saved_image_path
+        with reusable_figure("clustering", figsize=(20, 20)) as fig:
+            ax = fig.add_subplot()
+            scatter = ax.scatter(
+                logits[:, 0],
+                logits[:, 1],
+                c=tags,
+                cmap=labels_colormap(),
+            )
+
+            if mode == ClusteringMode.tsne:
+                ax.set_title("tSNE scatterplot with ResNet50v2 preprocess")
+            if mode == ClusteringMode.umap:
+                ax.set_title("UMAP scatterplot with ResNet50v2 preprocess")
+
+            ax.set_xlabel("Dimension 1")
+            ax.set_ylabel("Dimension 2")
+            ax.legend(
+                handles=scatter.legend_elements()[0],
+                labels=sorted(labels_dict),
+                title="Labels",
+            )
+
+            return render_png(fig)
+
+
+_ENGINES: Dict[Tuple[EmbeddingsModel, Providers], EmbeddingEngine] = {}
+_ENGINES_LOCK = threading.Lock()
+
+
+def get_engine(
+    model: EmbeddingsModel,
+    provider: Providers,
+    warmup: bool = False,
+) -> EmbeddingEngine:
+    """Return the process-wide `EmbeddingEngine` for a (model, provider) pair.
+
+    The ONNX session is created the first time the pair is requested, then shared by
+    every later call. `onnxruntime.InferenceSession.run` is thread-safe, so the engine
+    can be used by concurrent requests. If `settings.batch_autotune` is set, the engine
+    is warmed up, and its batch size tuned, at its first use, see `EmbeddingEngine.warmup`.
+
+    Args:
+        model (EmbeddingsModel): The embedding model.
+        provider (Providers): The execution provider.
+        warmup (bool, optional): Whether to run a dummy batch through a newly created
+            session, even without `settings.batch_autotune`. Defaults to False.
+
+    Returns:
+        EmbeddingEngine: The shared engine.
+    """
+    with _ENGINES_LOCK:
+        engine = _ENGINES.get((model, provider))
+        if engine is None:
+            engine = EmbeddingEngine(model=model, provider=provider)
+            _ENGINES[(model, provider)] = engine
+            logger.info(f"{model.value} loaded in {engine.load_time:.3f}s.")
+
+    if warmup or settings.batch_autotune:
+        engine.warmup()
+
+    return engine
+
+
+def get_loaded_engines() -> List[EmbeddingEngine]:
+    """Return the engines currently loaded in the process.
+
+    Returns:
+        List[EmbeddingEngine]: The loaded engines.
+    """
+    with _ENGINES_LOCK:
+        return list(_ENGINES.values())
@@ -1,5 +1,3 @@
-from typing import List
-
 import numpy as np
 
 
@@ -27,14 +25,38 @@ class ChannelNotFoundError(DimensionError):
     """
 
 
-def validate_height_width(
-    images_list: List[np.ndarray],
+class InvalidArchiveError(ValueError):
+    """An uploaded archive is truncated or corrupt."""
+
+
+class EmptyDatasetError(ValueError):
+    """The dataset has no image of the requested extension."""
+
+
+def validate_rgb_images(images: np.ndarray) -> None:
+    # a grayscale (N, H, W) batch would otherwise be read as width-3 RGB images
+    if images.ndim != 4 or images.shape[-1] < 3:
+        raise ChannelNotFoundError(images.shape)
+
+
+def validate_same_height_width(
+    reference: np.ndarray,
+    image: np.ndarray,
+) -> None:
+    height, width = reference.shape[:2]
+    img_height, img_width = image.shape[:2]
+
+    if img_height - height != 0:
+        raise HeightWidthMismatchError(img_height, height)
+    elif img_width - width != 0:
+        raise HeightWidthMismatchError(img_width, width)
+
+
+def validate_same_shape(
+    reference: np.ndarray,
+    image: np.ndarray,
 ) -> None:
-    height, width, _ = images_list[0].shape
-
-    for idx in range(1, len(images_list)):
-        img_height, img_width, _ = images_list[idx].shape
-        if img_height - height != 0:
-            raise HeightWidthMismatchError(img_height, height)
-        elif img_width - width != 0:
-            raise HeightWidthMismatchError(img_width, width)
+    validate_same_height_width(reference=reference, image=image)
+    # e.g. a grayscale or RGBA image in an RGB dataset
+    if image.shape[2:] != reference.shape[2:]:
+        raise ChannelNotFoundError(image.shape, reference.shape)
@@ -0,0 +1,275 @@
+import asyncio
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from loguru import logger
+
+from app.config import settings
+
+
+class ExecutorStats:
+    """Latencies of the tasks run by an executor.
+
+    The queue time is the time spent by a task between its submission and the start of
+    its execution, the execution time is the time spent running it.
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.submitted = 0
+        self.completed = 0
+        self.queue_time = 0.0
+        self.max_queue_time = 0.0
+        self.execution_time = 0.0
+        self.max_execution_time = 0.0
+        self._lock = threading.Lock()
+
+    def record_submission(self) -> None:
+        with self._lock:
+            self.submitted += 1
+
+    def record_completion(self, queue_time: float, execution_time: float) -> None:
+        with self._lock:
+            self.completed += 1
+            self.queue_time += queue_time
+            self.max_queue_time = max(self.max_queue_time, queue_time)
+            self.execution_time += execution_time
+            self.max_execution_time = max(self.max_execution_time, execution_time)
+
+    def report(self) -> Dict[str, Any]:
+        with self._lock:
+            completed = max(self.completed, 1)
+            return {
+                "name": self.name,
+                "submitted": self.submitted,
+                "pending": self.submitted - self.completed,
+                "completed": self.completed,
+                "mean_queue_time": self.queue_time / completed,
+                "max_queue_time": self.max_queue_time,
+                "mean_execution_time": self.execution_time / completed,
+                "max_execution_time": self.max_execution_time,
+            }
+
+
+_THREAD_POOL: Optional[ThreadPoolExecutor] = None
+_PROCESS_POOL: Optional[ProcessPoolExecutor] = None
+_SHARD_POOL: Optional[ProcessPoolExecutor] = None
+_POOLS_LOCK = threading.Lock()
+
+_THREAD_STATS = ExecutorStats(name="thread")
+_PROCESS_STATS = ExecutorStats(name="process")
+
+
+def _get_thread_pool() -> ThreadPoolExecutor:
+    global _THREAD_POOL
+
+    with _POOLS_LOCK:
+        if _THREAD_POOL is None:
+            _THREAD_POOL = ThreadPoolExecutor(
+                max_workers=settings.thread_pool_workers,
+                thread_name_prefix="eda",
+            )
+        return _THREAD_POOL
+
+
+def _get_process_pool() -> ProcessPoolExecutor:
+    global _PROCESS_POOL
+
+    with _POOLS_LOCK:
+        if _PROCESS_POOL is None:
+            _PROCESS_POOL = ProcessPoolExecutor(
+                max_workers=settings.process_pool_workers,
+                mp_context=multiprocessing.get_context(
+                    settings.process_pool_start_method,
+                ),
+            )
+        return _PROCESS_POOL
+
+
+def cores_per_worker() -> int:
+    """Return the share of the cores of each server worker.
+
+    Returns:
+        int: The number of cores divided by the `WEB_CONCURRENCY` workers set by
+            `app/gunicorn.py`, at least 1, or every core outside of gunicorn.
+    """
+    workers = int(os.environ.get("WEB_CONCURRENCY", 1))
+    return max(1, (os.cpu_count() or 1) // max(1, workers))
+
+
+def shard_pool_size() -> int:
+    """Return the number of processes of the shard pool.
+
+    Each gunicorn worker has its own shard pool, so by default the cores are shared
+    between the workers rather than each pool having one process per core.
+
+    Returns:
+        int: `settings.shard_pool_workers`, or, if it is 0, `cores_per_worker()`.
+    """
+    return settings.shard_pool_workers or cores_per_worker()
+
+
+def get_shard_pool() -> ProcessPoolExecutor:
+    """Return the process pool running the shards of the dataset-scale computations.
+
+    Unlike the process pool of `run_in_process`, sized for a few concurrent requests, it
+    has up to one process per core, see `shard_pool_size`, and is meant to be driven from a thread, see
+    `app.dependancies.sharding`.
+
+    Returns:
+        ProcessPoolExecutor: The shard pool.
+    """
+    global _SHARD_POOL
+
+    with _POOLS_LOCK:
+        if _SHARD_POOL is None:
+            _SHARD_POOL = ProcessPoolExecutor(
+                max_workers=shard_pool_size(),
+                mp_context=multiprocessing.get_context(
+                    settings.process_pool_start_method,
+                ),
+            )
+        return _SHARD_POOL
+
+
+def _timed_call(
+    func: Callable,
+    submitted_at: float,
+    args: Tuple,
+    kwargs: Dict[str, Any],
+) -> Tuple[Any, float, float]:
+    """Run a function and measure its queue and execution times.
+
+    Defined at module level so that it can be sent to the process pool. `time.time` is
+    used as the submission time is taken in the parent process.
+    """
+    started_at = time.time()
+    result = func(*args, **kwargs)
+    return result, started_at - submitted_at, time.time() - started_at
+
+
+async def _run(
+    executor: Executor,
+    stats: ExecutorStats,
+    func: Callable,
+    args: Tuple,
+    kwargs: Dict[str, Any],
+) -> Any:
+    loop = asyncio.get_running_loop()
+    stats.record_submission()
+
+    try:
+        result, queue_time, execution_time = await loop.run_in_executor(
+            executor,
+            partial(_timed_call, func, time.time(), args, kwargs),
+        )
+    except Exception:
+        stats.record_completion(queue_time=0, execution_time=0)
+        raise
+
+    stats.record_completion(queue_time=queue_time, execution_time=execution_time)
+    logger.debug(
+        f"{func.__qualname__} ran in the {stats.name} pool : "
+        + f"queued {queue_time:.3f}s, executed {execution_time:.3f}s.",
+    )
+
+    return result
+
+
+async def run_in_thread(func: Callable, *args, **kwargs) -> Any:
+    """Run a blocking function in the thread pool, without blocking the event loop.
+
+    To be used for work releasing the GIL : image decoding, NumPy reductions, ONNX inference.
+
+    Args:
+        func (Callable): The function to run.
+        *args: The positional arguments of the function.
+        **kwargs: The keyword arguments of the function.
+
+    Returns:
+        Any: The result of the function.
+    """
+    return await _run(_get_thread_pool(), _THREAD_STATS, func, args, kwargs)
+
+
+async def run_in_process(func: Callable, *args, **kwargs) -> Any:
+    """Run a blocking function in the process pool, without blocking the event loop.
+
+    To be used for pure-Python work holding the GIL : plot rendering, tSNE/UMAP. The
+    function and its arguments must be picklable. If `settings.process_pool_workers` is 0,
+    the function is run in the thread pool instead.
+
+    Args:
+        func (Callable): The function to run.
+        *args: The positional arguments of the function.
+        **kwargs: The keyword arguments of the function.
+
+    Returns:
+        Any: The result of the function.
+    """
+    if settings.process_pool_workers == 0:
+        return await run_in_thread(func, *args, **kwargs)
+
+    return await _run(_get_process_pool(), _PROCESS_STATS, func, args, kwargs)
+
+
+def call_in_process(func: Callable, *args, **kwargs) -> Any:
+    """Run a blocking function in the process pool, from a thread and waiting for it.
+
+    The counterpart of `run_in_process` for the code running outside of the event loop,
+    e.g. the background jobs. If `settings.process_pool_workers` is 0, the function is
+    run in the calling thread instead.
+
+    Args:
+        func (Callable): The function to run.
+        *args: The positional arguments of the function.
+        **kwargs: The keyword arguments of the function.
+
+    Returns:
+        Any: The result of the function.
+    """
+    if settings.process_pool_workers == 0:
+        return func(*args, **kwargs)
+
+    _PROCESS_STATS.record_submission()
+    future = _get_process_pool().submit(_timed_call, func, time.time(), args, kwargs)
+
+    try:
+        result, queue_time, execution_time = future.result()
+    except Exception:
+        _PROCESS_STATS.record_completion(queue_time=0, execution_time=0)
+        raise
+
+    _PROCESS_STATS.record_completion(
+        queue_time=queue_time,
+        execution_time=execution_time,
+    )
+
+    return result
+
+
+def get_executors_stats() -> List[Dict[str, Any]]:
+    """Return the latencies of the tasks run by the thread and process pools.
+
+    Returns:
+        List[Dict[str, Any]]: One report per pool.
+    """
+    return [_THREAD_STATS.report(), _PROCESS_STATS.report()]
+
+
+def shutdown_executors() -> None:
+    """Shut the thread, process and shard pools down, waiting for the running tasks."""
+    global _THREAD_POOL, _PROCESS_POOL, _SHARD_POOL
+
+    with _POOLS_LOCK:
+        for executor in (_THREAD_POOL, _PROCESS_POOL, _SHARD_POOL):
+            if executor is not None:
+                executor.shutdown(wait=True)
+        _THREAD_POOL = None
+        _PROCESS_POOL = None
+        _SHARD_POOL = None
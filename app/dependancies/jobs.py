@@ -0,0 +1,559 @@
+import json
+import mimetypes
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import arrow
+from loguru import logger
+
+from app.config import settings
+from app.dependancies.clustering import format_timings
+from app.dependancies.decoding import DecodeStats
+from app.dependancies.deviation import (
+    cached_mean_image,
+    deviation_heatmaps,
+    plot_deviations,
+    rank_deviations,
+)
+from app.dependancies.eda_functions import (
+    accumulate_class_sums,
+    encode_mean_image,
+    plot_class_statistics,
+    plot_scatterplot,
+)
+from app.dependancies.eigenimages import compute_eigenimages, plot_eigenimages
+from app.dependancies.embedding_cache import compute_embeddings
+from app.dependancies.embedding_function import EmbeddingEngine, get_engine
+from app.dependancies.executors import call_in_process
+from app.dependancies.reducer_store import dataset_key, project_with_stored_reducer
+from app.dependancies.sharding import sharded_channels_stats, sharded_images_sum
+from app.dependancies.utils import file_lock, get_items_list
+from app.pydantic_models import (
+    ClusteringMode,
+    DeviationMetric,
+    EmbeddingsModel,
+    Extension,
+    JobKind,
+    JobStatus,
+    Providers,
+)
+
+
+class Job:
+    """A dataset-scale computation run in the background.
+
+    The state of the job is persisted in `settings.jobs_dir/<job_id>.json`, and its result
+    next to it, with the suffix of its media type, see `JOB_MEDIA_TYPES`, so that any
+    gunicorn worker can report them, and so that they survive a worker restart. The
+    worker process running the job is its owner, see `owner_id`.
+    """
+
+    def __init__(self, state: Dict[str, Any]) -> None:
+        self.state = state
+        self._last_write = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def job_id(self) -> str:
+        return self.state["job_id"]
+
+    @staticmethod
+    def path(job_id: str) -> Path:
+        return Path(settings.jobs_dir) / f"{job_id}.json"
+
+    @classmethod
+    def create(cls, kind: JobKind, params: Dict[str, Any]) -> "Job":
+        job = cls(
+            state={
+                "job_id": uuid.uuid4().hex,
+                "kind": kind.value,
+                "params": params,
+                "status": JobStatus.pending.value,
+                "done": 0,
+                "total": None,
+                "created_at": arrow.now().isoformat(),
+                "started_at": None,
+                "finished_at": None,
+                "result_path": None,
+                "media_type": None,
+                "headers": {},
+                "error": None,
+                "owner": owner_id(),
+            },
+        )
+        job.save()
+        return job
+
+    @classmethod
+    def load(cls, job_id: str) -> Optional["Job"]:
+        try:
+            with open(cls.path(job_id), "r") as state_file:
+                return cls(state=json.load(state_file))
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def save(self) -> None:
+        with self._lock:
+            tmp_path = self.path(self.job_id).with_suffix(f".{os.getpid()}.tmp")
+            with open(tmp_path, "w") as state_file:
+                json.dump(self.state, state_file)
+            os.replace(tmp_path, self.path(self.job_id))
+            self._last_write = time.monotonic()
+
+    def set_total(self, total: int) -> None:
+        self.state["total"] = total
+        self.save()
+
+    def advance(self, num_items: int) -> None:
+        """Report progress, the state is written at most every `settings.jobs_progress_interval` seconds.
+
+        Args:
+            num_items (int): The number of items processed since the last call.
+        """
+        self.state["done"] += num_items
+        if time.monotonic() - self._last_write > settings.jobs_progress_interval:
+            self.save()
+
+    def run(self) -> None:
+        self.state["status"] = JobStatus.running.value
+        self.state["started_at"] = arrow.now().isoformat()
+        self.save()
+
+        kind = JobKind(self.state["kind"])
+        try:
+            result, headers = JOB_FUNCTIONS[kind](params=self.state["params"], job=self)
+            media_type = JOB_MEDIA_TYPES[kind]
+            result_path = self.path(self.job_id).with_suffix(
+                mimetypes.guess_extension(media_type) or "",
+            )
+            result_path.write_bytes(result)
+        except Exception as err:
+            logger.exception(f"Job {self.job_id} failed.")
+            self.state["status"] = JobStatus.failed.value
+            self.state["error"] = repr(err)
+        else:
+            self.state["status"] = JobStatus.done.value
+            self.state["result_path"] = str(result_path)
+            self.state["media_type"] = media_type
+            self.state["headers"] = headers
+
+        self.state["finished_at"] = arrow.now().isoformat()
+        self.save()
+
+
+def _dataset_mean_image_job(params: Dict[str, Any], job: Job) -> Tuple[bytes, Dict]:
+    images_paths = get_items_list(
+        directory=settings.data_dir,
+        extension=Extension(params["extension"]).value,
+    )
+    job.set_total(len(images_paths))
+    decode_stats = DecodeStats()
+
+    images_sum, num_images = sharded_images_sum(
+        images_paths=images_paths,
+        progress=job.advance,
+        scale=params.get("scale", 1),
+        decode_stats=decode_stats,
+    )
+    mean_image = encode_mean_image(images_sum=images_sum, num_images=num_images)
+
+    return mean_image, decode_stats.report()
+
+
+def _mean_std_scatterplot_job(params: Dict[str, Any], job: Job) -> Tuple[bytes, Dict]:
+    images_paths = get_items_list(
+        directory=settings.data_dir,
+        extension=Extension(params["extension"]).value,
+    )
+    job.set_total(len(images_paths))
+    decode_stats = DecodeStats()
+
+    stats = sharded_channels_stats(
+        images_paths=images_paths,
+        progress=job.advance,
+        scale=params.get("scale", 1),
+        decode_stats=decode_stats,
+    )
+    scatterplot = plot_scatterplot(stats=stats, images_paths=images_paths)
+
+    return scatterplot, decode_stats.report()
+
+
+def _clustering_job(params: Dict[str, Any], job: Job) -> Tuple[bytes, Dict]:
+    mode = ClusteringMode(params["mode"])
+
+    images_paths = get_items_list(
+        directory=settings.data_dir,
+        extension=Extension(params["extension"]).value,
+    )
+    job.set_total(len(images_paths))
+
+    engine = get_engine(
+        model=EmbeddingsModel(params["model"]),
+        provider=Providers(params["provider"]),
+    )
+    decode_stats = DecodeStats()
+
+    logits, num_inferred, throughput = compute_embeddings(
+        engine=engine,
+        images_paths=images_paths,
+        batch_size=params["batch_size"] or engine.batch_size,
+        progress=job.advance,
+        decode_stats=decode_stats,
+    )
+
+    # like the `/clustering` route, the projection and the plot are run in the process
+    # pool, as they hold the GIL
+    if params.get("reuse_reducer") and mode == ClusteringMode.umap:
+        X_embedded, timings = call_in_process(
+            project_with_stored_reducer,
+            logits=logits,
+            images_paths=images_paths,
+            model=EmbeddingsModel(params["model"]),
+            dataset=dataset_key(Extension(params["extension"])),
+            sample_size=params.get("sample_size"),
+            pca_components=params.get("pca_components"),
+            seed=params.get("seed"),
+        )
+    else:
+        X_embedded, timings = call_in_process(
+            EmbeddingEngine.compute_clustering,
+            logits=logits,
+            mode=mode,
+            labels=[Path(image_path).parent.stem for image_path in images_paths],
+            sample_size=params.get("sample_size"),
+            pca_components=params.get("pca_components"),
+            seed=params.get("seed"),
+        )
+    clustering_plot = call_in_process(
+        EmbeddingEngine.plot,
+        logits=X_embedded,
+        images_paths=images_paths,
+        mode=mode,
+    )
+
+    return clustering_plot, {
+        "inferred": str(num_inferred),
+        "throughput": f"{throughput:.1f}",
+        **decode_stats.report(),
+        **format_timings(timings),
+    }
+
+
+def _eigenimages_job(params: Dict[str, Any], job: Job) -> Tuple[bytes, Dict]:
+    images_paths = get_items_list(
+        directory=settings.data_dir,
+        extension=Extension(params["extension"]).value,
+    )
+    job.set_total(len(images_paths))
+    decode_stats = DecodeStats()
+
+    eigenimages = compute_eigenimages(
+        images_paths=images_paths,
+        per_label=params["per_label"],
+        n_components=params["n_components"],
+        size=(params["size"], params["size"]),
+        batch_size=params["batch_size"],
+        progress=job.advance,
+        decode_stats=decode_stats,
+    )
+    plot = plot_eigenimages(eigenimages)
+
+    return plot, decode_stats.report()
+
+
+def _mean_image_deviations_job(params: Dict[str, Any], job: Job) -> Tuple[bytes, Dict]:
+    extension = Extension(params["extension"])
+    metric = DeviationMetric(params["metric"])
+    images_paths = get_items_list(
+        directory=settings.data_dir,
+        extension=extension.value,
+    )
+    job.set_total(len(images_paths))
+    decode_stats = DecodeStats()
+
+    mean_image = cached_mean_image(
+        extension=extension,
+        scale=params["scale"],
+        decode_stats=decode_stats,
+    )
+    scores, top = rank_deviations(
+        images_paths=images_paths,
+        mean_image=mean_image,
+        metric=metric,
+        top_k=params["top_k"],
+        scale=params["scale"],
+        progress=job.advance,
+        decode_stats=decode_stats,
+    )
+    top_paths = [images_paths[idx] for idx in top]
+    plot = plot_deviations(
+        images_paths=top_paths,
+        scores=scores[top],
+        heatmaps=deviation_heatmaps(
+            top_paths,
+            mean_image=mean_image,
+            scale=params["scale"],
+        ),
+        metric=metric,
+    )
+
+    return plot, decode_stats.report()
+
+
+def _class_statistics_job(params: Dict[str, Any], job: Job) -> Tuple[bytes, Dict]:
+    images_paths = get_items_list(
+        directory=settings.data_dir,
+        extension=Extension(params["extension"]).value,
+    )
+    job.set_total(len(images_paths))
+    decode_stats = DecodeStats()
+
+    accumulators = accumulate_class_sums(
+        images_paths=images_paths,
+        progress=job.advance,
+        scale=params["scale"],
+        decode_stats=decode_stats,
+    )
+    plot = plot_class_statistics(accumulators)
+
+    return plot, decode_stats.report()
+
+
+JOB_FUNCTIONS: Dict[JobKind, Callable[..., Tuple[bytes, Dict]]] = {
+    JobKind.dataset_mean_image: _dataset_mean_image_job,
+    JobKind.mean_std_scatterplot: _mean_std_scatterplot_job,
+    JobKind.clustering: _clustering_job,
+    JobKind.eigenimages: _eigenimages_job,
+    JobKind.mean_image_deviations: _mean_image_deviations_job,
+    JobKind.class_statistics: _class_statistics_job,
+}
+
+# the media type of the result of each kind of job
+JOB_MEDIA_TYPES: Dict[JobKind, str] = {kind: "image/png" for kind in JOB_FUNCTIONS}
+
+_JOBS_POOL: Optional[ThreadPoolExecutor] = None
+_JOBS_POOL_LOCK = threading.Lock()
+
+
+def _get_jobs_pool() -> ThreadPoolExecutor:
+    global _JOBS_POOL
+
+    with _JOBS_POOL_LOCK:
+        if _JOBS_POOL is None:
+            _JOBS_POOL = ThreadPoolExecutor(
+                max_workers=settings.jobs_workers,
+                thread_name_prefix="job",
+            )
+        return _JOBS_POOL
+
+
+def submit_job(kind: JobKind, params: Dict[str, Any]) -> Dict[str, Any]:
+    """Create a job and queue it in the local worker pool.
+
+    Args:
+        kind (JobKind): The kind of computation.
+        params (Dict[str, Any]): The JSON-serializable parameters of the computation.
+
+    Returns:
+        Dict[str, Any]: The state of the created job.
+    """
+    job = Job.create(kind=kind, params=params)
+    _get_jobs_pool().submit(job.run)
+    logger.info(f"Job {job.job_id} ({kind.value}) submitted.")
+
+    return job.state
+
+
+def get_job(job_id: str) -> Optional[Dict[str, Any]]:
+    """Return the state of a job, whichever worker runs it.
+
+    Args:
+        job_id (str): The id of the job.
+
+    Returns:
+        Optional[Dict[str, Any]]: The state of the job, None if it does not exist.
+    """
+    job = Job.load(job_id)
+    return None if job is None else job.state
+
+
+_OWNER: Optional[Tuple[int, str]] = None
+_OWNER_LOCK = threading.Lock()
+
+
+def owner_id() -> str:
+    """Return the id of the current process as the owner of jobs.
+
+    Unlike its pid, which the workers started after a restart of the host or container
+    usually get again, the id is never reused. It is created again in a forked process.
+
+    Returns:
+        str: The owner id.
+    """
+    global _OWNER
+
+    with _OWNER_LOCK:
+        if _OWNER is None or _OWNER[0] != os.getpid():
+            _OWNER = (os.getpid(), uuid.uuid4().hex)
+        return _OWNER[1]
+
+
+def _heartbeat_path(owner: str) -> Path:
+    return Path(settings.jobs_dir) / "heartbeats" / owner
+
+
+def beat() -> None:
+    """Renew the lease of the current process on its jobs."""
+    path = _heartbeat_path(owner_id())
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.touch()
+
+
+def _owner_is_alive(owner: Optional[str]) -> bool:
+    if owner is None:
+        return False
+    if owner == owner_id():
+        return True
+    try:
+        age = time.time() - _heartbeat_path(owner).stat().st_mtime
+    except FileNotFoundError:
+        return False
+    return age < settings.jobs_lease_timeout
+
+
+def recover_jobs() -> List[str]:
+    """Requeue the pending or running jobs whose worker process died.
+
+    The owner of a job is dead when it did not renew its lease, see `beat`, for
+    `settings.jobs_lease_timeout` seconds.
+
+    Returns:
+        List[str]: The ids of the requeued jobs.
+    """
+    jobs_dir = Path(settings.jobs_dir)
+    recovered = []
+
+    with file_lock(jobs_dir / ".lock"):
+        for state_path in jobs_dir.glob("*.json"):
+            job = Job.load(state_path.stem)
+            if job is None or job.state["status"] not in (
+                JobStatus.pending.value,
+                JobStatus.running.value,
+            ):
+                continue
+            if _owner_is_alive(job.state.get("owner")):
+                continue
+
+            job.state.update(status=JobStatus.pending.value, done=0)
+            job.state["owner"] = owner_id()
+            job.save()
+            _get_jobs_pool().submit(job.run)
+            recovered.append(job.job_id)
+
+    if recovered:
+        logger.info(f"Requeued {len(recovered)} interrupted jobs.")
+
+    return recovered
+
+
+def cleanup_jobs() -> List[str]:
+    """Delete the finished jobs older than `settings.jobs_ttl` seconds, and their result.
+
+    The heartbeats of the owners dead for as long are deleted too.
+
+    Returns:
+        List[str]: The ids of the deleted jobs.
+    """
+    jobs_dir = Path(settings.jobs_dir)
+    now = arrow.now()
+    deleted = []
+
+    with file_lock(jobs_dir / ".lock"):
+        for state_path in jobs_dir.glob("*.json"):
+            job = Job.load(state_path.stem)
+            if job is None or job.state["status"] not in (
+                JobStatus.done.value,
+                JobStatus.failed.value,
+            ):
+                continue
+            age = now - arrow.get(job.state["finished_at"])
+            if age.total_seconds() < settings.jobs_ttl:
+                continue
+
+            if job.state.get("result_path"):
+                Path(job.state["result_path"]).unlink(missing_ok=True)
+            state_path.unlink(missing_ok=True)
+            deleted.append(job.job_id)
+
+        for heartbeat in jobs_dir.glob("heartbeats/*"):
+            if time.time() - heartbeat.stat().st_mtime > settings.jobs_ttl:
+                heartbeat.unlink(missing_ok=True)
+
+    if deleted:
+        logger.info(f"Deleted {len(deleted)} expired jobs.")
+
+    return deleted
+
+
+_MONITOR: Optional[threading.Thread] = None
+_MONITOR_STOP = threading.Event()
+_MONITOR_LOCK = threading.Lock()
+
+
+def _monitor_jobs() -> None:
+    while True:
+        try:
+            beat()
+            recover_jobs()
+            cleanup_jobs()
+        except Exception:
+            logger.exception("Could not monitor the jobs.")
+        if _MONITOR_STOP.wait(settings.jobs_heartbeat_interval):
+            return
+
+
+def start_jobs_monitor() -> None:
+    """Run the heartbeat, the recovery and the cleanup of the jobs in a thread.
+
+    Every `settings.jobs_heartbeat_interval` seconds, the worker renews its lease on its
+    jobs, requeues the jobs of the dead workers and deletes the expired jobs. The jobs
+    interrupted by a restart are requeued once the lease of their owner has expired.
+    """
+    global _MONITOR
+
+    with _MONITOR_LOCK:
+        if _MONITOR is None or not _MONITOR.is_alive():
+            _MONITOR_STOP.clear()
+            _MONITOR = threading.Thread(
+                target=_monitor_jobs,
+                name="jobs-monitor",
+                daemon=True,
+            )
+            _MONITOR.start()
+
+
+def shutdown_jobs() -> None:
+    """Stop the local worker pool, the running jobs are requeued by the next worker.
+
+    The lease of the worker is given up, so the other workers requeue its jobs at once.
+    """
+    global _JOBS_POOL, _MONITOR
+
+    # the monitor takes the lock of the pool to requeue jobs
+    _MONITOR_STOP.set()
+    if _MONITOR is not None:
+        _MONITOR.join()
+    _MONITOR = None
+
+    with _JOBS_POOL_LOCK:
+        if _JOBS_POOL is not None:
+            _JOBS_POOL.shutdown(wait=False)
+        _JOBS_POOL = None
+
+    _heartbeat_path(owner_id()).unlink(missing_ok=True)
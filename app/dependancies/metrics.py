@@ -0,0 +1,377 @@
+import bisect
+import contextlib
+import json
+import multiprocessing
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, ContextManager, Dict, List, Optional, Tuple
+
+from loguru import logger
+
+from app.config import settings
+
+# Prefix of the names of the exported metrics.
+NAMESPACE = "eda"
+
+# Type and description of each metric, in the Prometheus text format.
+METRICS = {
+    "request_duration_seconds": (
+        "histogram",
+        "Latency of the HTTP requests, by method, route and status.",
+    ),
+    "stage_duration_seconds": (
+        "histogram",
+        "Latency of the stages of the requests, such as decoding or session.run.",
+    ),
+    "images_total": (
+        "counter",
+        "Images processed by each stage, rate() of it gives the images/s.",
+    ),
+    "decode_seconds_total": (
+        "counter",
+        "Time spent decoding the images of each stage, summed over its threads.",
+    ),
+}
+
+# Stem of the file the metrics of the exited workers are merged into.
+EXITED_WORKERS = "exited"
+
+MetricKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+def _key(name: str, labels: Dict[str, Any]) -> MetricKey:
+    return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+
+def _serialize(
+    buckets: List[float],
+    counters: Dict[MetricKey, float],
+    histograms: Dict[MetricKey, Tuple[List[int], float]],
+) -> Dict[str, Any]:
+    return {
+        "buckets": buckets,
+        "counters": [
+            [name, dict(labels), value] for (name, labels), value in counters.items()
+        ],
+        "histograms": [
+            [name, dict(labels), list(counts), total]
+            for (name, labels), (counts, total) in histograms.items()
+        ],
+    }
+
+
+class MetricsRegistry:
+    """Counters and latency histograms of the current process.
+
+    Each gunicorn worker records its own metrics, and writes them to
+    `settings.metrics_dir/<pid>.json` at most every `settings.metrics_flush_interval`
+    seconds, so that `/metrics` can add up the metrics of every worker whichever one
+    serves it. When a worker exits, its file is merged into the file of the exited
+    workers, see `merge_worker_metrics`, for the counters not to go backwards. A new
+    process reusing the pid of a worker not merged yet starts from its file.
+
+    The processes of the process and shard pools of a worker write to
+    `settings.metrics_dir/<worker pid>-<pid>.json`, and are merged with it.
+    """
+
+    def __init__(self, directory: Optional[Path] = None) -> None:
+        self.directory = Path(directory or settings.metrics_dir)
+        self.pid = os.getpid()
+        parent = multiprocessing.parent_process()
+        stem = str(self.pid) if parent is None else f"{parent.pid}-{self.pid}"
+        self.path = self.directory / f"{stem}.json"
+        self.buckets = [float(bound) for bound in settings.metrics_buckets]
+        self.counters: Dict[MetricKey, float] = {}
+        # count of each bucket, the last one for the values above every bound, and sum
+        self.histograms: Dict[MetricKey, Tuple[List[int], float]] = {}
+        self._last_flush = 0.0
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self) -> None:
+        try:
+            state = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            return
+        for name, labels, value in state.get("counters", []):
+            self.counters[_key(name, labels)] = value
+        if state.get("buckets") == self.buckets:
+            for name, labels, counts, total in state.get("histograms", []):
+                self.histograms[_key(name, labels)] = (counts, total)
+
+    def increment(self, name: str, value: float = 1.0, **labels: Any) -> None:
+        key = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0.0) + value
+        self.maybe_flush()
+
+    def observe(self, name: str, value: float, **labels: Any) -> None:
+        key = _key(name, labels)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self.histograms.get(
+                key,
+                ([0] * (len(self.buckets) + 1), 0.0),
+            )
+            counts[idx] += 1
+            self.histograms[key] = (counts, total + value)
+        self.maybe_flush()
+
+    def state(self) -> Dict[str, Any]:
+        with self._lock:
+            return _serialize(self.buckets, self.counters, self.histograms)
+
+    def flush(self) -> None:
+        """Write the metrics of the process, atomically, to its file."""
+        self._last_flush = time.monotonic()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        temp_path = self.path.with_suffix(f".{threading.get_ident()}.tmp")
+        try:
+            temp_path.write_text(json.dumps(self.state()))
+            os.replace(temp_path, self.path)
+        except OSError as error:
+            logger.warning(f"Could not write the metrics to {self.path}: {error}")
+
+    def maybe_flush(self) -> None:
+        if time.monotonic() - self._last_flush >= settings.metrics_flush_interval:
+            self.flush()
+
+
+_REGISTRY: Optional[MetricsRegistry] = None
+_REGISTRY_LOCK = threading.Lock()
+
+
+def get_registry() -> MetricsRegistry:
+    """Get the metrics registry of the current process, created at its first use."""
+    global _REGISTRY
+
+    with _REGISTRY_LOCK:
+        # a forked process must not write to the file of its parent
+        if _REGISTRY is None or _REGISTRY.pid != os.getpid():
+            _REGISTRY = MetricsRegistry()
+        return _REGISTRY
+
+
+class span(contextlib.ContextDecorator):
+    """Time a stage of a request, as a context manager or as a decorator.
+
+    The duration is recorded in the `stage_duration_seconds` histogram of the stage, and
+    the images processed, given when entering the span or set on it once known, are
+    added to its `images_total` counter.
+
+    Examples:
+        >>> with span("decode") as current:
+        ...     images = [open_image(path) for path in paths]
+        ...     current.images = len(images)
+
+        >>> @span("plot")
+        ... def plot_scatterplot(...):
+    """
+
+    def __init__(self, stage: str, images: int = 0) -> None:
+        self.stage = stage
+        self.images = images
+        self.duration = 0.0
+        self._start = 0.0
+
+    def _recreate_cm(self) -> "span":
+        # a decorated function may run in several threads at once
+        return span(self.stage, self.images)
+
+    def __enter__(self) -> "span":
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.duration = time.perf_counter() - self._start
+        observe_stage(self.stage, self.duration, images=self.images)
+
+
+def observe_stage(stage: str, duration: float, images: int = 0) -> None:
+    """Record a stage timed elsewhere, e.g. in a process of the process pool."""
+    registry = get_registry()
+    registry.observe("stage_duration_seconds", duration, stage=stage)
+    if images:
+        registry.increment("images_total", images, stage=stage)
+
+
+def observe_request(method: str, route: str, status: int, duration: float) -> None:
+    get_registry().observe(
+        "request_duration_seconds",
+        duration,
+        method=method,
+        route=route,
+        status=status,
+    )
+
+
+def aggregate_metrics(directory: Optional[Path] = None) -> Dict[str, Any]:
+    """Add up the metrics written by every worker.
+
+    The histograms written with other buckets than `settings.metrics_buckets`, by a
+    server run with other settings, are left out.
+
+    Args:
+        directory (Optional[Path], optional): The directory of the files of the workers.
+            Defaults to `settings.metrics_dir`.
+
+    Returns:
+        Dict[str, Any]: The buckets, and the summed counters and histograms, keyed by
+            their name and labels.
+    """
+    buckets = [float(bound) for bound in settings.metrics_buckets]
+    metrics: Dict[str, Any] = {"buckets": buckets, "counters": {}, "histograms": {}}
+
+    directory = Path(directory or settings.metrics_dir)
+    directory.mkdir(parents=True, exist_ok=True)
+    # a worker merged meanwhile would be counted twice, or not at all
+    with _metrics_lock(directory, shared=True):
+        for path in sorted(directory.glob("*.json")):
+            try:
+                _add_state(metrics, json.loads(path.read_text()))
+            except (OSError, ValueError):
+                continue
+
+    return metrics
+
+
+def _add_state(metrics: Dict[str, Any], state: Dict[str, Any]) -> None:
+    counters = metrics["counters"]
+    for name, labels, value in state.get("counters", []):
+        key = _key(name, labels)
+        counters[key] = counters.get(key, 0.0) + value
+
+    if state.get("buckets") != metrics["buckets"]:
+        return
+    histograms = metrics["histograms"]
+    for name, labels, counts, total in state.get("histograms", []):
+        key = _key(name, labels)
+        summed_counts, summed_total = histograms.get(key, ([0] * len(counts), 0.0))
+        histograms[key] = (
+            [left + right for left, right in zip(summed_counts, counts)],
+            summed_total + total,
+        )
+
+
+def _metrics_lock(directory: Path, shared: bool = False) -> ContextManager[None]:
+    # `app.dependancies.utils` times its stages with the metrics
+    from app.dependancies.utils import file_lock
+
+    return file_lock(directory / ".lock", shared=shared)
+
+
+def merge_worker_metrics(pid: int, directory: Optional[Path] = None) -> None:
+    """Merge the metrics of an exited worker into the file of the exited workers.
+
+    Called by the gunicorn master when a worker exits, so that the files of the workers
+    do not pile up as they are restarted, while the counters keep their totals. The
+    files of the processes of its pools are merged too.
+
+    Args:
+        pid (int): The pid of the exited worker.
+        directory (Optional[Path], optional): The directory of the files of the workers.
+            Defaults to `settings.metrics_dir`.
+    """
+    directory = Path(directory or settings.metrics_dir)
+    paths = [directory / f"{pid}.json", *directory.glob(f"{pid}-*.json")]
+    paths = [path for path in paths if path.exists()]
+    if not paths:
+        return
+
+    merged_path = directory / f"{EXITED_WORKERS}.json"
+    buckets = [float(bound) for bound in settings.metrics_buckets]
+    merged: Dict[str, Any] = {"buckets": buckets, "counters": {}, "histograms": {}}
+
+    with _metrics_lock(directory):
+        for state_path in (merged_path, *paths):
+            try:
+                _add_state(merged, json.loads(state_path.read_text()))
+            except (OSError, ValueError):
+                continue
+
+        temp_path = merged_path.with_suffix(".tmp")
+        temp_path.write_text(json.dumps(_serialize(**merged)))
+        os.replace(temp_path, merged_path)
+        for path in paths:
+            path.unlink(missing_ok=True)
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (label, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for label, value in labels
+    )
+    return "{" + ",".join(f'{label}="{value}"' for label, value in escaped) + "}"
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+def render_prometheus(metrics: Dict[str, Any]) -> str:
+    """Render aggregated metrics in the Prometheus text exposition format (0.0.4).
+
+    Args:
+        metrics (Dict[str, Any]): The metrics, as returned by `aggregate_metrics`.
+
+    Returns:
+        str: The metrics, one sample per line.
+    """
+    bounds = [_format_value(bound) for bound in metrics["buckets"]] + ["+Inf"]
+    lines = []
+    for name, (kind, description) in METRICS.items():
+        full_name = f"{NAMESPACE}_{name}"
+        lines.append(f"# HELP {full_name} {description}")
+        lines.append(f"# TYPE {full_name} {kind}")
+        if kind == "counter":
+            for (key_name, labels), value in sorted(metrics["counters"].items()):
+                if key_name == name:
+                    lines.append(
+                        f"{full_name}{_format_labels(labels)} {_format_value(value)}",
+                    )
+            continue
+        histograms = sorted(metrics["histograms"].items())
+        for (key_name, labels), (counts, total) in histograms:
+            if key_name != name:
+                continue
+            cumulated = 0
+            for bound, count in zip(bounds, counts):
+                cumulated += count
+                bucket_labels = _format_labels(labels + (("le", bound),))
+                lines.append(f"{full_name}_bucket{bucket_labels} {cumulated}")
+            labels_text = _format_labels(labels)
+            lines.append(f"{full_name}_sum{labels_text} {_format_value(total)}")
+            lines.append(f"{full_name}_count{labels_text} {cumulated}")
+
+    return "\n".join(lines) + "\n"
+
+
+def _is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def clear_metrics(directory: Optional[Path] = None, keep_running: bool = False) -> None:
+    """Remove the metrics files left by a previous run of the server.
+
+    Args:
+        directory (Optional[Path], optional): The directory of the files of the workers.
+            Defaults to `settings.metrics_dir`.
+        keep_running (bool, optional): Keep the files of the workers still running, and
+            of their pools, e.g. when the other workers of the server already started.
+            Defaults to False.
+    """
+    for path in Path(directory or settings.metrics_dir).glob("*.json"):
+        worker = path.stem.split("-")[0]
+        if keep_running and worker.isdigit() and _is_running(int(worker)):
+            continue
+        path.unlink(missing_ok=True)
@@ -0,0 +1,180 @@
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import joblib
+import numpy as np
+from loguru import logger
+from pynndescent import NNDescent
+
+from app.config import settings
+from app.dependancies.embedding_cache import EmbeddingStore
+from app.dependancies.utils import file_lock
+from app.pydantic_models import EmbeddingsModel
+
+# The indexes loaded by the worker, by path, refreshed when their store changes.
+_INDEXES: Dict[str, Dict] = {}
+_INDEXES_LOCK = threading.Lock()
+
+
+class NeighboursIndex:
+    """Approximate nearest-neighbour index over the embeddings stored for a model.
+
+    The index is a pynndescent graph, by cosine distance, over the rows of the
+    `EmbeddingStore` of the model : the point i of the index is the row i of the store.
+    It is persisted with joblib, and kept in memory by each worker once loaded. When the
+    store changes, the new rows are added to the graph, and the rows of the changed images
+    are replaced, with `NNDescent.update`, instead of building the graph again. The graph
+    is only built again when deleted images are pruned from the store.
+    """
+
+    def __init__(
+        self,
+        model: EmbeddingsModel,
+        directory: Optional[str] = None,
+        store: Optional[EmbeddingStore] = None,
+    ) -> None:
+        """Open the index of a model.
+
+        Args:
+            model (EmbeddingsModel): The model which computed the embeddings.
+            directory (Optional[str], optional): The root directory of the indexes.
+                Defaults to `settings.neighbours_index_dir`.
+            store (Optional[EmbeddingStore], optional): The store of the embeddings.
+                Defaults to the store of the model.
+        """
+        self.model = model
+        self.store = store or EmbeddingStore(model=model)
+
+        self.directory = Path(directory or settings.neighbours_index_dir) / model.value
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.path = self.directory / "index.joblib"
+        self.lock_path = self.directory / ".lock"
+
+    def _load(self) -> Optional[Dict]:
+        if not self.path.exists():
+            return None
+        return joblib.load(self.path)
+
+    def _save(self, state: Dict) -> None:
+        tmp_path = self.path.with_suffix(".tmp")
+        joblib.dump(state, tmp_path)
+        os.replace(tmp_path, self.path)
+
+    def _sync(self, state: Optional[Dict], version: Tuple[int, int]) -> Dict:
+        entries = self.store.entries()
+        count = len(entries)
+        if count < 2:
+            raise ValueError("At least 2 embeddings are needed to build the index.")
+
+        paths: List[str] = [""] * count
+        signatures = np.empty((count, 2), dtype=np.int64)
+        for path, entry in entries.items():
+            paths[entry["row"]] = path
+            signatures[entry["row"]] = (entry["size"], entry["mtime_ns"])
+
+        # the store renumbers its rows when deleted images are pruned from it
+        if state is not None and paths[: len(state["paths"])] != state["paths"]:
+            state = None
+
+        start = time.perf_counter()
+        if state is None:
+            index = NNDescent(
+                self.store.rows(list(range(count))),
+                metric="cosine",
+                n_neighbors=min(settings.neighbours_index_degree, count - 1),
+                random_state=0,
+            )
+            logger.info(
+                f"Neighbours index of {self.model.value} built on {count} embeddings in "
+                + f"{time.perf_counter() - start:.2f}s.",
+            )
+        else:
+            index = state["index"]
+            indexed = len(state["paths"])
+            changed = (signatures[:indexed] != state["signatures"]).any(axis=1)
+            updated = np.flatnonzero(changed).tolist()
+            fresh = list(range(indexed, count))
+
+            index.update(
+                xs_fresh=self.store.rows(fresh) if fresh else None,
+                xs_updated=self.store.rows(updated) if updated else None,
+                updated_indices=updated or None,
+            )
+            logger.info(
+                f"Neighbours index of {self.model.value} updated with {len(fresh)} new "
+                + f"and {len(updated)} changed embeddings in "
+                + f"{time.perf_counter() - start:.2f}s.",
+            )
+        index.prepare()
+
+        return {
+            "index": index,
+            "version": version,
+            "paths": paths,
+            "signatures": signatures,
+        }
+
+    def refresh(self) -> Dict:
+        """Bring the index up to date with the store of the model.
+
+        The index loaded by the worker is returned as is when the store did not change
+        since it was indexed, which only costs a `stat`. Otherwise, the persisted index is
+        loaded, as another worker may have updated it already, updated if needed, saved,
+        and swapped with the loaded one, so the running queries are not disturbed.
+
+        Raises:
+            ValueError: If the store holds less than 2 embeddings.
+
+        Returns:
+            Dict: The state of the index : the `NNDescent` graph, under "index", the
+                version of the store it was built from, and the path and signature of the
+                image of each point.
+        """
+        version = self.store.version()
+
+        loaded = _INDEXES.get(str(self.path))
+        if loaded is not None and loaded["version"] == version:
+            return loaded
+
+        with _INDEXES_LOCK, file_lock(self.lock_path):
+            state = self._load()
+            if state is None or state["version"] != version:
+                state = self._sync(state, version=version)
+                self._save(state)
+            _INDEXES[str(self.path)] = state
+
+        return state
+
+    def query(
+        self,
+        embeddings: np.ndarray,
+        k: int = 10,
+        state: Optional[Dict] = None,
+    ) -> List[List[Tuple[str, float]]]:
+        """Find the approximate nearest neighbours of embeddings among the stored ones.
+
+        Args:
+            embeddings (np.ndarray): The query embeddings, of shape (N, D).
+            k (int, optional): The number of neighbours. Defaults to 10.
+            state (Optional[Dict], optional): The state of the index to query, as returned
+                by `refresh`. Defaults to the state refreshed first.
+
+        Returns:
+            List[List[Tuple[str, float]]]: For each query, the path of the image of each
+                neighbour and its cosine distance, from the nearest.
+        """
+        state = state or self.refresh()
+        paths = state["paths"]
+
+        indices, distances = state["index"].query(
+            embeddings.astype(np.float32),
+            k=min(k, len(paths)),
+        )
+
+        return [
+            [(paths[idx], float(distance)) for idx, distance in zip(row, row_distances)]
+            for row, row_distances in zip(indices, distances)
+        ]
@@ -0,0 +1,240 @@
+"""Offline INT8 quantization of the embedding models, and its accuracy check.
+
+Quantize the FP32 ResNet50v2 on a calibration subset of the dataset, then compare the
+neighbours of the INT8 and FP32 embeddings:
+
+    python -m app.dependancies.quantization quantize --extension .jpg
+    python -m app.dependancies.quantization check --extension .jpg
+"""
+import argparse
+import json
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+from loguru import logger
+from onnxruntime.quantization import (
+    CalibrationDataReader,
+    QuantFormat,
+    QuantType,
+    quantize_static,
+)
+from sklearn.neighbors import NearestNeighbors
+
+try:
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+except ImportError:  # onnxruntime < 1.13
+    quant_pre_process = None
+
+from app.config import settings
+from app.dependancies.clustering import stratified_sample
+from app.dependancies.embedding_function import INPUT_SIZE, EmbeddingEngine, get_engine
+from app.dependancies.utils import generate_batch, get_items_list
+from app.pydantic_models import EmbeddingsModel, Providers
+
+# The FP32 model each quantized model is produced from.
+QUANTIZED_MODELS = {EmbeddingsModel.resnet50v2_int8: EmbeddingsModel.resnet50v2}
+
+
+class ImagesCalibrationReader(CalibrationDataReader):
+    """Feed batches of preprocessed images to the ONNX Runtime calibration."""
+
+    def __init__(self, images_paths: List[Path], batch_size: int = 8) -> None:
+        """Prepare the calibration batches.
+
+        Args:
+            images_paths (List[Path]): The paths of the calibration images.
+            batch_size (int, optional): The number of images per batch. Defaults to 8.
+        """
+        self.batches = iter(generate_batch(lst=images_paths, batch_size=batch_size))
+
+    def get_next(self) -> Optional[Dict[str, np.ndarray]]:
+        batch = next(self.batches, None)
+        if batch is None:
+            return None
+
+        images = np.empty((len(batch), *INPUT_SIZE, 3), dtype=np.float32)
+        for idx, image_path in enumerate(batch):
+            EmbeddingEngine.load_image(image_path, out=images[idx])
+
+        return {"input": images}
+
+
+def calibration_subset(
+    images_paths: List[Path],
+    size: int,
+    seed: int = 0,
+) -> List[Path]:
+    """Draw the calibration images, keeping the proportion of each label of the dataset.
+
+    Args:
+        images_paths (List[Path]): The paths of the images of the dataset.
+        size (int): The number of calibration images.
+        seed (int, optional): The seed of the draw. Defaults to 0.
+
+    Returns:
+        List[Path]: The paths of the calibration images.
+    """
+    labels = [Path(image_path).parent.stem for image_path in images_paths]
+    return [images_paths[idx] for idx in stratified_sample(labels, size, seed=seed)]
+
+
+def quantize_model(
+    model: EmbeddingsModel,
+    images_paths: List[Path],
+    calibration_size: int = 200,
+    seed: int = 0,
+) -> Path:
+    """Quantize the FP32 model of a quantized variant, with static INT8 quantization.
+
+    The activations ranges are calibrated on a subset of the dataset. The weights are
+    quantized per channel, and the model is saved in the QDQ format, run with the INT8
+    kernels of the CPU execution provider. When available (onnxruntime >= 1.13), the
+    model is first pre-processed, with shape inference and graph optimizations.
+
+    Args:
+        model (EmbeddingsModel): The quantized variant, e.g. `resnet50v2_int8`.
+        images_paths (List[Path]): The paths of the images of the dataset.
+        calibration_size (int, optional): The number of calibration images. Defaults to 200.
+        seed (int, optional): The seed of the calibration subset. Defaults to 0.
+
+    Returns:
+        Path: The path of the quantized model, `settings[model.value]`.
+    """
+    source = settings[QUANTIZED_MODELS[model].value]
+    output = Path(settings[model.value])
+    output.parent.mkdir(parents=True, exist_ok=True)
+
+    calibration = calibration_subset(images_paths, size=calibration_size, seed=seed)
+    logger.info(f"Quantizing {source} on {len(calibration)} calibration images.")
+
+    preprocessed = None
+    if quant_pre_process is not None:
+        preprocessed = output.with_suffix(".preprocessed.onnx")
+        quant_pre_process(source, str(preprocessed), skip_symbolic_shape=True)
+        source = str(preprocessed)
+
+    try:
+        quantize_static(
+            model_input=source,
+            model_output=str(output),
+            calibration_data_reader=ImagesCalibrationReader(calibration),
+            quant_format=QuantFormat.QDQ,
+            activation_type=QuantType.QUInt8,
+            weight_type=QuantType.QInt8,
+            per_channel=True,
+        )
+    finally:
+        if preprocessed is not None:
+            preprocessed.unlink(missing_ok=True)
+    logger.info(f"Quantized model saved to {output}.")
+
+    return output
+
+
+def neighbour_overlap(
+    reference: np.ndarray,
+    candidate: np.ndarray,
+    k: int = 10,
+) -> np.ndarray:
+    """Measure how well a set of embeddings keeps the neighbours of a reference set.
+
+    Args:
+        reference (np.ndarray): The reference embeddings, of shape (N, D).
+        candidate (np.ndarray): The embeddings of the same points, of shape (N, D').
+        k (int, optional): The number of neighbours compared. Defaults to 10.
+
+    Returns:
+        np.ndarray: For each point, the share of its k nearest reference neighbours, by
+            cosine distance, which are also among its k nearest candidate neighbours.
+    """
+    k = min(k, len(reference) - 1)
+
+    def neighbours(embeddings: np.ndarray) -> np.ndarray:
+        indices = (
+            NearestNeighbors(n_neighbors=k + 1, metric="cosine")
+            .fit(embeddings)
+            .kneighbors(embeddings, return_distance=False)
+        )
+        # drop each point from its own neighbours
+        return np.array([row[row != idx][:k] for idx, row in enumerate(indices)])
+
+    reference_neighbours = neighbours(reference)
+    candidate_neighbours = neighbours(candidate)
+
+    return np.array(
+        [
+            len(np.intersect1d(ref, cand)) / k
+            for ref, cand in zip(reference_neighbours, candidate_neighbours)
+        ],
+    )
+
+
+def check_quantized_model(
+    model: EmbeddingsModel,
+    images_paths: List[Path],
+    k: int = 10,
+    batch_size: int = 32,
+) -> Dict[str, float]:
+    """Compare the embeddings of a quantized model with the ones of its FP32 model.
+
+    Args:
+        model (EmbeddingsModel): The quantized variant, e.g. `resnet50v2_int8`.
+        images_paths (List[Path]): The paths of the images compared.
+        k (int, optional): The number of neighbours compared. Defaults to 10.
+        batch_size (int, optional): The inference batch size. Defaults to 32.
+
+    Returns:
+        Dict[str, float]: The mean and 5th percentile of the neighbour overlap, and the
+            inference throughput, in images/s, of both models.
+    """
+    embeddings = {}
+    throughputs = {}
+    for variant in (QUANTIZED_MODELS[model], model):
+        engine = get_engine(model=variant, provider=Providers.cpu, warmup=True)
+        embeddings[variant], throughputs[variant] = engine.embed(
+            images_paths=images_paths,
+            batch_size=batch_size,
+        )
+
+    overlap = neighbour_overlap(
+        reference=embeddings[QUANTIZED_MODELS[model]],
+        candidate=embeddings[model],
+        k=k,
+    )
+
+    return {
+        "images": len(images_paths),
+        "k": k,
+        "mean_overlap": float(overlap.mean()),
+        "p05_overlap": float(np.percentile(overlap, 5)),
+        "fp32_throughput": throughputs[QUANTIZED_MODELS[model]],
+        "int8_throughput": throughputs[model],
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("command", choices=["quantize", "check"])
+    parser.add_argument("--model", default=EmbeddingsModel.resnet50v2_int8.value)
+    parser.add_argument("--extension", default=".jpg")
+    parser.add_argument("--calibration-size", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--neighbours", type=int, default=10)
+    args = parser.parse_args()
+
+    paths = get_items_list(directory=settings.data_dir, extension=args.extension)
+    if args.command == "quantize":
+        quantize_model(
+            model=EmbeddingsModel(args.model),
+            images_paths=paths,
+            calibration_size=args.calibration_size,
+            seed=args.seed,
+        )
+    else:
+        report = check_quantized_model(
+            model=EmbeddingsModel(args.model),
+            images_paths=paths,
+            k=args.neighbours,
+        )
+        print(json.dumps(report, indent=2))
@@ -0,0 +1,208 @@
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import joblib
+import numpy as np
+from loguru import logger
+
+from app.config import settings
+from app.dependancies.clustering import FittedProjection, fit_projection
+from app.dependancies.embedding_cache import file_signature
+from app.dependancies.utils import file_lock
+from app.pydantic_models import ClusteringMode, EmbeddingsModel, Extension
+
+
+def dataset_key(extension: Extension) -> str:
+    """Return the identifier of the images of a given extension in `settings.data_dir`.
+
+    Args:
+        extension (Extension): The extension of the images.
+
+    Returns:
+        str: The identifier.
+    """
+    return f"{Path(settings.data_dir).resolve()}:{extension.value}"
+
+
+class ReducerStore:
+    """On-disk store of the UMAP projection fitted on a dataset, for a model.
+
+    The store keeps the fitted `FittedProjection`, and the 2D coordinates of every image
+    placed with it, along with the size and modification time of the image file. A
+    changed image is placed again. The store is written atomically, under a lock file
+    shared by the gunicorn workers.
+    """
+
+    def __init__(
+        self,
+        model: EmbeddingsModel,
+        dataset: str,
+        pca_components: Optional[int] = None,
+        directory: Optional[str] = None,
+    ) -> None:
+        """Open the store of a (dataset, model) pair.
+
+        Args:
+            model (EmbeddingsModel): The model which computed the embeddings.
+            dataset (str): An identifier of the dataset, e.g. its directory and extension.
+            pca_components (Optional[int], optional): The PCA dimensions of the projection,
+                a projection fitted on other features cannot be reused. Defaults to None.
+            directory (Optional[str], optional): The root directory of the stores.
+                Defaults to `settings.reducers_dir`.
+        """
+        self.directory = Path(directory or settings.reducers_dir) / model.value
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        key = hashlib.sha1(json.dumps([dataset, pca_components]).encode()).hexdigest()
+        self.path = self.directory / f"{key[:16]}.joblib"
+        self.lock_path = self.directory / f"{key[:16]}.lock"
+
+    def load(self) -> Optional[Dict]:
+        """Load the stored projection.
+
+        Returns:
+            Optional[Dict]: The fitted projection, under "projection", the signature
+                and coordinates of the placed images, under "points", and the number
+                of images placed since the fit, under "placed". None if nothing is stored.
+        """
+        with file_lock(self.lock_path, shared=True):
+            if not self.path.exists():
+                return None
+            return joblib.load(self.path)
+
+    def save(self, stored: Dict) -> None:
+        """Store a projection and the coordinates of the images placed with it.
+
+        Args:
+            stored (Dict): See `load`.
+        """
+        with file_lock(self.lock_path):
+            tmp_path = self.path.with_suffix(".tmp")
+            joblib.dump(stored, tmp_path)
+            os.replace(tmp_path, self.path)
+
+
+def _points(
+    images_paths: List[Path],
+    clusters: np.ndarray,
+) -> Dict[str, Tuple[Tuple[int, int], np.ndarray]]:
+    return {
+        str(image_path): (file_signature(image_path), coords)
+        for image_path, coords in zip(images_paths, clusters)
+    }
+
+
+def project_with_stored_reducer(
+    logits: np.ndarray,
+    images_paths: List[Path],
+    model: EmbeddingsModel,
+    dataset: str,
+    sample_size: Optional[int] = None,
+    pca_components: Optional[int] = None,
+    seed: Optional[int] = None,
+) -> Tuple[np.ndarray, Dict[str, float]]:
+    """Project the embeddings of a dataset with UMAP, reusing the projection stored for it.
+
+    The images already placed with the stored projection keep their coordinates, and the
+    new or changed images are placed with `UMAP.transform`. The projection is fitted
+    again, see `fit_projection`, and stored, when there is no stored projection, when the
+    images placed since the fit exceed `settings.reducer_refit_growth` times the fitted
+    images, or when the mean of the embeddings drifted by more than
+    `settings.reducer_drift_threshold`, see `FittedProjection.drift`.
+
+    Args:
+        logits (np.ndarray): The embeddings, of shape (N, D).
+        images_paths (List[Path]): The paths of the images, labelled by their directory.
+        model (EmbeddingsModel): The model which computed the embeddings.
+        dataset (str): An identifier of the dataset.
+        sample_size (Optional[int], optional): The number of images a new projection is
+            fitted on. Defaults to None, all the images.
+        pca_components (Optional[int], optional): The number of PCA dimensions.
+            Defaults to None, no PCA.
+        seed (Optional[int], optional): The random seed of a new fit. Defaults to None.
+
+    Returns:
+        Tuple[np.ndarray, Dict[str, float]]: The 2D coordinates, of shape (N, 2), and the
+            time of each stage, with the number of images fitted (0 when the stored
+            projection was reused) and projected.
+    """
+    store = ReducerStore(model=model, dataset=dataset, pca_components=pca_components)
+    stored = store.load()
+
+    timings: Dict[str, float] = {}
+    if stored is not None:
+        projection: FittedProjection = stored["projection"]
+        points = stored["points"]
+
+        start = time.perf_counter()
+        known = [
+            idx
+            for idx, image_path in enumerate(images_paths)
+            if str(image_path) in points
+            and points[str(image_path)][0] == file_signature(image_path)
+        ]
+        new = np.setdiff1d(np.arange(len(images_paths)), known)
+        drift = projection.drift(logits) if len(logits) else 0.0
+        placed = stored["placed"] + len(new)
+        timings["drift"] = drift
+        timings["drift_time"] = time.perf_counter() - start
+
+        if (
+            drift <= settings.reducer_drift_threshold
+            and placed <= settings.reducer_refit_growth * projection.num_fitted
+        ):
+            start = time.perf_counter()
+            clusters = np.empty((len(images_paths), 2), dtype=np.float64)
+            for idx in known:
+                clusters[idx] = points[str(images_paths[idx])][1]
+            if len(new):
+                clusters[new] = projection.transform(logits[new])
+            timings["transform_time"] = time.perf_counter() - start
+            timings["fitted"] = 0
+            timings["projected"] = len(new)
+
+            if len(new):
+                new_paths = [images_paths[idx] for idx in new]
+                points = {
+                    str(images_paths[idx]): points[str(images_paths[idx])]
+                    for idx in known
+                }
+                points.update(_points(new_paths, clusters[new]))
+                store.save(
+                    {"projection": projection, "points": points, "placed": placed},
+                )
+
+            logger.info(
+                f"UMAP projection reused, {len(new)} images placed, drift {drift:.3f}.",
+            )
+            return clusters, timings
+
+        logger.info(
+            f"UMAP projection fitted again : {placed} images placed since the fit, "
+            + f"drift {drift:.3f}.",
+        )
+
+    clusters, fit_timings, projection = fit_projection(
+        logits=logits,
+        mode=ClusteringMode.umap,
+        labels=[Path(image_path).parent.stem for image_path in images_paths],
+        sample_size=sample_size,
+        pca_components=pca_components,
+        seed=seed,
+    )
+    timings.update(fit_timings)
+    timings["projected"] = len(images_paths) - fit_timings["fitted"]
+
+    store.save(
+        {
+            "projection": projection,
+            "points": _points(images_paths, clusters),
+            "placed": 0,
+        },
+    )
+
+    return clusters, timings
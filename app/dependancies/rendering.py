@@ -0,0 +1,125 @@
+import threading
+from contextlib import contextmanager
+from io import BytesIO
+from typing import Dict, Iterator, Tuple
+
+import numpy as np
+from matplotlib import cm
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.colors import Colormap
+from matplotlib.figure import Figure
+from PIL import Image
+
+# Figures are not thread-safe, each thread keeps its own figures, reused between calls.
+_FIGURES = threading.local()
+
+
+@contextmanager
+def reusable_figure(name: str, figsize: Tuple[float, float]) -> Iterator[Figure]:
+    """Provide a cleared figure, attached to an Agg canvas, without using pyplot.
+
+    The figures are not registered in the global pyplot state, and are kept between
+    calls by the thread using them : the figure and its canvas are created once per
+    thread and per `name`, then cleared after each use, so no figure is ever leaked.
+
+    Args:
+        name (str): The name under which the figure is reused.
+        figsize (Tuple[float, float]): The size of the figure, in inches.
+
+    Yields:
+        Iterator[Figure]: The figure, to draw on.
+    """
+    figures: Dict[str, Figure] = getattr(_FIGURES, "figures", None)
+    if figures is None:
+        figures = _FIGURES.figures = {}
+
+    fig = figures.get(name)
+    if fig is None:
+        fig = Figure(figsize=figsize)
+        FigureCanvasAgg(fig)
+        figures[name] = fig
+    else:
+        fig.set_size_inches(figsize)
+
+    try:
+        yield fig
+    finally:
+        fig.clear()
+
+
+def render_png(fig: Figure) -> bytes:
+    """Render a figure as a PNG, in memory.
+
+    Args:
+        fig (Figure): The figure to render.
+
+    Returns:
+        bytes: The PNG image.
+    """
+    buffer = BytesIO()
+    fig.savefig(buffer, format="png")
+    return buffer.getvalue()
+
+
+def encode_png(image: np.ndarray) -> bytes:
+    """Encode an image as a PNG, in memory.
+
+    Args:
+        image (np.ndarray): The `uint8` image.
+
+    Returns:
+        bytes: The PNG image.
+    """
+    buffer = BytesIO()
+    Image.fromarray(image).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def thumbnail_array(values: np.ndarray, max_size: int) -> np.ndarray:
+    """Reduce a 2D array, with a box filter, to at most `max_size` pixels of side.
+
+    Args:
+        values (np.ndarray): The 2D array.
+        max_size (int): The maximal height and width.
+
+    Returns:
+        np.ndarray: The reduced float32 array.
+    """
+    image = Image.fromarray(values.astype(np.float32))
+    image.thumbnail((max_size, max_size), Image.BOX)
+    return np.asarray(image)
+
+
+def encode_heatmap(
+    values: np.ndarray,
+    vmin: float,
+    vmax: float,
+    colormap: Colormap,
+) -> bytes:
+    """Color a 2D array with a colormap, and encode it as a PNG, in memory.
+
+    Args:
+        values (np.ndarray): The 2D array.
+        vmin (float): The value mapped to the first color of the colormap.
+        vmax (float): The value mapped to the last color of the colormap.
+        colormap (Colormap): The colormap.
+
+    Returns:
+        bytes: The PNG image.
+    """
+    scaled = (values - vmin) / max(vmax - vmin, 1e-12)
+    return encode_png((colormap(scaled)[..., :3] * 255).astype(np.uint8))
+
+
+def labels_colormap() -> Colormap:
+    """Return the colormap used to color the points of a plot by label.
+
+    Returns:
+        Colormap: The colormap.
+    """
+    # define the colormap
+    cmap = cm.jet
+    # extract all colors from the .jet map
+    cmaplist = [cmap(i) for i in range(cmap.N)]
+    # create the new map
+    return cmap.from_list("Custom cmap", cmaplist, cmap.N)
@@ -0,0 +1,164 @@
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+from loguru import logger
+
+from app.config import settings
+from app.dependancies.dataset_index import DatasetIndex
+from app.dependancies.utils import file_lock
+
+
+def cache_key(endpoint: str, params: Dict[str, Any], fingerprint: str) -> str:
+    """Compute the key of a result, from the computation that produced it.
+
+    Args:
+        endpoint (str): The name of the endpoint.
+        params (Dict[str, Any]): The JSON-serializable parameters of the request.
+        fingerprint (str): The fingerprint of the dataset the result was computed on.
+
+    Returns:
+        str: The key.
+    """
+    payload = json.dumps([endpoint, params, fingerprint], sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def dataset_cache_key(endpoint: str, params: Dict[str, Any]) -> str:
+    """Compute the key of a result computed on `settings.data_dir`.
+
+    The dataset index is refreshed first, and the indexed files are stat'ed, so the key
+    changes with the images of the extension given in `params`, including the images
+    rewritten in place, which the index only picks up on a rescan.
+
+    Args:
+        endpoint (str): The name of the endpoint.
+        params (Dict[str, Any]): The JSON-serializable parameters of the request.
+
+    Returns:
+        str: The key.
+    """
+    index = DatasetIndex(directory=settings.data_dir)
+    index.refresh()
+    fingerprint = index.fingerprint(
+        extension=params.get("extension"),
+        stat_files=True,
+    )
+
+    return cache_key(endpoint=endpoint, params=params, fingerprint=fingerprint)
+
+
+class ResultCache:
+    """File-backed cache of the responses of the dataset endpoints.
+
+    Each result is stored in its own file, and an `index.json` file records the size,
+    last access time and media type of each result. The cache is shared by the gunicorn
+    workers through a lock file, and is bounded in size : the least recently used results
+    are evicted first.
+    """
+
+    def __init__(
+        self,
+        directory: Optional[str] = None,
+        max_bytes: Optional[int] = None,
+    ) -> None:
+        """Open the cache.
+
+        Args:
+            directory (Optional[str], optional): The directory of the cache.
+                Defaults to `settings.result_cache_dir`.
+            max_bytes (Optional[int], optional): The maximal total size of the results.
+                Defaults to `settings.result_cache_max_bytes`.
+        """
+        self.directory = Path(directory or settings.result_cache_dir)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes or settings.result_cache_max_bytes
+
+        self.index_path = self.directory / "index.json"
+        self.lock_path = self.directory / ".lock"
+
+    def _read_index(self) -> Dict[str, Dict[str, Any]]:
+        if not self.index_path.exists():
+            return {}
+
+        with open(self.index_path, "r") as index_file:
+            return json.load(index_file)
+
+    def _write_index(self, index: Dict[str, Dict[str, Any]]) -> None:
+        tmp_path = self.index_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as index_file:
+            json.dump(index, index_file)
+        os.replace(tmp_path, self.index_path)
+
+    def get(self, key: str) -> Optional[Tuple[bytes, str]]:
+        """Return a cached result, and mark it as recently used.
+
+        Args:
+            key (str): The key of the result.
+
+        Returns:
+            Optional[Tuple[bytes, str]]: The result and its media type, None if not cached.
+        """
+        with file_lock(self.lock_path):
+            index = self._read_index()
+            entry = index.get(key)
+            if entry is None:
+                return None
+
+            try:
+                content = (self.directory / key).read_bytes()
+            except FileNotFoundError:
+                del index[key]
+                self._write_index(index)
+                return None
+
+            entry["last_access"] = time.time()
+            self._write_index(index)
+
+        return content, entry["media_type"]
+
+    def put(self, key: str, content: bytes, media_type: str) -> None:
+        """Store a result, evicting the least recently used results if needed.
+
+        Args:
+            key (str): The key of the result.
+            content (bytes): The result.
+            media_type (str): The media type of the result.
+        """
+        if len(content) > self.max_bytes:
+            return
+
+        with file_lock(self.lock_path):
+            index = self._read_index()
+
+            (self.directory / key).write_bytes(content)
+            index[key] = {
+                "size": len(content),
+                "last_access": time.time(),
+                "media_type": media_type,
+            }
+
+            total_size = sum(entry["size"] for entry in index.values())
+            for old_key in sorted(index, key=lambda k: index[k]["last_access"]):
+                if total_size <= self.max_bytes:
+                    break
+                total_size -= index.pop(old_key)["size"]
+                (self.directory / old_key).unlink(missing_ok=True)
+                logger.debug(f"Result {old_key} evicted from the cache.")
+
+            self._write_index(index)
+
+    def contains(self, key: str) -> bool:
+        """Check if a result is cached, without marking it as recently used.
+
+        Args:
+            key (str): The key of the result.
+
+        Returns:
+            bool: Whether the result is cached.
+        """
+        with file_lock(self.lock_path, shared=True):
+            return key in self._read_index()
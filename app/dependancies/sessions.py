@@ -0,0 +1,150 @@
+import os
+import socket
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import onnxruntime as rt
+from loguru import logger
+
+from app.config import settings
+from app.dependancies.executors import cores_per_worker
+
+GRAPH_OPTIMIZATION_LEVELS = {
+    "disable": rt.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": rt.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": rt.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": rt.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+EXECUTION_MODES = {
+    "sequential": rt.ExecutionMode.ORT_SEQUENTIAL,
+    "parallel": rt.ExecutionMode.ORT_PARALLEL,
+}
+
+# The ONNX Runtime defaults, completed by the keys of the selected profile. 0 threads
+# stands for the share of the cores of the server worker, see `cores_per_worker`.
+DEFAULT_PROFILE: Dict[str, Any] = {
+    "intra_op_num_threads": 0,
+    "inter_op_num_threads": 0,
+    "graph_optimization_level": "all",
+    "execution_mode": "sequential",
+    "enable_cpu_mem_arena": True,
+    "cache_optimized_model": False,
+}
+
+
+def get_session_profile(name: Optional[str] = None) -> Dict[str, Any]:
+    """Return a session profile of `settings.session_profiles`, completed with the defaults.
+
+    Args:
+        name (Optional[str], optional): The name of the profile. Defaults to
+            `settings.session_profile`.
+
+    Raises:
+        ValueError: If the profile, its graph optimization level or its execution mode
+            is unknown.
+
+    Returns:
+        Dict[str, Any]: The profile.
+    """
+    name = name or settings.session_profile
+    profiles = settings.get("session_profiles", {})
+    if name not in profiles:
+        raise ValueError(f"Unknown ONNX Runtime session profile {name}.")
+
+    profile = {**DEFAULT_PROFILE, **profiles[name]}
+    if profile["graph_optimization_level"] not in GRAPH_OPTIMIZATION_LEVELS:
+        raise ValueError(
+            f"Unknown graph optimization level {profile['graph_optimization_level']}.",
+        )
+    if profile["execution_mode"] not in EXECUTION_MODES:
+        raise ValueError(f"Unknown execution mode {profile['execution_mode']}.")
+
+    return profile
+
+
+def optimized_models_dir() -> Path:
+    """Return the directory of the optimized models of the host.
+
+    At the "all" level, an optimized graph may contain optimizations specific to the CPU
+    of the host and to the ONNX Runtime version, so the graphs are kept by host and
+    version, and `settings.optimized_models_dir` can be on a shared volume.
+
+    Returns:
+        Path: The directory, under `settings.optimized_models_dir`.
+    """
+    return Path(settings.optimized_models_dir) / (
+        f"{socket.gethostname()}-onnxruntime-{rt.__version__}"
+    )
+
+
+def create_session(
+    model_path: str,
+    providers: List[str],
+    profile_name: Optional[str] = None,
+) -> Tuple[rt.InferenceSession, str]:
+    """Create an ONNX Runtime session with the options of a session profile.
+
+    The thread counts left to 0 are set to the share of the cores of the server worker,
+    see `app.dependancies.executors.cores_per_worker`, rather than to every core.
+
+    With `cache_optimized_model`, the graph optimized by the first session is saved in
+    `optimized_models_dir()`, and the later sessions load it with the graph optimizations
+    disabled, skipping the optimization work. The saved graph is discarded when the source
+    model is modified.
+
+    Args:
+        model_path (str): The path of the ONNX model.
+        providers (List[str]): The execution providers.
+        profile_name (Optional[str], optional): The name of the profile. Defaults to
+            `settings.session_profile`.
+
+    Returns:
+        Tuple[rt.InferenceSession, str]: The session, and the path of the model file it
+            was created from.
+    """
+    profile_name = profile_name or settings.session_profile
+    profile = get_session_profile(profile_name)
+
+    options = rt.SessionOptions()
+    # each gunicorn worker has its own sessions, which would oversubscribe the cores
+    # with one thread per core each
+    options.intra_op_num_threads = profile["intra_op_num_threads"] or cores_per_worker()
+    options.inter_op_num_threads = profile["inter_op_num_threads"] or cores_per_worker()
+    options.graph_optimization_level = GRAPH_OPTIMIZATION_LEVELS[
+        profile["graph_optimization_level"]
+    ]
+    options.execution_mode = EXECUTION_MODES[profile["execution_mode"]]
+    options.enable_cpu_mem_arena = profile["enable_cpu_mem_arena"]
+
+    if not profile["cache_optimized_model"]:
+        return rt.InferenceSession(model_path, options, providers=providers), model_path
+
+    optimized_dir = optimized_models_dir()
+    optimized_dir.mkdir(parents=True, exist_ok=True)
+    optimized_path = optimized_dir / (
+        f"{Path(model_path).stem}-{profile['graph_optimization_level']}.onnx"
+    )
+
+    if (
+        optimized_path.exists()
+        and optimized_path.stat().st_mtime_ns >= os.stat(model_path).st_mtime_ns
+    ):
+        options.graph_optimization_level = GRAPH_OPTIMIZATION_LEVELS["disable"]
+        session = rt.InferenceSession(str(optimized_path), options, providers=providers)
+        return session, str(optimized_path)
+
+    # each worker writes its own file, the last one replaces the cached graph
+    tmp_path = optimized_path.with_suffix(f".{os.getpid()}.tmp")
+    options.optimized_model_filepath = str(tmp_path)
+
+    start = time.perf_counter()
+    session = rt.InferenceSession(model_path, options, providers=providers)
+    os.replace(tmp_path, optimized_path)
+    logger.info(
+        f"{model_path} optimized in {time.perf_counter() - start:.3f}s, "
+        + f"saved to {optimized_path}.",
+    )
+
+    return session, model_path
@@ -0,0 +1,245 @@
+from concurrent.futures import Future, as_completed
+from multiprocessing.shared_memory import SharedMemory
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from loguru import logger
+
+from app.config import settings
+from app.dependancies.decoding import DecodeStats, load_array
+from app.dependancies.eda_functions import (
+    CHANNELS,
+    accumulate_images_sum,
+    compute_dataset_channels_stats,
+)
+from app.dependancies.executors import get_shard_pool, shard_pool_size
+from app.dependancies.utils import shard_bounds
+
+# Shards per worker for the per-image statistics, to balance the load and report progress.
+SHARDS_PER_WORKER = 4
+
+
+def _stats_shard(
+    shm_name: str,
+    num_images: int,
+    images_paths: List[Path],
+    start: int,
+    scale: int,
+) -> DecodeStats:
+    shm = SharedMemory(name=shm_name)
+    decode_stats = DecodeStats()
+    stats = None
+
+    try:
+        stats = np.ndarray((num_images, 2 * CHANNELS), dtype=np.float64, buffer=shm.buf)
+        compute_dataset_channels_stats(
+            images_paths=images_paths,
+            scale=scale,
+            decode_stats=decode_stats,
+            out=stats[start : start + len(images_paths)],
+        )
+    finally:
+        stats = None
+        shm.close()
+
+    return decode_stats
+
+
+def _sum_shard(
+    shm_name: str,
+    shape: Tuple[int, ...],
+    slot: int,
+    images_paths: List[Path],
+    scale: int,
+) -> DecodeStats:
+    shm = SharedMemory(name=shm_name)
+    decode_stats = DecodeStats()
+    sums = None
+
+    try:
+        sums = np.ndarray(shape, dtype=np.uint64, buffer=shm.buf)
+        accumulate_images_sum(
+            images_paths=images_paths,
+            scale=scale,
+            decode_stats=decode_stats,
+            out=sums[slot],
+        )
+    finally:
+        sums = None
+        shm.close()
+
+    return decode_stats
+
+
+def _gather(
+    futures: Dict[Future, int],
+    progress: Optional[Callable[[int], None]],
+    decode_stats: Optional[DecodeStats],
+) -> None:
+    try:
+        for future in as_completed(futures):
+            shard_decode_stats = future.result()
+            if decode_stats is not None:
+                decode_stats.merge(shard_decode_stats)
+            if progress is not None:
+                progress(futures[future])
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        raise
+
+
+def sharded_channels_stats(
+    images_paths: List[Path],
+    progress: Optional[Callable[[int], None]] = None,
+    scale: int = 1,
+    decode_stats: Optional[DecodeStats] = None,
+) -> np.ndarray:
+    """Compute the per-image channels statistics of a dataset over the shard pool.
+
+    The file list is split in contiguous shards, and each worker process writes the rows
+    of its images straight into a shared-memory (N, 6) array. The rows are computed by
+    `compute_dataset_channels_stats`, so the result is identical to the serial path, which
+    is used when the shard pool has a single process.
+
+    Args:
+        images_paths (List[Path]): The paths of the images.
+        progress (Optional[Callable[[int], None]], optional): Called with the number of
+            images of each shard once it is done. Defaults to None.
+        scale (int, optional): Decode the images at 1/scale of their width and height.
+            Defaults to 1.
+        decode_stats (Optional[DecodeStats], optional): If given, the decoding of the
+            images is recorded in it. Defaults to None.
+
+    Returns:
+        np.ndarray: For each image, the RGB means followed by the RGB stds, as an np.array
+            of shape (N, 6).
+    """
+    num_workers = shard_pool_size()
+    if num_workers == 1 or len(images_paths) < 2:
+        return compute_dataset_channels_stats(
+            images_paths=images_paths,
+            progress=progress,
+            scale=scale,
+            decode_stats=decode_stats,
+        )
+
+    num_images = len(images_paths)
+    bounds = shard_bounds(num_images, num_workers * SHARDS_PER_WORKER)
+    logger.info(
+        f"Computing the statistics of {num_images} images in {len(bounds)} shards.",
+    )
+
+    shm = SharedMemory(create=True, size=num_images * 2 * CHANNELS * 8)
+    shared = None
+    try:
+        pool = get_shard_pool()
+        futures = {
+            pool.submit(
+                _stats_shard,
+                shm.name,
+                num_images,
+                images_paths[start:stop],
+                start,
+                scale,
+            ): stop
+            - start
+            for start, stop in bounds
+        }
+        _gather(futures, progress=progress, decode_stats=decode_stats)
+
+        shared = np.ndarray(
+            (num_images, 2 * CHANNELS),
+            dtype=np.float64,
+            buffer=shm.buf,
+        )
+        stats = shared.copy()
+    finally:
+        # the views on the buffer must be released before closing it
+        shared = None
+        shm.close()
+        shm.unlink()
+
+    return stats
+
+
+def sharded_images_sum(
+    images_paths: List[Path],
+    progress: Optional[Callable[[int], None]] = None,
+    scale: int = 1,
+    decode_stats: Optional[DecodeStats] = None,
+) -> Tuple[np.ndarray, int]:
+    """Sum the pixel values of an image dataset over the shard pool.
+
+    Each shard accumulates its images, with `accumulate_images_sum`, into its own slot of
+    a shared-memory uint64 array, and the slots are added in the parent. The sums are
+    exact, so the result is identical to the serial path. The number of slots is bounded
+    by `settings.shard_sum_max_bytes`.
+
+    Args:
+        images_paths (List[Path]): The paths of the images to sum.
+        progress (Optional[Callable[[int], None]], optional): Called with the number of
+            images of each shard once it is done. Defaults to None.
+        scale (int, optional): Decode the images at 1/scale of their width and height.
+            Defaults to 1.
+        decode_stats (Optional[DecodeStats], optional): If given, the decoding of the
+            images is recorded in it. Defaults to None.
+
+    Raises:
+        HeightWidthMismatchError: If an image does not have the same height and width
+            as the first image of the dataset.
+        ValueError: If the dataset is empty.
+
+    Returns:
+        Tuple[np.ndarray, int]: The per-pixel sum of the images, and the number of images summed.
+    """
+    num_workers = shard_pool_size()
+    if num_workers == 1 or len(images_paths) < 2:
+        return accumulate_images_sum(
+            images_paths=images_paths,
+            progress=progress,
+            scale=scale,
+            decode_stats=decode_stats,
+        )
+
+    image_shape = load_array(images_paths[0], scale=scale).shape
+    slot_bytes = int(np.prod(image_shape)) * 8
+    num_slots = min(
+        num_workers,
+        len(images_paths),
+        max(1, settings.shard_sum_max_bytes // slot_bytes),
+    )
+    bounds = shard_bounds(len(images_paths), num_slots)
+    shape = (len(bounds), *image_shape)
+    logger.info(f"Summing {len(images_paths)} images in {len(bounds)} shards.")
+
+    shm = SharedMemory(create=True, size=len(bounds) * slot_bytes)
+    sums = None
+    try:
+        sums = np.ndarray(shape, dtype=np.uint64, buffer=shm.buf)
+        sums.fill(0)
+
+        pool = get_shard_pool()
+        futures = {
+            pool.submit(
+                _sum_shard,
+                shm.name,
+                shape,
+                slot,
+                images_paths[start:stop],
+                scale,
+            ): stop
+            - start
+            for slot, (start, stop) in enumerate(bounds)
+        }
+        _gather(futures, progress=progress, decode_stats=decode_stats)
+
+        images_sum = sums.sum(axis=0, dtype=np.uint64)
+    finally:
+        # the views on the buffer must be released before closing it
+        sums = None
+        shm.close()
+        shm.unlink()
+
+    return images_sum, len(images_paths)
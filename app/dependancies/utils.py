@@ -1,25 +1,47 @@
+import asyncio
+import fcntl
+import io
+import tarfile
+import zipfile
+import zlib
+from contextlib import contextmanager
 from io import BytesIO
 from pathlib import Path
-from typing import List
+from typing import AsyncIterator, BinaryIO, Iterator, List, Optional, Tuple
 
 import numpy as np
-from PIL import Image
+from PIL import Image, UnidentifiedImageError
+
+from app.dependancies.dataset_index import DatasetIndex
+from app.dependancies.errors import (
+    ChannelNotFoundError,
+    InvalidArchiveError,
+    validate_rgb_images,
+)
+from app.dependancies.metrics import span
+from app.pydantic_models import ArchiveFormat
 
 
 def get_items_list(directory: str, extension: str) -> List[Path]:
-    """
-    The code above does the following:
+    """Return the sorted absolute paths of the files of a directory with a given extension.
+
+    The files are listed from the persistent dataset index, which is refreshed
+    incrementally first, see `app.dependancies.dataset_index.DatasetIndex`.
 
-    1. Creates a list of all the files in the directory.
-    2. Applies a filter to the list to only include files with the given extension.
-    3. Sorts the list by file name.
-    4. Returns the list.
+    Args:
+        directory (str): The directory, searched recursively.
+        extension (str): The extension of the files, e.g. ".png".
+
+    Returns:
+        List[Path]: The sorted absolute paths of the files.
     """
-    return sorted(
-        Path(file).absolute()
-        for file in Path(directory).glob(f"**/*{extension}")
-        if file.is_file()
-    )
+    with span("list_files") as current:
+        index = DatasetIndex(directory=directory)
+        index.refresh()
+        paths = index.paths(extension=extension)
+        current.images = len(paths)
+
+    return paths
 
 
 def read_imagefile(data: bytes) -> Image.Image:
@@ -50,3 +72,148 @@ def generate_batch(lst, batch_size):
     """Yields batch of specified size"""
     for i in range(0, len(lst), batch_size):
         yield lst[i : i + batch_size]
+
+
+def shard_bounds(num_items: int, num_shards: int) -> List[Tuple[int, int]]:
+    """Split a range of items in contiguous shards of (almost) equal sizes.
+
+    Args:
+        num_items (int): The number of items.
+        num_shards (int): The number of shards.
+
+    Returns:
+        List[Tuple[int, int]]: The start and stop of each non-empty shard.
+    """
+    edges = np.linspace(0, num_items, num_shards + 1).astype(int)
+    return [(start, stop) for start, stop in zip(edges[:-1], edges[1:]) if stop > start]
+
+
+@contextmanager
+def file_lock(path: Path, shared: bool = False) -> Iterator[None]:
+    """Hold an advisory lock on a file, to synchronize the gunicorn workers.
+
+    Args:
+        path (Path): The lock file, created if it does not exist.
+        shared (bool, optional): Take a shared (read) lock instead of an exclusive
+            (write) one. Defaults to False.
+
+    Yields:
+        Iterator[None]: Nothing, the lock is held inside the `with` block.
+    """
+    with open(path, "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+class AsyncStreamReader(io.RawIOBase):
+    """Blocking file-like view of an async byte stream, e.g. the body of a request.
+
+    Meant to be read from a worker thread : each read pulls the next chunks of the stream
+    from the event loop, so the bytes are consumed as they arrive, with no buffering
+    beyond the current chunk.
+    """
+
+    def __init__(
+        self,
+        stream: AsyncIterator[bytes],
+        loop: asyncio.AbstractEventLoop,
+    ) -> None:
+        super().__init__()
+        self._stream = stream
+        self._loop = loop
+        self._chunk = memoryview(b"")
+        self._eof = False
+
+    def readable(self) -> bool:
+        return True
+
+    async def _next_chunk(self) -> bytes:
+        return await self._stream.__anext__()
+
+    def readinto(self, buffer) -> int:
+        while not len(self._chunk):
+            if self._eof:
+                return 0
+            try:
+                chunk = asyncio.run_coroutine_threadsafe(
+                    self._next_chunk(),
+                    self._loop,
+                ).result()
+            except StopAsyncIteration:
+                self._eof = True
+                return 0
+            self._chunk = memoryview(chunk)
+
+        size = min(len(buffer), len(self._chunk))
+        buffer[:size] = self._chunk[:size]
+        self._chunk = self._chunk[size:]
+
+        return size
+
+
+def iter_archive_files(
+    fileobj: BinaryIO,
+    archive_format: ArchiveFormat,
+) -> Iterator[Tuple[str, bytes]]:
+    """Yield the files of an archive one at a time.
+
+    Tar archives, compressed or not, are read sequentially, in a single pass over the
+    stream. Zip archives need a seekable file object, as their index is at the end.
+
+    Args:
+        fileobj (BinaryIO): The archive.
+        archive_format (ArchiveFormat): The format of the archive.
+
+    Raises:
+        InvalidArchiveError: If the archive is truncated or corrupt.
+
+    Yields:
+        Iterator[Tuple[str, bytes]]: The name and content of each file.
+    """
+    try:
+        if archive_format == ArchiveFormat.tar:
+            with tarfile.open(fileobj=fileobj, mode="r|*") as archive:
+                for member in archive:
+                    if member.isfile():
+                        yield member.name, archive.extractfile(member).read()
+        else:
+            with zipfile.ZipFile(fileobj) as archive:
+                for info in archive.infolist():
+                    if not info.is_dir():
+                        yield info.filename, archive.read(info)
+    except (tarfile.TarError, zipfile.BadZipFile, EOFError, zlib.error) as err:
+        raise InvalidArchiveError(
+            f"Invalid {archive_format.value} archive : {err}",
+        ) from err
+
+
+def decode_images(
+    files: Iterator[Tuple[str, bytes]],
+    skipped: Optional[List[str]] = None,
+    rgb_only: bool = False,
+) -> Iterator[Tuple[str, np.ndarray]]:
+    """Decode a stream of image files, skipping the files which are not images.
+
+    Args:
+        files (Iterator[Tuple[str, bytes]]): The name and content of each file.
+        skipped (Optional[List[str]], optional): If given, the names of the skipped files
+            are appended to it. Defaults to None.
+        rgb_only (bool, optional): Also skip the images without RGB channels, e.g.
+            grayscale or 16-bit images. Defaults to False.
+
+    Yields:
+        Iterator[Tuple[str, np.ndarray]]: The name and the decoded image of each image file.
+    """
+    for name, data in files:
+        try:
+            image = load_image_into_numpy_array(data)
+            if rgb_only:
+                validate_rgb_images(image[None])
+        except (UnidentifiedImageError, OSError, ChannelNotFoundError):
+            if skipped is not None:
+                skipped.append(name)
+            continue
+        yield name, image
@@ -131,7 +131,8 @@ reload = False
 #
 
 # daemon = False
-raw_env = []
+# the app shares the cores between the shard pools of the workers
+raw_env = [f"WEB_CONCURRENCY={workers}"]
 # pidfile = None
 # umask = 0
 # user = None
@@ -187,6 +188,25 @@ proc_name = None
 #
 #       A callable that takes a server instance as the sole argument.
 #
+#   on_starting - Called just before the master process is initialized.
+#
+#       A callable that takes a server instance as the sole argument.
+#
+
+
+def on_starting(server):
+    # the metrics of the workers of a previous run would be added to the new ones
+    from app.dependancies.metrics import clear_metrics
+
+    server.log.info("Clearing the metrics of the previous workers.")
+    clear_metrics()
+
+
+def child_exit(server, worker):
+    # keep the counters of the worker, without leaving one file per restarted worker
+    from app.dependancies.metrics import merge_worker_metrics
+
+    merge_worker_metrics(worker.pid)
 
 
 def post_fork(server, worker):
@@ -1,12 +1,26 @@
+import os
+import time
 from pathlib import Path
+from typing import List
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import RedirectResponse
+from fastapi.responses import PlainTextResponse, RedirectResponse
 from loguru import logger
 
 from app.config import settings
-from app.routes import eda, embedding
+from app.dependancies.embedding_function import get_engine
+from app.dependancies.executors import get_executors_stats, shutdown_executors
+from app.dependancies.jobs import shutdown_jobs, start_jobs_monitor
+from app.dependancies.metrics import (
+    aggregate_metrics,
+    clear_metrics,
+    get_registry,
+    observe_request,
+    render_prometheus,
+)
+from app.pydantic_models import EmbeddingsModel, ExecutorReport, Providers
+from app.routes import eda, embedding, jobs
 
 app = FastAPI(
     title="Basic API for Computer Vision EDA",
@@ -16,6 +30,7 @@ app = FastAPI(
 
 app.include_router(eda.router, prefix="/eda")
 app.include_router(embedding.router, prefix="/embedding")
+app.include_router(jobs.router, prefix="/jobs")
 
 
 app.add_middleware(
@@ -27,14 +42,71 @@ app.add_middleware(
 )
 
 
+@app.middleware("http")
+async def record_request_latency(request: Request, call_next):
+    start = time.perf_counter()
+    # an exception raised by the route is answered with a 500 by the server
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        # the route template, rather than the path, keeps the number of series bounded
+        route = request.scope.get("route")
+        observe_request(
+            method=request.method,
+            route=getattr(route, "path", "unmatched"),
+            status=status_code,
+            duration=time.perf_counter() - start,
+        )
+
+
 @app.on_event("startup")
 async def create_directories():
     logger.info("Creating data directory.")
     Path(f"{settings.data_dir}").mkdir(parents=True, exist_ok=True)
     logger.info("Creating results directories.")
-    Path(f"{settings.histograms_dir}").mkdir(parents=True, exist_ok=True)
-    Path(f"{settings.mean_image_dir}").mkdir(parents=True, exist_ok=True)
-    Path(f"{settings.scatterplots_dir}").mkdir(parents=True, exist_ok=True)
+    Path(f"{settings.embeddings_cache_dir}").mkdir(parents=True, exist_ok=True)
+    Path(f"{settings.jobs_dir}").mkdir(parents=True, exist_ok=True)
+    Path(f"{settings.dataset_index_dir}").mkdir(parents=True, exist_ok=True)
+    Path(f"{settings.result_cache_dir}").mkdir(parents=True, exist_ok=True)
+    Path(f"{settings.reducers_dir}").mkdir(parents=True, exist_ok=True)
+    Path(f"{settings.optimized_models_dir}").mkdir(parents=True, exist_ok=True)
+    Path(f"{settings.neighbours_index_dir}").mkdir(parents=True, exist_ok=True)
+    Path(f"{settings.hashes_cache_dir}").mkdir(parents=True, exist_ok=True)
+    Path(f"{settings.metrics_dir}").mkdir(parents=True, exist_ok=True)
+
+
+@app.on_event("startup")
+def clear_previous_metrics():
+    # gunicorn clears them once before starting its workers, see `app/gunicorn.py`
+    if "gunicorn" not in os.environ.get("SERVER_SOFTWARE", ""):
+        clear_metrics(keep_running=True)
+
+
+@app.on_event("startup")
+def requeue_interrupted_jobs():
+    start_jobs_monitor()
+
+
+@app.on_event("startup")
+def warmup_engines():
+    for model_name in settings.warmup_engines:
+        logger.info(f"Loading and warming up {model_name}.")
+        get_engine(
+            model=EmbeddingsModel(model_name),
+            provider=Providers.cpu,
+            warmup=True,
+        )
+
+
+@app.on_event("shutdown")
+def stop_executors():
+    logger.info("Shutting down the executors.")
+    shutdown_executors()
+    shutdown_jobs()
+    get_registry().flush()
 
 
 @app.get(
@@ -49,3 +121,28 @@ def main():
 @app.get("/healthcheck", tags=["Healthcheck"])
 def get_api_status():
     return {"Status": "ok"}
+
+
+@app.get(
+    "/executors",
+    response_model=List[ExecutorReport],
+    tags=["Healthcheck"],
+)
+def get_executors_status():
+    return get_executors_stats()
+
+
+@app.get(
+    "/metrics",
+    response_class=PlainTextResponse,
+    tags=["Healthcheck"],
+    description="latences des requêtes et de leurs étapes, au format Prometheus.",
+)
+def get_metrics():
+    # the metrics of the other workers are read from their files, this one's are written
+    # first for the response to be up to date
+    get_registry().flush()
+    return PlainTextResponse(
+        render_prometheus(aggregate_metrics()),
+        media_type="text/plain; version=0.0.4",
+    )
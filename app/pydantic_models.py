@@ -1,4 +1,5 @@
 from enum import Enum
+from typing import Dict, List, Optional
 
 from pydantic import BaseModel
 
@@ -12,6 +13,128 @@ class FeatureReport(BaseModel):
     blue_std_value: float
 
 
+class HistogramOutput(Enum):
+    png = "png"
+    json = "json"
+    npy = "npy"
+
+
+class HistogramReport(BaseModel):
+    num_pixels: int
+    red_counts: List[int]
+    green_counts: List[int]
+    blue_counts: List[int]
+
+
+class FeatureTable(BaseModel):
+    columns: List[str]
+    filenames: List[str]
+    rows: List[List[float]]
+    skipped: List[str] = []
+
+
+class EigenimagesOutput(Enum):
+    png = "png"
+    json = "json"
+
+
+class EigenimagesClass(BaseModel):
+    num_images: int
+    explained_variance_ratio: List[float]
+    mean: List[List[float]]
+    components: List[List[List[float]]]
+
+
+class EigenimagesReport(BaseModel):
+    width: int
+    height: int
+    labels: Dict[str, EigenimagesClass]
+
+
+class DeviationMetric(Enum):
+    l2 = "l2"
+    l1 = "l1"
+    ssim = "ssim"
+
+
+class DeviationOutput(Enum):
+    png = "png"
+    json = "json"
+
+
+class DeviationItem(BaseModel):
+    filename: str
+    label: str
+    l2: float
+    l1: float
+    ssim: float
+    heatmap: str
+
+
+class DeviationReport(BaseModel):
+    metric: DeviationMetric
+    num_images: int
+    images: List[DeviationItem]
+
+
+class ClassStatisticsOutput(Enum):
+    png = "png"
+    json = "json"
+
+
+class ClassStatistics(BaseModel):
+    num_images: int
+    channels_means: List[float]
+    channels_stds: List[float]
+    mean_image: str
+
+
+class ClassContrast(BaseModel):
+    first: str
+    second: str
+    image: str
+
+
+class ClassStatisticsReport(BaseModel):
+    labels: Dict[str, ClassStatistics]
+    contrasts: List[ClassContrast]
+
+
+class PerceptualHash(Enum):
+    ahash = "ahash"
+    dhash = "dhash"
+    phash = "phash"
+
+
+class DuplicateKind(Enum):
+    exact = "exact"
+    near = "near"
+
+
+class DuplicateFile(BaseModel):
+    path: str
+    label: str
+
+
+class DuplicateGroup(BaseModel):
+    kind: DuplicateKind
+    labels: List[str]
+    files: List[DuplicateFile]
+
+
+class DuplicatesReport(BaseModel):
+    hash: PerceptualHash
+    max_distance: int
+    num_images: int
+    num_duplicates: int
+    groups: List[DuplicateGroup]
+
+
+class ArchiveFormat(Enum):
+    tar = "tar"
+    zip = "zip"
+
+
 class Extension(Enum):
     png = ".png"
     jpg = ".jpg"
@@ -19,6 +142,7 @@ class Extension(Enum):
 
 class EmbeddingsModel(Enum):
     resnet50v2 = "resnet50v2"
+    resnet50v2_int8 = "resnet50v2_int8"
 
 
 class Providers(Enum):
@@ -29,3 +153,83 @@ class Providers(Enum):
 class ClusteringMode(Enum):
     tsne = "tSNE"
     umap = "UMAP"
+
+
+class EngineReport(BaseModel):
+    model: str
+    provider: str
+    profile: str
+    load_time: float
+    warmup_time: Optional[float] = None
+    batch_size: int
+    batch_throughputs: Dict[int, float] = {}
+
+
+class Neighbour(BaseModel):
+    path: str
+    label: str
+    distance: float
+
+
+class NeighboursReport(BaseModel):
+    model: EmbeddingsModel
+    query: str
+    indexed: int
+    query_time: float
+    neighbours: List[Neighbour]
+
+
+class NeighboursIndexReport(BaseModel):
+    model: EmbeddingsModel
+    indexed: int
+    inferred: int
+    pruned: int
+    refresh_time: float
+
+
+class ExecutorReport(BaseModel):
+    name: str
+    submitted: int
+    pending: int
+    completed: int
+    mean_queue_time: float
+    max_queue_time: float
+    mean_execution_time: float
+    max_execution_time: float
+
+
+class JobKind(Enum):
+    dataset_mean_image = "dataset_mean_image"
+    mean_std_scatterplot = "mean_std_scatterplot"
+    clustering = "clustering"
+    eigenimages = "eigenimages"
+    mean_image_deviations = "mean_image_deviations"
+    class_statistics = "class_statistics"
+
+
+class JobStatus(Enum):
+    pending = "pending"
+    running = "running"
+    done = "done"
+    failed = "failed"
+
+
+class JobReport(BaseModel):
+    job_id: str
+    kind: JobKind
+    status: JobStatus
+    done: int
+    total: Optional[int] = None
+    created_at: str
+    started_at: Optional[str] = None
+    finished_at: Optional[str] = None
+    error: Optional[str] = None
+    media_type: Optional[str] = None
+    params: Dict[str, object] = {}
+
+
+class DatasetSummary(BaseModel):
+    num_files: int
+    total_size: int
+    labels: Dict[str, int]
+    extensions: Dict[str, int]
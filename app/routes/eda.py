@@ -1,30 +1,144 @@
+import asyncio
+import base64
+import io
+import shutil
+from collections import Counter
 from io import BytesIO
 from pathlib import Path
+from tempfile import SpooledTemporaryFile
+from typing import Any, Awaitable, BinaryIO, Callable, Dict, List, Optional, Tuple
 
-import arrow
 import numpy as np
-from fastapi import APIRouter, File, UploadFile, status
-from fastapi.responses import FileResponse, Response
+from fastapi import APIRouter, File, HTTPException, Query, Request, UploadFile, status
+from fastapi.responses import Response
 from loguru import logger
-from PIL import Image
 
 from app.config import settings
+from app.dependancies.dataset_index import DatasetIndex
+from app.dependancies.decoding import DecodeStats, with_decode_stats
+from app.dependancies.deviation import (
+    METRICS,
+    cached_mean_image,
+    deviation_heatmaps,
+    plot_deviations,
+    rank_deviations,
+)
+from app.dependancies.duplicates import find_duplicates
 from app.dependancies.eda_functions import (
-    compute_channels_mean,
-    compute_channels_std,
-    compute_histograms_channels,
-    compute_mean_image,
-    compute_scatterplot,
+    CHANNELS,
+    ClassAccumulator,
+    accumulate_class_sums,
+    compute_channels_counts,
+    compute_channels_histograms,
+    compute_channels_stats,
+    compute_contrast_images,
+    compute_images_channels_stats,
+    encode_contrast_images,
+    encode_mean_image,
+    plot_class_statistics,
+    plot_histograms_channels,
+    plot_scatterplot,
+)
+from app.dependancies.eigenimages import compute_eigenimages, plot_eigenimages
+from app.dependancies.errors import (
+    ChannelNotFoundError,
+    DimensionError,
+    EmptyDatasetError,
+    InvalidArchiveError,
 )
+from app.dependancies.executors import run_in_process, run_in_thread
+from app.dependancies.metrics import span
+from app.dependancies.result_cache import ResultCache, dataset_cache_key
+from app.dependancies.sharding import sharded_channels_stats, sharded_images_sum
 from app.dependancies.utils import (
+    AsyncStreamReader,
+    decode_images,
     get_items_list,
+    iter_archive_files,
     load_image_into_numpy_array,
     read_imagefile,
 )
-from app.pydantic_models import Extension, FeatureReport
+from app.pydantic_models import (
+    ArchiveFormat,
+    ClassStatisticsOutput,
+    ClassStatisticsReport,
+    DatasetSummary,
+    DeviationMetric,
+    DeviationOutput,
+    DeviationReport,
+    DuplicatesReport,
+    EigenimagesOutput,
+    EigenimagesReport,
+    Extension,
+    FeatureReport,
+    FeatureTable,
+    HistogramOutput,
+    HistogramReport,
+    PerceptualHash,
+)
 
 router = APIRouter()
 
+FEATURE_COLUMNS = [
+    "red_mean_value",
+    "green_mean_value",
+    "blue_mean_value",
+    "red_std_value",
+    "green_std_value",
+    "blue_std_value",
+]
+
+# zip archives smaller than this are kept in memory while being received
+ZIP_SPOOL_MAX_SIZE = 64 * 1024 * 1024
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if if_none_match is None:
+        return False
+
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in candidates or any(
+        tag[2:] == etag if tag.startswith("W/") else tag == etag for tag in candidates
+    )
+
+
+async def _cached_dataset_response(
+    request: Request,
+    endpoint: str,
+    params: Dict[str, Any],
+    compute: Callable[[], Awaitable[Tuple[bytes, Dict[str, str]]]],
+    media_type: str = "image/png",
+) -> Response:
+    """Serve the result of a dataset endpoint from the result cache, computing it if needed.
+
+    The key of the result, built from the endpoint, its parameters and the fingerprint of
+    the dataset, is used as the ETag of the response : a client sending it back in
+    `If-None-Match` gets a 304 without any computation. The headers returned by `compute`
+    are only sent with a freshly computed result.
+    """
+    with span("cache_key"):
+        key = await run_in_thread(dataset_cache_key, endpoint=endpoint, params=params)
+    headers = {"ETag": f'"{key}"'}
+
+    if _etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    cache = ResultCache()
+    cached = await run_in_thread(cache.get, key)
+    if cached is not None:
+        logger.info(f"{endpoint} served from the result cache.")
+        content, media_type = cached
+        return Response(content=content, headers=headers, media_type=media_type)
+
+    content, compute_headers = await compute()
+    await run_in_thread(cache.put, key, content, media_type)
+
+    return Response(
+        content=content,
+        headers={**headers, **compute_headers},
+        media_type=media_type,
+    )
+
 
 @router.post(
     "/mean_values",
@@ -34,11 +148,22 @@ router = APIRouter()
 )
 async def get_mean_values(file: UploadFile = File(...)):
     """Return the mean and standard deviation over each channels of an RGB images."""
-    image = load_image_into_numpy_array(await file.read())
-
-    red_mean_value, green_mean_value, blue_mean_value = compute_channels_mean(image)
-
-    red_std_value, green_std_value, blue_std_value = compute_channels_std(image)
+    image = await run_in_thread(load_image_into_numpy_array, await file.read())
+
+    try:
+        (
+            red_mean_value,
+            green_mean_value,
+            blue_mean_value,
+            red_std_value,
+            green_std_value,
+            blue_std_value,
+        ) = await run_in_thread(compute_channels_stats, image)
+    except ChannelNotFoundError:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Expected an RGB image, got an image of shape {image.shape}.",
+        )
 
     return FeatureReport(
         red_mean_value=red_mean_value,
@@ -50,6 +175,102 @@ async def get_mean_values(file: UploadFile = File(...)):
     )
 
 
+@router.post(
+    "/mean_values_batch",
+    response_model=FeatureTable,
+    status_code=status.HTTP_200_OK,
+    tags=["CV"],
+)
+async def get_batch_mean_values(
+    files: List[UploadFile] = File(...),
+    batch_size: int = Query(16, ge=1),
+):
+    """Return the mean and standard deviation over each channels of many RGB images.
+
+    The files which are not RGB images, e.g. grayscale images, are listed as skipped.
+    """
+    skipped: List[str] = []
+    uploaded = ((file.filename, file.file.read()) for file in files)
+
+    names, stats = await run_in_thread(
+        compute_images_channels_stats,
+        images=decode_images(uploaded, skipped=skipped, rgb_only=True),
+        batch_size=batch_size,
+    )
+
+    return FeatureTable(
+        columns=FEATURE_COLUMNS,
+        filenames=names,
+        rows=stats.tolist(),
+        skipped=skipped,
+    )
+
+
+def _compute_archive_stats(
+    body: BinaryIO,
+    archive_format: ArchiveFormat,
+    batch_size: int,
+) -> Tuple[List[str], np.ndarray, List[str]]:
+    if archive_format == ArchiveFormat.zip:
+        # the index of a zip archive is at its end, it has to be received first
+        spooled = SpooledTemporaryFile(max_size=ZIP_SPOOL_MAX_SIZE)
+        shutil.copyfileobj(body, spooled)
+        spooled.seek(0)
+        body = spooled
+
+    skipped: List[str] = []
+    names, stats = compute_images_channels_stats(
+        images=decode_images(
+            iter_archive_files(fileobj=body, archive_format=archive_format),
+            skipped=skipped,
+            rgb_only=True,
+        ),
+        batch_size=batch_size,
+    )
+
+    return names, stats, skipped
+
+
+@router.post(
+    "/mean_values_archive",
+    response_model=FeatureTable,
+    status_code=status.HTTP_200_OK,
+    tags=["CV"],
+)
+async def get_archive_mean_values(
+    request: Request,
+    archive_format: ArchiveFormat = ArchiveFormat.tar,
+    batch_size: int = Query(16, ge=1),
+):
+    """Return the mean and standard deviation over each channels of the images of an archive.
+
+    The archive is sent as the raw body of the request. A tar archive, compressed or not,
+    is decoded and reduced as its bytes arrive, a zip archive is received first.
+    The files which are not RGB images are listed as skipped.
+    """
+    body = io.BufferedReader(
+        AsyncStreamReader(request.stream(), asyncio.get_running_loop()),
+        buffer_size=1 << 20,
+    )
+
+    try:
+        names, stats, skipped = await run_in_thread(
+            _compute_archive_stats,
+            body=body,
+            archive_format=archive_format,
+            batch_size=batch_size,
+        )
+    except InvalidArchiveError as err:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(err))
+
+    return FeatureTable(
+        columns=FEATURE_COLUMNS,
+        filenames=names,
+        rows=stats.tolist(),
+        skipped=skipped,
+    )
+
+
 @router.post(
     "/return_image",
     tags=["CV"],
@@ -57,7 +278,7 @@ async def get_mean_values(file: UploadFile = File(...)):
 )
 async def image_endpoint(file: UploadFile = File(...)):
     """Placeholder. Just return the given image."""
-    image = read_imagefile(await file.read())
+    image = await run_in_thread(read_imagefile, await file.read())
 
     # here you can do whatever you want with your image
 
@@ -81,24 +302,49 @@ async def image_endpoint(file: UploadFile = File(...)):
 )
 async def get_histograms_channels(
     file: UploadFile = File(...),
+    output: HistogramOutput = HistogramOutput.png,
 ):
-    """Compute the channels normed histograms of an image."""
+    """Compute the channels normed histograms of an image.
 
-    timestamp = arrow.now().format("YYYY-MM-DD_HH-mm-ss")
+    With `output=png` the histograms are plotted, with `output=json` or `output=npy` the
+    exact 256-bin counts of each channel are returned instead, without any plotting.
+    """
 
     filename = Path(file.filename).stem
-    image = load_image_into_numpy_array(await file.read())
+    image = await run_in_thread(load_image_into_numpy_array, await file.read())
     logger.info(f"image loaded : {image.shape}")
 
-    saved_image_path = compute_histograms_channels(
-        image=image,
-        filename=filename,
-        timestamp=timestamp,
-    )
-
     result = {"filename": file.filename}
 
-    return FileResponse(saved_image_path, headers=result)
+    if output == HistogramOutput.json:
+        counts = await run_in_thread(compute_channels_counts, image)
+        return HistogramReport(
+            num_pixels=int(counts[0].sum()),
+            red_counts=counts[0].tolist(),
+            green_counts=counts[1].tolist(),
+            blue_counts=counts[2].tolist(),
+        )
+
+    if output == HistogramOutput.npy:
+        counts = await run_in_thread(compute_channels_counts, image)
+        bytes_counts = BytesIO()
+        np.save(bytes_counts, counts)
+        return Response(
+            content=bytes_counts.getvalue(),
+            headers=result,
+            media_type="application/octet-stream",
+        )
+
+    # only the (3, 256) histograms are sent to the process pool, not the whole image
+    histograms = await run_in_thread(compute_channels_histograms, image)
+    with span("compute_histograms_channels"):
+        histograms_plot = await run_in_process(
+            plot_histograms_channels,
+            histograms=histograms,
+            filename=filename,
+        )
+
+    return Response(content=histograms_plot, headers=result, media_type="image/png")
 
 
 @router.get(
@@ -106,43 +352,497 @@ async def get_histograms_channels(
     tags=["CV"],
     status_code=status.HTTP_200_OK,
 )
-async def get_dataset_mean_image(extension: Extension):
-    """Compute the mean image of an image dataset."""
+async def get_dataset_mean_image(
+    request: Request,
+    extension: Extension,
+    scale: int = Query(1, ge=1),
+):
+    """Compute the mean image of an image dataset.
+
+    With `scale` > 1, the images are decoded at 1/scale of their resolution, for an
+    approximate mean image, faster to compute. The result is cached until the dataset
+    changes, and can be revalidated with the `If-None-Match` header.
+    """
 
     # TODO : check for image size and resize if necessary
 
-    timestamp = arrow.now().format("YYYY-MM-DD_HH-mm-ss")
+    async def compute() -> Tuple[bytes, Dict[str, str]]:
+        images_paths = await run_in_thread(
+            get_items_list,
+            directory=settings.data_dir,
+            extension=extension.value,
+        )
+        (images_sum, num_images), headers = await run_in_thread(
+            with_decode_stats,
+            sharded_images_sum,
+            images_paths=images_paths,
+            scale=scale,
+        )
+        mean_image = await run_in_thread(
+            encode_mean_image,
+            images_sum=images_sum,
+            num_images=num_images,
+        )
+        return mean_image, headers
+
+    return await _cached_dataset_response(
+        request=request,
+        endpoint="dataset_mean_image",
+        params={"extension": extension.value, "scale": scale},
+        compute=compute,
+    )
+
+
+@router.get(
+    "/mean_std_scatterplot",
+    tags=["CV"],
+    status_code=status.HTTP_200_OK,
+)
+async def get_mean_std_scatterplot(
+    request: Request,
+    extension: Extension,
+    scale: int = Query(1, ge=1),
+):
+    """Compute the mean vs std scatterplot of an image dataset.
+
+    With `scale` > 1, the images are decoded at 1/scale of their resolution, for
+    approximate statistics, faster to compute. The result is cached until the dataset
+    changes, and can be revalidated with the `If-None-Match` header.
+    """
+
+    async def compute() -> Tuple[bytes, Dict[str, str]]:
+        images_paths = await run_in_thread(
+            get_items_list,
+            directory=settings.data_dir,
+            extension=extension.value,
+        )
+        stats, headers = await run_in_thread(
+            with_decode_stats,
+            sharded_channels_stats,
+            images_paths=images_paths,
+            scale=scale,
+        )
+        with span("plot_scatterplot"):
+            scatterplot = await run_in_process(
+                plot_scatterplot,
+                stats=stats,
+                images_paths=images_paths,
+            )
+        return scatterplot, headers
+
+    return await _cached_dataset_response(
+        request=request,
+        endpoint="mean_std_scatterplot",
+        params={"extension": extension.value, "scale": scale},
+        compute=compute,
+    )
+
+
+@router.get(
+    "/eigenimages",
+    tags=["CV"],
+    status_code=status.HTTP_200_OK,
+)
+async def get_eigenimages(
+    request: Request,
+    extension: Extension,
+    per_label: bool = False,
+    n_components: int = Query(16, ge=1),
+    size: int = Query(64, ge=8, le=256),
+    batch_size: int = Query(256, ge=1),
+    output: EigenimagesOutput = EigenimagesOutput.png,
+):
+    """Compute the eigenimages of an image dataset, or of each of its labels.
+
+    The images are resized to `size` x `size` grayscale images, and streamed in batches
+    of `batch_size` images into an incremental PCA, so the memory used does not depend
+    on the size of the dataset. With `output=png` the first eigenimages and the
+    explained-variance curve are plotted, with `output=json` the mean image, all the
+    eigenimages and the explained-variance ratios are returned. The result is cached
+    until the dataset changes, and can be revalidated with the `If-None-Match` header.
+    """
+
+    async def compute() -> Tuple[bytes, Dict[str, str]]:
+        images_paths = await run_in_thread(
+            get_items_list,
+            directory=settings.data_dir,
+            extension=extension.value,
+        )
+        eigenimages, headers = await run_in_thread(
+            with_decode_stats,
+            compute_eigenimages,
+            images_paths=images_paths,
+            per_label=per_label,
+            n_components=n_components,
+            size=(size, size),
+            batch_size=batch_size,
+        )
+
+        if output == EigenimagesOutput.json:
+            report = EigenimagesReport(
+                width=size,
+                height=size,
+                labels={label: eigen.to_dict() for label, eigen in eigenimages.items()},
+            )
+            return report.json().encode(), headers
+
+        with span("plot_eigenimages"):
+            plot = await run_in_process(plot_eigenimages, eigenimages=eigenimages)
+        return plot, headers
+
+    return await _cached_dataset_response(
+        request=request,
+        endpoint="eigenimages",
+        params={
+            "extension": extension.value,
+            "per_label": per_label,
+            "n_components": n_components,
+            "size": size,
+            "batch_size": batch_size,
+            "output": output.value,
+        },
+        compute=compute,
+        media_type=(
+            "application/json" if output == EigenimagesOutput.json else "image/png"
+        ),
+    )
+
+
+def _class_statistics_report(accumulators: Dict[str, ClassAccumulator]) -> bytes:
+    labels = {}
+    for label, accumulator in accumulators.items():
+        stats = accumulator.channels_stats()
+        mean_image = encode_mean_image(
+            images_sum=accumulator.images_sum,
+            num_images=accumulator.num_images,
+        )
+        labels[label] = {
+            "num_images": accumulator.num_images,
+            "channels_means": stats[:CHANNELS].tolist(),
+            "channels_stds": stats[CHANNELS:].tolist(),
+            "mean_image": base64.b64encode(mean_image).decode(),
+        }
+
+    contrasts = encode_contrast_images(compute_contrast_images(accumulators))
+    report = ClassStatisticsReport(
+        labels=labels,
+        contrasts=[
+            {
+                "first": first,
+                "second": second,
+                "image": base64.b64encode(image).decode(),
+            }
+            for (first, second), image in contrasts.items()
+        ],
+    )
+
+    return report.json().encode()
+
+
+@router.get(
+    "/class_statistics",
+    tags=["CV"],
+    status_code=status.HTTP_200_OK,
+)
+async def get_class_statistics(
+    request: Request,
+    extension: Extension,
+    scale: int = Query(1, ge=1),
+    output: ClassStatisticsOutput = ClassStatisticsOutput.json,
+):
+    """Compute the mean image and the channels statistics of each label of a dataset.
+
+    The images are decoded once, in a single pass, and added to the sums of their label,
+    so the memory used depends on the number of labels only. With `output=json`, the
+    channels means and stds of the pixels of each label, its mean image, and the
+    difference between the mean images of each pair of labels are returned, as base64
+    PNG images. With `output=png`, the mean images and their differences are plotted.
+    The result is cached until the dataset changes, and can be revalidated with the
+    `If-None-Match` header.
+    """
+
+    async def compute() -> Tuple[bytes, Dict[str, str]]:
+        images_paths = await run_in_thread(
+            get_items_list,
+            directory=settings.data_dir,
+            extension=extension.value,
+        )
+        accumulators, headers = await run_in_thread(
+            with_decode_stats,
+            accumulate_class_sums,
+            images_paths=images_paths,
+            scale=scale,
+        )
+
+        if output == ClassStatisticsOutput.json:
+            report = await run_in_thread(_class_statistics_report, accumulators)
+            return report, headers
+
+        with span("plot_class_statistics"):
+            plot = await run_in_process(
+                plot_class_statistics,
+                accumulators=accumulators,
+            )
+        return plot, headers
+
+    return await _cached_dataset_response(
+        request=request,
+        endpoint="class_statistics",
+        params={"extension": extension.value, "scale": scale, "output": output.value},
+        compute=compute,
+        media_type=(
+            "application/json" if output == ClassStatisticsOutput.json else "image/png"
+        ),
+    )
+
+
+def _compute_deviations(
+    extension: Extension,
+    metric: DeviationMetric,
+    top_k: int,
+    scale: int,
+    output: DeviationOutput,
+) -> Tuple[bytes, Dict[str, str]]:
+    decode_stats = DecodeStats()
+    mean_image = cached_mean_image(
+        extension=extension,
+        scale=scale,
+        decode_stats=decode_stats,
+    )
 
     images_paths = get_items_list(
         directory=settings.data_dir,
         extension=extension.value,
     )
-
-    images_list = [
-        np.array(Image.open(image), dtype=np.float32) for image in images_paths
-    ]
-    saved_image_path = compute_mean_image(images_list=images_list, timestamp=timestamp)
-
-    return FileResponse(saved_image_path)
+    with span("rank_deviations", images=len(images_paths)):
+        scores, top = rank_deviations(
+            images_paths=images_paths,
+            mean_image=mean_image,
+            metric=metric,
+            top_k=top_k,
+            scale=scale,
+            decode_stats=decode_stats,
+        )
+    top_paths = [images_paths[idx] for idx in top]
+    heatmaps = deviation_heatmaps(top_paths, mean_image=mean_image, scale=scale)
+
+    if output == DeviationOutput.png:
+        with span("plot_deviations"):
+            plot = plot_deviations(
+                images_paths=top_paths,
+                scores=scores[top],
+                heatmaps=heatmaps,
+                metric=metric,
+            )
+        return plot, decode_stats.report()
+
+    report = DeviationReport(
+        metric=metric,
+        num_images=len(images_paths),
+        images=[
+            {
+                "filename": Path(image_path).name,
+                "label": Path(image_path).parent.stem,
+                **{
+                    name.value: float(score)
+                    for name, score in zip(METRICS, scores[idx])
+                },
+                "heatmap": base64.b64encode(heatmap).decode(),
+            }
+            for idx, image_path, heatmap in zip(top, top_paths, heatmaps)
+        ],
+    )
+    return report.json().encode(), decode_stats.report()
 
 
 @router.get(
-    "/mean_std_scatterplot",
+    "/mean_image_deviations",
     tags=["CV"],
     status_code=status.HTTP_200_OK,
 )
-async def get_mean_std_scatterplot(extension: Extension):
-    """Compute the mean vs std scatterplot of an image dataset."""
-    timestamp = arrow.now().format("YYYY-MM-DD_HH-mm-ss")
+async def get_mean_image_deviations(
+    request: Request,
+    extension: Extension,
+    metric: DeviationMetric = DeviationMetric.l2,
+    top_k: int = Query(20, ge=1, le=500),
+    scale: int = Query(1, ge=1),
+    output: DeviationOutput = DeviationOutput.json,
+):
+    """Rank the images of a dataset by their deviation from the mean image of the dataset.
+
+    Every image is scored against the mean image, shared with `/eda/dataset_mean_image`,
+    in a single streaming pass over memory-bounded chunks, by its l2 and l1 pixel
+    distances and a block-wise SSIM dissimilarity. The `top_k` most atypical images by
+    `metric` are returned, with `output=json`, along with their scores and a small diff
+    heatmap, as a base64 PNG, or plotted next to their heatmaps with `output=png`. The
+    result is cached until the dataset changes, and can be revalidated with the
+    `If-None-Match` header. A dataset whose images do not all have the same shape, or
+    are not all 8-bit images, is answered with a 422, and a dataset without any image
+    with a 404.
+    """
+
+    async def compute() -> Tuple[bytes, Dict[str, str]]:
+        try:
+            return await run_in_thread(
+                _compute_deviations,
+                extension=extension,
+                metric=metric,
+                top_k=top_k,
+                scale=scale,
+                output=output,
+            )
+        except DimensionError as err:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=f"The images do not all have the shape of the mean image: {err}",
+            )
+        except EmptyDatasetError:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"No {extension.value} image in the dataset.",
+            )
+
+    return await _cached_dataset_response(
+        request=request,
+        endpoint="mean_image_deviations",
+        params={
+            "extension": extension.value,
+            "metric": metric.value,
+            "top_k": top_k,
+            "scale": scale,
+            "output": output.value,
+        },
+        compute=compute,
+        media_type=(
+            "application/json" if output == DeviationOutput.json else "image/png"
+        ),
+    )
 
+
+def _compute_duplicates(
+    extension: Extension,
+    hash_function: PerceptualHash,
+    max_distance: int,
+    cross_label_only: bool,
+) -> Tuple[bytes, Dict[str, str]]:
+    decode_stats = DecodeStats()
     images_paths = get_items_list(
         directory=settings.data_dir,
         extension=extension.value,
     )
+    with span("find_duplicates") as current:
+        groups, num_hashed = find_duplicates(
+            images_paths=images_paths,
+            hash_function=hash_function,
+            max_distance=max_distance,
+            decode_stats=decode_stats,
+        )
+        current.images = num_hashed
+
+    data_dir = Path(settings.data_dir).absolute()
+    report_groups = []
+    for kind, group in groups:
+        labels = sorted({Path(images_paths[idx]).parent.stem for idx in group})
+        if cross_label_only and len(labels) < 2:
+            continue
+        report_groups.append(
+            {
+                "kind": kind,
+                "labels": labels,
+                "files": [
+                    {
+                        "path": str(Path(images_paths[idx]).relative_to(data_dir)),
+                        "label": Path(images_paths[idx]).parent.stem,
+                    }
+                    for idx in group
+                ],
+            },
+        )
+
+    report = DuplicatesReport(
+        hash=hash_function,
+        max_distance=max_distance,
+        num_images=len(images_paths),
+        num_duplicates=sum(len(group["files"]) - 1 for group in report_groups),
+        groups=report_groups,
+    )
+
+    return report.json().encode(), {
+        **decode_stats.report(),
+        "hashed_images": str(num_hashed),
+    }
 
-    saved_image_path = compute_scatterplot(
-        images_paths=images_paths,
-        timestamp=timestamp,
+
+@router.get(
+    "/duplicates",
+    tags=["CV"],
+    status_code=status.HTTP_200_OK,
+)
+async def get_duplicates(
+    request: Request,
+    extension: Extension,
+    hash: PerceptualHash = PerceptualHash.phash,
+    max_distance: int = Query(4, ge=0, le=16),
+    cross_label_only: bool = False,
+):
+    """Find the groups of exact and near duplicates of an image dataset.
+
+    Every image is hashed once, by the SHA-256 of its file and by its aHash, dHash and
+    pHash, and the hashes are kept until the file changes. The files with the same
+    content, or whose `hash` differ by at most `max_distance` bits out of 64, are
+    grouped, with a multi-index search of the close hashes instead of comparing every
+    pair of images. With `cross_label_only`, only the groups spanning several labels are
+    returned. The result is cached until the dataset changes, and can be revalidated
+    with the `If-None-Match` header.
+    """
+
+    async def compute() -> Tuple[bytes, Dict[str, str]]:
+        return await run_in_thread(
+            _compute_duplicates,
+            extension=extension,
+            hash_function=hash,
+            max_distance=max_distance,
+            cross_label_only=cross_label_only,
+        )
+
+    return await _cached_dataset_response(
+        request=request,
+        endpoint="duplicates",
+        params={
+            "extension": extension.value,
+            "hash": hash.value,
+            "max_distance": max_distance,
+            "cross_label_only": cross_label_only,
+        },
+        compute=compute,
+        media_type="application/json",
     )
 
-    return FileResponse(saved_image_path)
+
+@router.get(
+    "/dataset_summary",
+    response_model=DatasetSummary,
+    status_code=status.HTTP_200_OK,
+    tags=["CV"],
+)
+async def get_dataset_summary(refresh: bool = True):
+    """Count the files of the image dataset by label and by extension.
+
+    The files are counted from the dataset index, refreshed first unless `refresh` is
+    false.
+    """
+    index = await run_in_thread(DatasetIndex, directory=settings.data_dir)
+    if refresh:
+        await run_in_thread(index.refresh)
+
+    files = await run_in_thread(index.query)
+
+    labels = Counter(item["label"] for item in files)
+    extensions = Counter(item["extension"] for item in files)
+
+    return DatasetSummary(
+        num_files=len(files),
+        total_size=sum(item["size"] for item in files),
+        labels=dict(labels),
+        extensions=dict(extensions),
+    )
@@ -1,14 +1,40 @@
+import io
+import os
+from pathlib import Path
+from typing import Dict, List, Optional
+
 import arrow
 import numpy as np
-from fastapi import APIRouter, status
-from fastapi.responses import FileResponse
+from fastapi import APIRouter, File, HTTPException, Query, UploadFile, status
+from fastapi.responses import Response
 from loguru import logger
-from tqdm import tqdm
+from PIL import UnidentifiedImageError
 
 from app.config import settings
-from app.dependancies.embedding_function import EmbeddingEngine
-from app.dependancies.utils import generate_batch, get_items_list
-from app.pydantic_models import ClusteringMode, EmbeddingsModel, Extension, Providers
+from app.dependancies.clustering import format_timings
+from app.dependancies.dataset_index import DatasetIndex
+from app.dependancies.decoding import DecodeStats
+from app.dependancies.embedding_cache import compute_embeddings
+from app.dependancies.embedding_function import (
+    EmbeddingEngine,
+    get_engine,
+    get_loaded_engines,
+)
+from app.dependancies.errors import ChannelNotFoundError, validate_rgb_images
+from app.dependancies.executors import run_in_process, run_in_thread
+from app.dependancies.metrics import observe_stage, span
+from app.dependancies.neighbours_index import NeighboursIndex
+from app.dependancies.reducer_store import dataset_key, project_with_stored_reducer
+from app.dependancies.utils import get_items_list, load_image_into_numpy_array
+from app.pydantic_models import (
+    ClusteringMode,
+    EmbeddingsModel,
+    EngineReport,
+    Extension,
+    NeighboursIndexReport,
+    NeighboursReport,
+    Providers,
+)
 
 router = APIRouter()
 
@@ -23,37 +49,100 @@ async def get_cnn_embedding(
     provider: Providers,
     extension: Extension,
     mode: ClusteringMode,
-    batch_size: int = 32,
+    batch_size: Optional[int] = Query(None, ge=1),
+    use_cache: bool = True,
+    sample_size: Optional[int] = Query(None, ge=2),
+    pca_components: Optional[int] = Query(None, ge=2),
+    seed: Optional[int] = None,
+    reuse_reducer: bool = False,
 ):
+    """Compute the clustering plot of the image dataset.
+
+    For large datasets, reduce the embeddings with a PCA of `pca_components` dimensions,
+    and fit the projection on a stratified subsample of `sample_size` images only : the
+    other images are projected afterwards. The time of each stage is returned in the
+    headers of the response.
+
+    Without `batch_size`, the batch size tuned for the host at the warm-up of the model
+    is used.
+
+    With `reuse_reducer`, the UMAP projection is stored and reused by the next requests :
+    only the new images are placed, until the dataset grew or drifted too much.
+
+    For large datasets, submit the computation with `/jobs/clustering` instead, to
+    follow its progress and avoid the request timeout.
+    """
 
     timestamp = arrow.now().format("YYYY-MM-DD_HH-mm-ss")
 
-    images_paths = get_items_list(
+    images_paths = await run_in_thread(
+        get_items_list,
         directory=settings.data_dir,
         extension=extension.value,
     )
 
-    engine = EmbeddingEngine(model=model, provider=provider)
-    logger.info("Model loaded.")
-
-    batches = generate_batch(lst=images_paths, batch_size=batch_size)
-    logits = []
+    engine = await run_in_thread(get_engine, model=model, provider=provider)
+    batch_size = batch_size or engine.batch_size
+    decode_stats = DecodeStats()
+    timings: Dict[str, float] = {}
 
-    for batch in tqdm(batches, total=np.ceil(len(images_paths) / batch_size)):
-        batch_logits = engine.infer(batch)
-        logits.append(batch_logits)
-    logits = np.vstack(logits)
-    logger.info("Inference done.")
+    with span("embed") as embed_span:
+        if use_cache:
+            logits, num_inferred, throughput = await run_in_thread(
+                compute_embeddings,
+                engine=engine,
+                images_paths=images_paths,
+                batch_size=batch_size,
+                decode_stats=decode_stats,
+            )
+        else:
+            logits, throughput = await run_in_thread(
+                engine.embed,
+                images_paths=images_paths,
+                batch_size=batch_size,
+                decode_stats=decode_stats,
+            )
+            num_inferred = len(images_paths)
+        embed_span.images = len(images_paths)
+    timings["embed_time"] = embed_span.duration
 
-    X_embedded = engine.compute_clustering(logits=logits, mode=mode)
     logger.info("Computing clustering.")
+    with span(f"{mode.name}_projection", images=len(images_paths)):
+        if reuse_reducer and mode == ClusteringMode.umap:
+            X_embedded, clustering_timings = await run_in_process(
+                project_with_stored_reducer,
+                logits=logits,
+                images_paths=images_paths,
+                model=model,
+                dataset=dataset_key(extension),
+                sample_size=sample_size,
+                pca_components=pca_components,
+                seed=seed,
+            )
+        else:
+            X_embedded, clustering_timings = await run_in_process(
+                EmbeddingEngine.compute_clustering,
+                logits=logits,
+                mode=mode,
+                labels=[Path(image_path).parent.stem for image_path in images_paths],
+                sample_size=sample_size,
+                pca_components=pca_components,
+                seed=seed,
+            )
+    timings.update(clustering_timings)
+    # the stages of the projection are timed in the process pool
+    for name, value in clustering_timings.items():
+        if name.endswith("_time"):
+            observe_stage(f"{mode.name}_{name[: -len('_time')]}", value)
 
-    saved_image_path = engine.plot(
-        logits=X_embedded,
-        images_paths=images_paths,
-        timestamp=timestamp,
-        mode=mode,
-    )
+    with span("plot_clustering") as plot_span:
+        clustering_plot = await run_in_process(
+            EmbeddingEngine.plot,
+            logits=X_embedded,
+            images_paths=images_paths,
+            mode=mode,
+        )
+    timings["plot_time"] = plot_span.duration
 
     config = {
         "model": model.value,
@@ -61,6 +150,236 @@ async def get_cnn_embedding(
         "extension": extension.value,
         "mode": mode.value,
         "timestamp": timestamp,
+        "load_time": f"{engine.load_time:.3f}",
+        "batch_size": str(batch_size),
+        "inferred": str(num_inferred),
+        "throughput": f"{throughput:.1f}",
+        **decode_stats.report(),
+        **format_timings(timings),
     }
 
-    return FileResponse(saved_image_path, headers=config)
+    return Response(content=clustering_plot, headers=config, media_type="image/png")
+
+
+@router.get(
+    "/engines",
+    response_model=List[EngineReport],
+    status_code=status.HTTP_200_OK,
+    tags=["clustering"],
+)
+async def get_engines():
+    """Return the embedding engines loaded in the worker, with their timings and batch size."""
+    return [
+        EngineReport(
+            model=engine.model_name.value,
+            provider=engine.provider_name.value,
+            profile=engine.profile_name,
+            load_time=engine.load_time,
+            warmup_time=engine.warmup_time,
+            batch_size=engine.batch_size,
+            batch_throughputs=engine.batch_throughputs,
+        )
+        for engine in get_loaded_engines()
+    ]
+
+
+def _dataset_path(image: str) -> Path:
+    # the paths are not resolved, like the paths of the dataset index and of the stores
+    relative = os.path.normpath(image)
+    image_path = Path(settings.data_dir).absolute() / relative
+
+    if (
+        os.path.isabs(relative)
+        or relative.split(os.sep)[0] == os.pardir
+        or not image_path.is_file()
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"No image {image} in the dataset.",
+        )
+
+    return image_path
+
+
+def _validate_upload(content: bytes) -> None:
+    try:
+        image = load_image_into_numpy_array(content)
+    except (UnidentifiedImageError, OSError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="The uploaded file is not an image.",
+        )
+
+    try:
+        validate_rgb_images(image[None])
+    except ChannelNotFoundError:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Expected an RGB image, got an image of shape {image.shape}.",
+        )
+
+
+def _neighbours_report(
+    model: EmbeddingsModel,
+    index: NeighboursIndex,
+    query: str,
+    embedding: np.ndarray,
+    k: int,
+    exclude: Optional[Path] = None,
+) -> NeighboursReport:
+    try:
+        with span("neighbours_query") as query_span:
+            state = index.refresh()
+            neighbours = index.query(
+                embedding[None],
+                k=k + int(exclude is not None),
+                state=state,
+            )[0]
+    except ValueError as err:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(err))
+    query_time = query_span.duration
+
+    data_dir = Path(settings.data_dir).absolute()
+    return NeighboursReport(
+        model=model,
+        query=query,
+        indexed=len(state["paths"]),
+        query_time=query_time,
+        neighbours=[
+            {
+                "path": os.path.relpath(path, data_dir),
+                "label": Path(path).parent.stem,
+                "distance": distance,
+            }
+            for path, distance in neighbours
+            if exclude is None or Path(path) != exclude
+        ][:k],
+    )
+
+
+@router.get(
+    "/neighbours",
+    response_model=NeighboursReport,
+    status_code=status.HTTP_200_OK,
+    tags=["clustering"],
+)
+async def get_image_neighbours(
+    model: EmbeddingsModel,
+    provider: Providers,
+    image: str,
+    k: int = Query(10, ge=1, le=1000),
+):
+    """Find the most similar images of the dataset to an image of the dataset.
+
+    `image` is the path of the image relative to the data directory, e.g. `label/1.png`.
+    The neighbours are searched in the nearest-neighbours index of the embeddings stored
+    for the model, by cosine distance. The embeddings computed since the last query, e.g.
+    by `/embedding/clustering`, are added to the index first.
+    """
+    image_path = await run_in_thread(_dataset_path, image)
+    engine = await run_in_thread(get_engine, model=model, provider=provider)
+
+    embeddings, _, _ = await run_in_thread(
+        compute_embeddings,
+        engine=engine,
+        images_paths=[image_path],
+        batch_size=1,
+    )
+
+    return await run_in_thread(
+        _neighbours_report,
+        model=model,
+        index=NeighboursIndex(model=model),
+        query=image,
+        embedding=embeddings[0],
+        k=k,
+        exclude=image_path,
+    )
+
+
+@router.post(
+    "/neighbours",
+    response_model=NeighboursReport,
+    status_code=status.HTTP_200_OK,
+    tags=["clustering"],
+)
+async def post_image_neighbours(
+    model: EmbeddingsModel,
+    provider: Providers,
+    file: UploadFile = File(...),
+    k: int = Query(10, ge=1, le=1000),
+):
+    """Find the most similar images of the dataset to an uploaded image.
+
+    See `GET /embedding/neighbours`. The uploaded image is not added to the index. A file
+    which is not an image is answered with a 400, an image without RGB channels, e.g. a
+    grayscale image, with a 422.
+    """
+    content = await file.read()
+    await run_in_thread(_validate_upload, content)
+    engine = await run_in_thread(get_engine, model=model, provider=provider)
+    embeddings = await run_in_thread(engine.infer, [io.BytesIO(content)])
+
+    return await run_in_thread(
+        _neighbours_report,
+        model=model,
+        index=NeighboursIndex(model=model),
+        query=file.filename,
+        embedding=embeddings[0],
+        k=k,
+    )
+
+
+@router.post(
+    "/neighbours_index",
+    response_model=NeighboursIndexReport,
+    status_code=status.HTTP_200_OK,
+    tags=["clustering"],
+)
+async def refresh_neighbours_index(
+    model: EmbeddingsModel,
+    provider: Providers,
+    extension: Extension,
+    batch_size: Optional[int] = Query(None, ge=1),
+):
+    """Embed the new images of the dataset, and add them to the nearest-neighbours index.
+
+    Only the images missing from the embeddings store, or changed since they were
+    embedded, go through the model. The embeddings of the images deleted from the dataset
+    are dropped from the store. The index is built on the first call, and updated
+    incrementally afterwards.
+    """
+    images_paths = await run_in_thread(
+        get_items_list,
+        directory=settings.data_dir,
+        extension=extension.value,
+    )
+    engine = await run_in_thread(get_engine, model=model, provider=provider)
+
+    _, num_inferred, _ = await run_in_thread(
+        compute_embeddings,
+        engine=engine,
+        images_paths=images_paths,
+        batch_size=batch_size or engine.batch_size,
+    )
+
+    # every extension of the dataset, the store is shared by all of them
+    dataset_paths = await run_in_thread(
+        DatasetIndex(directory=settings.data_dir).paths,
+    )
+    index = NeighboursIndex(model=model)
+    pruned = await run_in_thread(index.store.prune, dataset_paths)
+
+    try:
+        with span("neighbours_index_refresh") as refresh_span:
+            state = await run_in_thread(index.refresh)
+    except ValueError as err:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(err))
+
+    return NeighboursIndexReport(
+        model=model,
+        indexed=len(state["paths"]),
+        inferred=num_inferred,
+        pruned=pruned,
+        refresh_time=refresh_span.duration,
+    )
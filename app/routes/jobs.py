@@ -0,0 +1,224 @@
+from typing import Optional
+
+from fastapi import APIRouter, HTTPException, Query, status
+from fastapi.responses import FileResponse
+
+from app.dependancies.executors import run_in_thread
+from app.dependancies.jobs import get_job, submit_job
+from app.pydantic_models import (
+    ClusteringMode,
+    DeviationMetric,
+    EmbeddingsModel,
+    Extension,
+    JobKind,
+    JobReport,
+    JobStatus,
+    Providers,
+)
+
+router = APIRouter()
+
+
+@router.post(
+    "/dataset_mean_image",
+    response_model=JobReport,
+    status_code=status.HTTP_202_ACCEPTED,
+    tags=["Jobs"],
+)
+async def submit_dataset_mean_image(
+    extension: Extension,
+    scale: int = Query(1, ge=1),
+):
+    """Submit the computation of the mean image of the image dataset.
+
+    With `scale` > 1, the images are decoded at a reduced resolution, for an approximate
+    mean image, faster to compute.
+    """
+    return await run_in_thread(
+        submit_job,
+        kind=JobKind.dataset_mean_image,
+        params={"extension": extension.value, "scale": scale},
+    )
+
+
+@router.post(
+    "/mean_std_scatterplot",
+    response_model=JobReport,
+    status_code=status.HTTP_202_ACCEPTED,
+    tags=["Jobs"],
+)
+async def submit_mean_std_scatterplot(
+    extension: Extension,
+    scale: int = Query(1, ge=1),
+):
+    """Submit the computation of the mean vs std scatterplot of the image dataset.
+
+    With `scale` > 1, the images are decoded at a reduced resolution, for approximate
+    statistics, faster to compute.
+    """
+    return await run_in_thread(
+        submit_job,
+        kind=JobKind.mean_std_scatterplot,
+        params={"extension": extension.value, "scale": scale},
+    )
+
+
+@router.post(
+    "/eigenimages",
+    response_model=JobReport,
+    status_code=status.HTTP_202_ACCEPTED,
+    tags=["Jobs"],
+)
+async def submit_eigenimages(
+    extension: Extension,
+    per_label: bool = False,
+    n_components: int = Query(16, ge=1),
+    size: int = Query(64, ge=8, le=256),
+    batch_size: int = Query(256, ge=1),
+):
+    """Submit the computation of the eigenimages plot of the image dataset.
+
+    See `/eda/eigenimages` for the parameters.
+    """
+    return await run_in_thread(
+        submit_job,
+        kind=JobKind.eigenimages,
+        params={
+            "extension": extension.value,
+            "per_label": per_label,
+            "n_components": n_components,
+            "size": size,
+            "batch_size": batch_size,
+        },
+    )
+
+
+@router.post(
+    "/mean_image_deviations",
+    response_model=JobReport,
+    status_code=status.HTTP_202_ACCEPTED,
+    tags=["Jobs"],
+)
+async def submit_mean_image_deviations(
+    extension: Extension,
+    metric: DeviationMetric = DeviationMetric.l2,
+    top_k: int = Query(20, ge=1, le=500),
+    scale: int = Query(1, ge=1),
+):
+    """Submit the plot of the images deviating the most from the mean image of the dataset.
+
+    See `/eda/mean_image_deviations` for the parameters.
+    """
+    return await run_in_thread(
+        submit_job,
+        kind=JobKind.mean_image_deviations,
+        params={
+            "extension": extension.value,
+            "metric": metric.value,
+            "top_k": top_k,
+            "scale": scale,
+        },
+    )
+
+
+@router.post(
+    "/class_statistics",
+    response_model=JobReport,
+    status_code=status.HTTP_202_ACCEPTED,
+    tags=["Jobs"],
+)
+async def submit_class_statistics(
+    extension: Extension,
+    scale: int = Query(1, ge=1),
+):
+    """Submit the plot of the mean image of each label, and of their differences.
+
+    See `/eda/class_statistics` for the parameters.
+    """
+    return await run_in_thread(
+        submit_job,
+        kind=JobKind.class_statistics,
+        params={"extension": extension.value, "scale": scale},
+    )
+
+
+@router.post(
+    "/clustering",
+    response_model=JobReport,
+    status_code=status.HTTP_202_ACCEPTED,
+    tags=["Jobs"],
+)
+async def submit_clustering(
+    model: EmbeddingsModel,
+    provider: Providers,
+    extension: Extension,
+    mode: ClusteringMode,
+    batch_size: Optional[int] = Query(None, ge=1),
+    sample_size: Optional[int] = Query(None, ge=2),
+    pca_components: Optional[int] = Query(None, ge=2),
+    seed: Optional[int] = None,
+    reuse_reducer: bool = False,
+):
+    """Submit the computation of the clustering plot of the image dataset.
+
+    See `/embedding/clustering` for the subsampling, PCA and stored projection parameters.
+    """
+    return await run_in_thread(
+        submit_job,
+        kind=JobKind.clustering,
+        params={
+            "model": model.value,
+            "provider": provider.value,
+            "extension": extension.value,
+            "mode": mode.value,
+            "batch_size": batch_size,
+            "sample_size": sample_size,
+            "pca_components": pca_components,
+            "seed": seed,
+            "reuse_reducer": reuse_reducer,
+        },
+    )
+
+
+@router.get(
+    "/{job_id}",
+    response_model=JobReport,
+    status_code=status.HTTP_200_OK,
+    tags=["Jobs"],
+)
+async def get_job_status(job_id: str):
+    """Return the status and progress of a job."""
+    job = await run_in_thread(get_job, job_id)
+    if job is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Unknown job.",
+        )
+
+    return job
+
+
+@router.get(
+    "/{job_id}/result",
+    status_code=status.HTTP_200_OK,
+    tags=["Jobs"],
+)
+async def get_job_result(job_id: str):
+    """Return the result of a finished job."""
+    job = await run_in_thread(get_job, job_id)
+    if job is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Unknown job.",
+        )
+    if job["status"] != JobStatus.done.value:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Job is {job['status']}.",
+        )
+
+    return FileResponse(
+        job["result_path"],
+        headers=job["headers"],
+        media_type=job.get("media_type"),
+    )
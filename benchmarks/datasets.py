@@ -0,0 +1,89 @@
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+from PIL import Image
+
+# Quality of the generated JPEG images, close to the one of the usual datasets.
+JPEG_QUALITY = 90
+
+
+def synthetic_image(
+    rng: np.random.Generator,
+    size: Tuple[int, int],
+    base_color: np.ndarray,
+) -> np.ndarray:
+    """Draw an RGB image with the structure of a photograph, rather than pure noise.
+
+    The image is a gradient around the color of its label, with a bright disk and some
+    sensor-like noise, so it compresses, and decodes, like a real image.
+
+    Args:
+        rng (np.random.Generator): The random generator.
+        size (Tuple[int, int]): The (width, height) of the image.
+        base_color (np.ndarray): The mean RGB color of the label, of shape (3,).
+
+    Returns:
+        np.ndarray: The uint8 image, of shape (height, width, 3).
+    """
+    width, height = size
+    rows = np.linspace(-1, 1, height, dtype=np.float32)[:, np.newaxis, np.newaxis]
+    cols = np.linspace(-1, 1, width, dtype=np.float32)[np.newaxis, :, np.newaxis]
+
+    slope = rng.normal(scale=40, size=(2, 3)).astype(np.float32)
+    image = base_color + slope[0] * rows + slope[1] * cols
+
+    center = rng.uniform(-0.6, 0.6, size=2)
+    radius = rng.uniform(0.1, 0.4)
+    disk = (rows - center[0]) ** 2 + (cols - center[1]) ** 2 < radius**2
+    image = np.where(disk, image + 60, image)
+
+    image += rng.normal(scale=8, size=image.shape).astype(np.float32)
+
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def generate_dataset(
+    directory: Path,
+    num_images: int,
+    size: Tuple[int, int] = (256, 256),
+    extension: str = ".jpg",
+    num_labels: int = 4,
+    seed: int = 0,
+) -> List[Path]:
+    """Write a labelled synthetic image dataset, laid out like `settings.data_dir`.
+
+    The images are spread evenly over `num_labels` directories, `label_0`, `label_1`...
+    The same arguments always give the same files.
+
+    Args:
+        directory (Path): The root directory of the dataset, created if needed.
+        num_images (int): The number of images.
+        size (Tuple[int, int], optional): The (width, height) of the images.
+            Defaults to (256, 256).
+        extension (str, optional): The format of the images, ".jpg" or ".png".
+            Defaults to ".jpg".
+        num_labels (int, optional): The number of labels. Defaults to 4.
+        seed (int, optional): The seed of the images. Defaults to 0.
+
+    Returns:
+        List[Path]: The sorted paths of the images.
+    """
+    rng = np.random.default_rng(seed)
+    base_colors = rng.uniform(60, 190, size=(num_labels, 3)).astype(np.float32)
+
+    paths = []
+    for idx in range(num_images):
+        label = idx % num_labels
+        label_dir = Path(directory) / f"label_{label}"
+        label_dir.mkdir(parents=True, exist_ok=True)
+
+        path = label_dir / f"image_{idx:06d}{extension}"
+        image = Image.fromarray(synthetic_image(rng, size, base_colors[label]))
+        if extension == ".jpg":
+            image.save(path, quality=JPEG_QUALITY)
+        else:
+            image.save(path)
+        paths.append(path)
+
+    return sorted(paths)
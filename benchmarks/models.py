@@ -0,0 +1,78 @@
+from pathlib import Path
+
+import numpy as np
+import onnx
+from onnx import TensorProto, helper, numpy_helper
+
+from app.dependancies.embedding_function import INPUT_SIZE
+
+# Side of the patches the stand-in model convolves, with no overlap.
+PATCH_SIZE = 8
+
+
+def build_tiny_model(path: Path, embedding_dim: int = 64, seed: int = 0) -> Path:
+    """Write a tiny ONNX model with the interface of the embedding models.
+
+    Like the Keras ResNet50v2, the model takes an NHWC float32 "input" batch of
+    224x224 images and returns its embeddings as "avg_pool", so `EmbeddingEngine` runs
+    it unchanged. It is a single strided convolution followed by a global average
+    pooling, and runs offline, with no model to download.
+
+    Args:
+        path (Path): The path of the model file.
+        embedding_dim (int, optional): The dimension of the embeddings. Defaults to 64.
+        seed (int, optional): The seed of the weights. Defaults to 0.
+
+    Returns:
+        Path: The path of the model file.
+    """
+    rng = np.random.default_rng(seed)
+    weights = rng.normal(scale=0.1, size=(embedding_dim, 3, PATCH_SIZE, PATCH_SIZE))
+    bias = np.zeros(embedding_dim)
+
+    nodes = [
+        helper.make_node("Transpose", ["input"], ["nchw"], perm=[0, 3, 1, 2]),
+        helper.make_node(
+            "Conv",
+            ["nchw", "weights", "bias"],
+            ["features"],
+            kernel_shape=[PATCH_SIZE, PATCH_SIZE],
+            strides=[PATCH_SIZE, PATCH_SIZE],
+        ),
+        helper.make_node("Relu", ["features"], ["activations"]),
+        helper.make_node("GlobalAveragePool", ["activations"], ["pooled"]),
+        helper.make_node("Flatten", ["pooled"], ["avg_pool"], axis=1),
+    ]
+    graph = helper.make_graph(
+        nodes,
+        "tiny_embedding",
+        inputs=[
+            helper.make_tensor_value_info(
+                "input",
+                TensorProto.FLOAT,
+                ["batch", *INPUT_SIZE, 3],
+            ),
+        ],
+        outputs=[
+            helper.make_tensor_value_info(
+                "avg_pool",
+                TensorProto.FLOAT,
+                ["batch", embedding_dim],
+            ),
+        ],
+        initializer=[
+            numpy_helper.from_array(weights.astype(np.float32), "weights"),
+            numpy_helper.from_array(bias.astype(np.float32), "bias"),
+        ],
+    )
+
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)])
+    # the IR version of onnx 1.12, read by every supported onnxruntime
+    model.ir_version = 8
+    onnx.checker.check_model(model)
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    onnx.save(model, str(path))
+
+    return path
@@ -0,0 +1,426 @@
+"""Benchmark the EDA functions and the embedding engine on a synthetic dataset.
+
+Record a baseline on a reference commit, then compare a later run against it:
+
+    python -m benchmarks.run --save-baseline
+    python -m benchmarks.run
+"""
+import argparse
+import json
+import multiprocessing
+import platform
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List
+
+import numpy as np
+import onnxruntime as rt
+import PIL
+from loguru import logger
+
+from app.config import settings
+from app.dependancies.decoding import load_array
+from app.dependancies.eda_functions import (
+    accumulate_images_sum,
+    compute_dataset_channels_stats,
+    compute_histograms_channels,
+    encode_mean_image,
+    plot_scatterplot,
+)
+from app.dependancies.embedding_function import EmbeddingEngine, get_engine
+from app.dependancies.utils import generate_batch
+from app.pydantic_models import EmbeddingsModel, Providers
+from benchmarks.datasets import generate_dataset
+from benchmarks.models import build_tiny_model
+
+DEFAULT_BASELINE = Path(__file__).parent / "baseline.json"
+
+
+def peak_rss_mb() -> float:
+    """Return the peak resident set size of the process, in MiB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / (1 << 10)
+
+
+class StageTimer:
+    """Wall-clock time of the stages of a benchmark, summed over each repetition."""
+
+    def __init__(self) -> None:
+        self.repeats: List[Dict[str, float]] = []
+
+    def new_repeat(self) -> None:
+        """Start the timings of a new repetition."""
+        self.repeats.append({})
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Add the time spent in the `with` block to a stage of the current repeat."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            current = self.repeats[-1]
+            current[name] = current.get(name, 0.0) + time.perf_counter() - start
+
+    def medians(self) -> Dict[str, float]:
+        """Return the median time, in seconds, of each stage over the repetitions."""
+        return {
+            name: statistics.median(repeat[name] for repeat in self.repeats)
+            for name in self.repeats[0]
+        }
+
+
+def _mean_image(
+    images_paths: List[Path],
+    config: Dict[str, Any],
+    timer: StageTimer,
+) -> int:
+    # the stages of `compute_mean_image`
+    with timer.stage("decode_and_sum"):
+        images_sum, num_images = accumulate_images_sum(images_paths)
+    with timer.stage("encode"):
+        encode_mean_image(images_sum=images_sum, num_images=num_images)
+    return len(images_paths)
+
+
+def _scatterplot(
+    images_paths: List[Path],
+    config: Dict[str, Any],
+    timer: StageTimer,
+) -> int:
+    # the stages of `compute_scatterplot`
+    with timer.stage("channels_stats"):
+        stats = compute_dataset_channels_stats(images_paths)
+    with timer.stage("plot"):
+        plot_scatterplot(stats=stats, images_paths=images_paths)
+    return len(images_paths)
+
+
+def _histograms(
+    images_paths: List[Path],
+    config: Dict[str, Any],
+    timer: StageTimer,
+) -> int:
+    images_paths = images_paths[: config["histogram_images"]]
+    for image_path in images_paths:
+        with timer.stage("decode"):
+            image = load_array(image_path)
+        with timer.stage("histograms_plot"):
+            compute_histograms_channels(image=image, filename=image_path.stem)
+    return len(images_paths)
+
+
+def _embedding_engine(config: Dict[str, Any]) -> EmbeddingEngine:
+    settings.set("resnet50v2", config["model_path"])
+    settings.set("optimized_models_dir", config["optimized_models_dir"])
+    settings.set("batch_autotune", False)
+    return get_engine(
+        model=EmbeddingsModel.resnet50v2,
+        provider=Providers.cpu,
+        warmup=True,
+    )
+
+
+def _embedding_infer(
+    images_paths: List[Path],
+    config: Dict[str, Any],
+    timer: StageTimer,
+) -> int:
+    engine = _embedding_engine(config)
+    for batch in generate_batch(lst=images_paths, batch_size=config["batch_size"]):
+        with timer.stage("infer"):
+            engine.infer(batch)
+    return len(images_paths)
+
+
+def _embedding_embed(
+    images_paths: List[Path],
+    config: Dict[str, Any],
+    timer: StageTimer,
+) -> int:
+    engine = _embedding_engine(config)
+    with timer.stage("embed"):
+        engine.embed(images_paths=images_paths, batch_size=config["batch_size"])
+    return len(images_paths)
+
+
+# The benchmarks, each one returns the number of images it processed.
+CASES: Dict[str, Callable[[List[Path], Dict[str, Any], StageTimer], int]] = {
+    "mean_image": _mean_image,
+    "scatterplot": _scatterplot,
+    "histograms": _histograms,
+    "embedding_infer": _embedding_infer,
+    "embedding_embed": _embedding_embed,
+}
+
+
+def run_case(
+    name: str,
+    images_paths: List[Path],
+    config: Dict[str, Any],
+) -> Dict[str, Any]:
+    """Run a benchmark, meant to be called in a fresh process to measure its peak RSS.
+
+    The benchmark is run `config["warmup"]` times untimed, to fill the caches and load
+    the model, then `config["repeat"]` times.
+
+    Args:
+        name (str): The name of the benchmark, one of `CASES`.
+        images_paths (List[Path]): The paths of the images of the dataset.
+        config (Dict[str, Any]): The configuration of the run, see `run_benchmarks`.
+
+    Returns:
+        Dict[str, Any]: The number of images, the throughput, in images/s, and the
+            total time of a repetition, the median time of each stage, the time of the
+            setup (e.g. the ONNX session creation), and the peak RSS, in MiB, before and
+            after the benchmark.
+    """
+    case = CASES[name]
+    rss_before = peak_rss_mb()
+
+    setup = {}
+    if name.startswith("embedding"):
+        engine = _embedding_engine(config)
+        setup = {"session": engine.load_time, "warmup": engine.warmup_time}
+
+    for _ in range(config["warmup"]):
+        warmup_timer = StageTimer()
+        warmup_timer.new_repeat()
+        case(images_paths, config, warmup_timer)
+
+    timer = StageTimer()
+    totals = []
+    for _ in range(config["repeat"]):
+        timer.new_repeat()
+        start = time.perf_counter()
+        num_images = case(images_paths, config, timer)
+        totals.append(time.perf_counter() - start)
+
+    total = statistics.median(totals)
+    return {
+        "images": num_images,
+        "throughput": num_images / total,
+        "total_time": total,
+        "stages": timer.medians(),
+        "setup": setup,
+        "rss_before_mb": rss_before,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def environment() -> Dict[str, Any]:
+    """Describe the host and the versions the benchmarks ran with."""
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": multiprocessing.cpu_count(),
+        "numpy": np.__version__,
+        "onnxruntime": rt.__version__,
+        "pillow": PIL.__version__,
+    }
+
+
+def run_benchmarks(
+    config: Dict[str, Any],
+    cases: List[str],
+) -> Dict[str, Any]:
+    """Generate the synthetic dataset and the stand-in model, and run the benchmarks.
+
+    Each benchmark runs in its own spawned process, so their peak RSS are measured
+    separately, and none of them warms up the caches of the next.
+
+    Args:
+        config (Dict[str, Any]): The number of images, their width, height, extension
+            and number of labels, the seed of the dataset, the number of warm-up and
+            timed repetitions, the inference batch size, and the number of images of the
+            histograms benchmark.
+        cases (List[str]): The names of the benchmarks to run, see `CASES`.
+
+    Returns:
+        Dict[str, Any]: The environment, the configuration, and the results of each
+            benchmark, see `run_case`.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="eda-cv-benchmarks-") as workdir:
+        start = time.perf_counter()
+        images_paths = generate_dataset(
+            directory=Path(workdir) / "data",
+            num_images=config["num_images"],
+            size=(config["width"], config["height"]),
+            extension=config["extension"],
+            num_labels=config["num_labels"],
+            seed=config["seed"],
+        )
+        model_path = build_tiny_model(Path(workdir) / "tiny.onnx")
+        logger.info(
+            f"Synthetic dataset of {len(images_paths)} images generated in "
+            + f"{time.perf_counter() - start:.1f}s.",
+        )
+
+        case_config = {
+            **config,
+            "model_path": str(model_path),
+            "optimized_models_dir": str(Path(workdir) / "optimized_models"),
+        }
+        context = multiprocessing.get_context("spawn")
+        for name in cases:
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                results[name] = pool.submit(
+                    run_case,
+                    name,
+                    images_paths,
+                    case_config,
+                ).result()
+            logger.info(
+                f"{name} : {results[name]['throughput']:.1f} images/s, "
+                + f"peak RSS {results[name]['peak_rss_mb']:.0f} MiB.",
+            )
+
+    return {"environment": environment(), "config": config, "cases": results}
+
+
+def compare_results(
+    results: Dict[str, Any],
+    baseline: Dict[str, Any],
+    tolerance: float = 0.15,
+    rss_tolerance: float = 0.2,
+    min_stage_time: float = 0.01,
+) -> List[str]:
+    """Flag the regressions of a run against a baseline run.
+
+    A benchmark regresses when its throughput drops by more than `tolerance`, when one
+    of its stages taking at least `min_stage_time` seconds slows down by more than
+    `tolerance`, or when its peak RSS grows by more than `rss_tolerance`. The
+    benchmarks missing from the baseline are not compared.
+
+    Args:
+        results (Dict[str, Any]): The run, see `run_benchmarks`.
+        baseline (Dict[str, Any]): The baseline run.
+        tolerance (float, optional): The relative slowdown tolerated. Defaults to 0.15.
+        rss_tolerance (float, optional): The relative peak RSS growth tolerated.
+            Defaults to 0.2.
+        min_stage_time (float, optional): The time, in seconds, under which a stage is
+            too noisy to be compared. Defaults to 0.01.
+
+    Raises:
+        ValueError: If the run and the baseline do not have the same configuration.
+
+    Returns:
+        List[str]: A description of each regression.
+    """
+    if results["config"] != baseline["config"]:
+        raise ValueError("The benchmarks configuration differs from the baseline one.")
+
+    regressions = []
+    for name, case in results["cases"].items():
+        reference = baseline["cases"].get(name)
+        if reference is None:
+            continue
+
+        if case["throughput"] < reference["throughput"] * (1 - tolerance):
+            regressions.append(
+                f"{name} throughput : {reference['throughput']:.1f} -> "
+                + f"{case['throughput']:.1f} images/s",
+            )
+
+        for stage, elapsed in case["stages"].items():
+            before = reference["stages"].get(stage)
+            if before is None or max(before, elapsed) < min_stage_time:
+                continue
+            if elapsed > before * (1 + tolerance):
+                regressions.append(
+                    f"{name} {stage} stage : {before:.3f} -> {elapsed:.3f}s",
+                )
+
+        if case["peak_rss_mb"] > reference["peak_rss_mb"] * (1 + rss_tolerance):
+            regressions.append(
+                f"{name} peak RSS : {reference['peak_rss_mb']:.0f} -> "
+                + f"{case['peak_rss_mb']:.0f} MiB",
+            )
+
+    return regressions
+
+
+def print_summary(results: Dict[str, Any]) -> None:
+    """Print the throughput, peak RSS and stages of each benchmark."""
+    print(f"{'benchmark':<18}{'images/s':>10}{'peak RSS':>10}  stages (s)")
+    for name, case in results["cases"].items():
+        stages = ", ".join(
+            f"{stage} {elapsed:.3f}" for stage, elapsed in case["stages"].items()
+        )
+        print(
+            f"{name:<18}{case['throughput']:>10.1f}"
+            + f"{case['peak_rss_mb']:>7.0f} MiB  {stages}",
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cases", nargs="+", choices=list(CASES), default=list(CASES))
+    parser.add_argument("--images", type=int, default=256)
+    parser.add_argument("--width", type=int, default=256)
+    parser.add_argument("--height", type=int, default=256)
+    parser.add_argument("--extension", choices=[".jpg", ".png"], default=".jpg")
+    parser.add_argument("--labels", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--histogram-images", type=int, default=16)
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--output", type=Path, default=None)
+    parser.add_argument("--tolerance", type=float, default=0.15)
+    parser.add_argument("--rss-tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    benchmarks = run_benchmarks(
+        config={
+            "num_images": args.images,
+            "width": args.width,
+            "height": args.height,
+            "extension": args.extension,
+            "num_labels": args.labels,
+            "seed": args.seed,
+            "warmup": args.warmup,
+            "repeat": args.repeat,
+            "batch_size": args.batch_size,
+            "histogram_images": args.histogram_images,
+        },
+        cases=args.cases,
+    )
+    print_summary(benchmarks)
+
+    if args.output is not None:
+        args.output.write_text(json.dumps(benchmarks, indent=2))
+
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps(benchmarks, indent=2))
+        logger.info(f"Baseline saved to {args.baseline}.")
+        sys.exit(0)
+
+    if not args.baseline.exists():
+        logger.warning(
+            f"No baseline at {args.baseline}, run with --save-baseline first.",
+        )
+        sys.exit(0)
+
+    found = compare_results(
+        results=benchmarks,
+        baseline=json.loads(args.baseline.read_text()),
+        tolerance=args.tolerance,
+        rss_tolerance=args.rss_tolerance,
+    )
+    for regression in found:
+        logger.error(f"Regression, {regression}.")
+    if found:
+        sys.exit(1)
+    logger.info("No regression against the baseline.")
@@ -0,0 +1,63 @@
+import copy
+
+import numpy as np
+import onnxruntime as rt
+import pytest
+from PIL import Image
+
+from benchmarks.datasets import generate_dataset
+from benchmarks.models import build_tiny_model
+from benchmarks.run import compare_results
+
+
+def test_synthetic_dataset_is_reproducible(tmp_path):
+    paths = generate_dataset(tmp_path / "a", num_images=6, size=(40, 30), num_labels=3)
+    again = generate_dataset(tmp_path / "b", num_images=6, size=(40, 30), num_labels=3)
+
+    assert sorted({path.parent.name for path in paths}) == [
+        "label_0",
+        "label_1",
+        "label_2",
+    ]
+    assert Image.open(paths[0]).size == (40, 30)
+    assert [path.read_bytes() for path in paths] == [
+        path.read_bytes() for path in again
+    ]
+
+
+def test_tiny_model_has_the_embedding_interface(tmp_path):
+    session = rt.InferenceSession(
+        str(build_tiny_model(tmp_path / "tiny.onnx", embedding_dim=16)),
+        providers=["CPUExecutionProvider"],
+    )
+
+    embeddings = session.run(
+        ["avg_pool"],
+        {"input": np.random.rand(3, 224, 224, 3).astype(np.float32)},
+    )[0]
+    assert embeddings.shape == (3, 16)
+
+
+def test_compare_results_flags_regressions():
+    baseline = {
+        "config": {"num_images": 8},
+        "cases": {
+            "mean_image": {
+                "throughput": 100.0,
+                "stages": {"decode_and_sum": 0.5, "encode": 0.001},
+                "peak_rss_mb": 100.0,
+            },
+        },
+    }
+    results = copy.deepcopy(baseline)
+    assert compare_results(results, baseline) == []
+
+    case = results["cases"]["mean_image"]
+    case["throughput"] = 50.0
+    case["stages"] = {"decode_and_sum": 1.0, "encode": 0.005}
+    case["peak_rss_mb"] = 200.0
+    assert len(compare_results(results, baseline)) == 3
+
+    results["config"] = {"num_images": 16}
+    with pytest.raises(ValueError):
+        compare_results(results, baseline)
@@ -0,0 +1,834 @@
+import asyncio
+import io
+import os
+import resource
+import tarfile
+import threading
+import time
+from pathlib import Path
+from typing import List
+
+import matplotlib.pyplot as plt
+import numpy as np
+import pytest
+from PIL import Image
+
+from app.config import settings
+from app.dependancies import metrics, rendering
+from app.dependancies.clustering import compute_projection, stratified_sample
+from app.dependancies.dataset_index import DatasetIndex
+from app.dependancies.decoding import DecodeStats, open_image
+from app.dependancies.deviation import deviation_scores, rank_deviations
+from app.dependancies.duplicates import find_duplicates, hamming_distance, near_pairs
+from app.dependancies.eda_functions import (
+    accumulate_class_sums,
+    accumulate_images_sum,
+    compute_batch_channels_stats,
+    compute_channels_histograms,
+    compute_channels_stats,
+    compute_contrast_images,
+    compute_dataset_channels_stats,
+    compute_histograms_channels,
+    compute_images_channels_stats,
+)
+from app.dependancies.eigenimages import compute_eigenimages, load_grayscale
+from app.dependancies.embedding_cache import EmbeddingStore
+from app.dependancies.embedding_function import EmbeddingEngine
+from app.dependancies.errors import (
+    ChannelNotFoundError,
+    EmptyDatasetError,
+    HeightWidthMismatchError,
+    InvalidArchiveError,
+)
+from app.dependancies.executors import (
+    call_in_process,
+    get_executors_stats,
+    run_in_process,
+    shard_pool_size,
+    shutdown_executors,
+)
+from app.dependancies.metrics import (
+    MetricsRegistry,
+    aggregate_metrics,
+    clear_metrics,
+    get_registry,
+    merge_worker_metrics,
+    render_prometheus,
+    span,
+)
+from app.dependancies.neighbours_index import NeighboursIndex
+from app.dependancies.quantization import neighbour_overlap
+from app.dependancies.reducer_store import project_with_stored_reducer
+from app.dependancies.result_cache import ResultCache, dataset_cache_key
+from app.dependancies.sessions import (
+    GRAPH_OPTIMIZATION_LEVELS,
+    create_session,
+    optimized_models_dir,
+)
+from app.dependancies.sharding import sharded_channels_stats, sharded_images_sum
+from app.dependancies.utils import decode_images, iter_archive_files
+from app.pydantic_models import (
+    ArchiveFormat,
+    ClusteringMode,
+    DeviationMetric,
+    DuplicateKind,
+    EmbeddingsModel,
+    Providers,
+)
+from benchmarks.models import build_tiny_model
+
+
+def write_images(directory: Path, shapes: List[tuple], seed: int = 0) -> List[Path]:
+    rng = np.random.default_rng(seed)
+    paths = []
+    for idx, shape in enumerate(shapes):
+        path = directory / f"image_{idx}.png"
+        Image.fromarray(rng.integers(0, 256, size=shape, dtype=np.uint8)).save(path)
+        paths.append(path)
+    return paths
+
+
+def test_accumulate_images_sum_matches_in_memory_mean(tmp_path):
+    paths = write_images(tmp_path, [(16, 12, 3)] * 5)
+
+    images_sum, num_images = accumulate_images_sum(paths)
+
+    images_list = [np.array(Image.open(path), dtype=np.float32) for path in paths]
+    expected = np.round(sum(images_list) / len(images_list))
+    assert num_images == 5
+    assert np.array_equal(np.round(images_sum / num_images), expected)
+
+
+def test_accumulate_images_sum_rejects_size_mismatch(tmp_path):
+    paths = write_images(tmp_path, [(16, 12, 3), (12, 16, 3)])
+
+    with pytest.raises(HeightWidthMismatchError):
+        accumulate_images_sum(paths)
+
+
+def test_compute_channels_stats_matches_numpy():
+    rng = np.random.default_rng(1)
+    image = rng.integers(0, 256, size=(33, 17, 3), dtype=np.uint8)
+
+    stats = compute_channels_stats(image)
+
+    expected = [image[:, :, channel].mean() for channel in range(3)] + [
+        image[:, :, channel].std() for channel in range(3)
+    ]
+    assert np.allclose(stats, expected)
+
+    grayscale = rng.integers(0, 256, size=(6, 9), dtype=np.uint8)
+    for gray_image in (grayscale, grayscale.astype(np.float32)):
+        with pytest.raises(ChannelNotFoundError):
+            compute_channels_stats(gray_image)
+
+
+def test_compute_batch_channels_stats_matches_single_image_kernel():
+    rng = np.random.default_rng(2)
+    images = rng.integers(0, 256, size=(4, 20, 10, 3), dtype=np.uint8)
+
+    batch_stats = compute_batch_channels_stats(images)
+
+    assert batch_stats.shape == (4, 6)
+    for image, stats in zip(images, batch_stats):
+        assert np.allclose(stats, compute_channels_stats(image))
+        assert np.allclose(
+            stats,
+            compute_channels_stats(image.astype(np.float32)),
+            atol=1e-4,
+        )
+
+
+def test_embedding_store_only_misses_new_or_changed_images(tmp_path):
+    paths = write_images(tmp_path, [(8, 8, 3)] * 3)
+    store = EmbeddingStore(
+        EmbeddingsModel.resnet50v2,
+        directory=str(tmp_path / "store"),
+    )
+    embeddings = np.arange(6, dtype=np.float32).reshape(3, 2)
+
+    store.update(paths[:2], embeddings[:2])
+    stored, missing = store.lookup(paths)
+    assert np.array_equal(stored, embeddings[:2])
+    assert missing == [2]
+
+    store.update(paths[2:], embeddings[2:])
+    Image.new("RGB", (9, 9)).save(paths[0])
+    stored, missing = store.lookup(paths)
+    assert np.array_equal(stored, embeddings[1:])
+    assert missing == [0]
+
+    # an image deleted after the dataset was listed is a miss, and dropped
+    store.update(paths[:1], embeddings[:1])
+    paths[1].unlink()
+    stored, missing = store.lookup(paths)
+    assert np.array_equal(stored, embeddings[[0, 2]])
+    assert missing == [1]
+    assert np.load(store.embeddings_path).shape == (2, 2)
+    store.update(paths[:2], embeddings[:2])
+    assert np.load(store.embeddings_path).shape == (2, 2)
+
+
+def test_run_in_process_falls_back_to_threads(monkeypatch):
+    monkeypatch.setattr(settings, "process_pool_workers", 0)
+
+    # a lambda cannot be pickled, so it can only run in the thread pool
+    thread_name = asyncio.run(run_in_process(lambda: threading.current_thread().name))
+
+    assert thread_name.startswith("eda")
+
+
+def test_call_in_process_runs_in_the_process_pool(monkeypatch):
+    monkeypatch.setattr(settings, "process_pool_workers", 1)
+    submitted = get_executors_stats()[1]["submitted"]
+
+    try:
+        pid = call_in_process(os.getpid)
+    finally:
+        shutdown_executors()
+
+    assert pid != os.getpid()
+    assert get_executors_stats()[1]["submitted"] == submitted + 1
+
+
+def test_dataset_index_tracks_added_and_removed_files(tmp_path):
+    data_dir = tmp_path / "data"
+    (data_dir / "cat").mkdir(parents=True)
+    (data_dir / "dog").mkdir()
+    write_images(data_dir / "cat", [(8, 8, 3)] * 2)
+    dog_paths = write_images(data_dir / "dog", [(6, 4, 3)])
+    index = DatasetIndex(str(data_dir), index_dir=str(tmp_path / "index"))
+
+    index.refresh()
+    expected = sorted(path.absolute() for path in data_dir.glob("**/*.png"))
+    assert index.paths(extension=".png") == expected
+    assert index.query(label="dog")[0]["width"] == 4
+
+    dog_paths[0].unlink()
+    (data_dir / "bird").mkdir()
+    write_images(data_dir / "bird", [(8, 8, 3)])
+    # a link to a parent directory is not followed
+    (data_dir / "cat" / "loop").symlink_to(data_dir)
+    assert index.refresh(force=True) == 2
+
+    assert index.paths(label="dog") == []
+    assert len(index.paths(label="bird")) == 1
+    assert len(index.paths(extension=".jpg")) == 0
+    assert len(index.paths()) == 3
+
+
+def test_compute_channels_histograms_counts_every_pixel_value():
+    rng = np.random.default_rng(3)
+    image = rng.integers(0, 256, size=(40, 30, 3), dtype=np.uint8)
+    image[0, 0] = 255
+
+    histograms = compute_channels_histograms(image)
+
+    assert histograms.shape == (3, 256)
+    assert np.allclose(histograms.sum(axis=1), 1)
+    for channel in range(3):
+        expected = np.bincount(image[:, :, channel].ravel(), minlength=256)
+        assert np.allclose(histograms[channel], expected / expected.sum())
+
+
+def test_repeated_renders_reuse_one_figure():
+    image = np.random.default_rng(0).integers(0, 256, size=(32, 32, 3), dtype=np.uint8)
+    compute_histograms_channels(image, filename="warmup")
+    figure = rendering._FIGURES.figures["histograms"]
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    for idx in range(200):
+        assert compute_histograms_channels(image, filename=str(idx))[:4] == b"\x89PNG"
+
+    assert plt.get_fignums() == []
+    assert rendering._FIGURES.figures["histograms"] is figure
+    assert figure.axes == []
+    # in KiB, a leaked figure and its canvas weigh a few MiB each
+    assert resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - peak_rss < 50 * 1024
+
+
+def test_result_cache_evicts_least_recently_used(tmp_path):
+    cache = ResultCache(directory=str(tmp_path), max_bytes=10)
+
+    cache.put("first", b"1234", "image/png")
+    cache.put("second", b"5678", "image/png")
+    assert cache.get("first") == (b"1234", "image/png")
+    cache.put("third", b"9012", "image/png")
+
+    assert cache.get("second") is None
+    assert cache.get("first") is not None
+    assert cache.get("third") is not None
+
+
+def test_dataset_cache_key_changes_with_images_rewritten_in_place(
+    tmp_path,
+    monkeypatch,
+):
+    data_dir = tmp_path / "data"
+    (data_dir / "label").mkdir(parents=True)
+    paths = write_images(data_dir / "label", [(8, 8, 3)] * 2)
+    monkeypatch.setattr(settings, "data_dir", str(data_dir))
+    monkeypatch.setattr(settings, "dataset_index_dir", str(tmp_path / "index"))
+    params = {"extension": ".png"}
+    key = dataset_cache_key(endpoint="dataset_mean_image", params=params)
+
+    # past the refresh interval, the directory is still not rescanned
+    monkeypatch.setattr(settings, "dataset_index_refresh_interval", 0.0)
+    directory_mtime = os.stat(data_dir / "label").st_mtime_ns
+    Image.new("RGB", (8, 8), color=(255, 0, 0)).save(paths[0])
+    mtime_ns = os.stat(paths[0]).st_mtime_ns + 10**9
+    os.utime(paths[0], ns=(mtime_ns, mtime_ns))
+    assert os.stat(data_dir / "label").st_mtime_ns == directory_mtime
+
+    new_key = dataset_cache_key(endpoint="dataset_mean_image", params=params)
+    assert new_key != key
+    assert dataset_cache_key(endpoint="dataset_mean_image", params=params) == new_key
+
+
+def test_tar_archive_stats_match_per_image_stats(tmp_path):
+    paths = write_images(tmp_path, [(8, 8, 3), (8, 8, 3), (5, 7, 3)])
+    (tmp_path / "notes.txt").write_text("not an image")
+
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as archive:
+        for path in paths + [tmp_path / "notes.txt"]:
+            archive.add(path, arcname=path.name)
+    buffer.seek(0)
+
+    skipped = []
+    names, stats = compute_images_channels_stats(
+        decode_images(iter_archive_files(buffer, ArchiveFormat.tar), skipped=skipped),
+        batch_size=2,
+    )
+
+    assert names == [path.name for path in paths]
+    assert skipped == ["notes.txt"]
+    for path, row in zip(paths, stats):
+        image = np.array(Image.open(path))
+        np.testing.assert_allclose(row, compute_channels_stats(image))
+
+
+def test_corrupt_archives_are_rejected(tmp_path):
+    paths = write_images(tmp_path, [(32, 32, 3)] * 3)
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as archive:
+        for path in paths:
+            archive.add(path, arcname=path.name)
+    truncated = buffer.getvalue()[: len(buffer.getvalue()) // 2]
+
+    for data, archive_format in (
+        (truncated, ArchiveFormat.tar),
+        (b"not an archive" * 64, ArchiveFormat.tar),
+        (truncated, ArchiveFormat.zip),
+    ):
+        with pytest.raises(InvalidArchiveError):
+            list(iter_archive_files(io.BytesIO(data), archive_format))
+
+
+def test_open_image_reduces_jpeg_with_dct_scaling(tmp_path):
+    gradient = np.linspace(0, 255, 640, dtype=np.uint8)
+    image = np.stack(
+        np.broadcast_arrays(gradient[None, :], gradient[:480, None], np.uint8(128)),
+        -1,
+    )
+    Image.fromarray(image).save(tmp_path / "image.jpg", quality=95)
+
+    stats = DecodeStats()
+    with open_image(tmp_path / "image.jpg", scale=4, stats=stats) as reduced:
+        assert reduced.size == (160, 120)
+        reduced_stats = compute_channels_stats(np.asarray(reduced))
+    with open_image(tmp_path / "image.jpg", target_size=(224, 224)) as resizable:
+        assert resizable.size == (320, 240)
+
+    assert stats.reduction == 16
+    np.testing.assert_allclose(
+        reduced_stats[:3],
+        compute_channels_stats(image)[:3],
+        atol=1,
+    )
+
+
+def test_open_image_reduces_every_format_to_the_same_size(tmp_path):
+    image = np.random.default_rng(0).integers(0, 256, size=(100, 70, 3), dtype=np.uint8)
+    Image.fromarray(image).save(tmp_path / "image.jpg")
+    Image.fromarray(image).save(tmp_path / "image.png")
+    Image.fromarray(image).quantize(16).save(tmp_path / "palette.png")
+    Image.fromarray(image[..., 0].astype(np.uint16) * 256).save(tmp_path / "deep.png")
+
+    for name, mode in (
+        ("image.jpg", "RGB"),
+        ("image.png", "RGB"),
+        ("palette.png", "P"),
+        ("deep.png", "I;16"),
+    ):
+        for scale in (2, 3, 4):
+            with open_image(tmp_path / name, scale=scale) as reduced:
+                assert reduced.size == (-(-70 // scale), -(-100 // scale)), (
+                    name,
+                    scale,
+                )
+                assert reduced.mode == mode
+
+
+def test_sharded_statistics_match_serial_path(tmp_path, monkeypatch):
+    paths = write_images(tmp_path, [(12, 10, 3)] * 7)
+    monkeypatch.setattr(settings, "shard_pool_workers", 2)
+
+    try:
+        stats = sharded_channels_stats(paths)
+        images_sum, num_images = sharded_images_sum(paths)
+    finally:
+        shutdown_executors()
+
+    np.testing.assert_array_equal(stats, compute_dataset_channels_stats(paths))
+    expected_sum, _ = accumulate_images_sum(paths)
+    np.testing.assert_array_equal(images_sum, expected_sum)
+    assert num_images == 7
+
+
+def test_shard_pools_share_the_cores_between_workers(monkeypatch):
+    monkeypatch.setattr(settings, "shard_pool_workers", 0)
+    monkeypatch.setattr(os, "cpu_count", lambda: 8)
+
+    monkeypatch.delenv("WEB_CONCURRENCY", raising=False)
+    assert shard_pool_size() == 8
+    monkeypatch.setenv("WEB_CONCURRENCY", "4")
+    assert shard_pool_size() == 2
+    monkeypatch.setenv("WEB_CONCURRENCY", "17")
+    assert shard_pool_size() == 1
+
+    monkeypatch.setattr(settings, "shard_pool_workers", 3)
+    assert shard_pool_size() == 3
+
+
+def test_stratified_sample_keeps_every_label():
+    labels = ["cat"] * 90 + ["dog"] * 9 + ["fox"]
+
+    sample = stratified_sample(labels, sample_size=20, seed=0)
+
+    assert len(sample) == 20
+    assert len(np.unique(sample)) == 20
+    sampled = [labels[idx] for idx in sample]
+    assert sampled.count("fox") == 1
+    assert sampled.count("dog") >= 1
+    np.testing.assert_array_equal(sample, stratified_sample(labels, 20, seed=0))
+
+
+def test_compute_projection_places_every_point():
+    rng = np.random.default_rng(0)
+    logits = np.vstack([rng.normal(0, 1, (30, 16)), rng.normal(20, 1, (30, 16))])
+    labels = ["a"] * 30 + ["b"] * 30
+
+    clusters, timings = compute_projection(
+        logits,
+        ClusteringMode.tsne,
+        labels=labels,
+        sample_size=40,
+        pca_components=4,
+        seed=0,
+    )
+
+    assert clusters.shape == (60, 2)
+    assert np.isfinite(clusters).all()
+    assert timings["fitted"] == 40
+    assert {"pca_time", "fit_time", "transform_time"} <= set(timings)
+
+
+def test_stored_reducer_only_places_new_images(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "reducers_dir", str(tmp_path / "reducers"))
+    monkeypatch.setattr(settings, "reducer_refit_growth", 0.05)
+    monkeypatch.setattr(settings, "reducer_drift_threshold", 0.5)
+    paths = write_images(tmp_path, [(4, 4, 3)] * 44)
+    logits = np.random.default_rng(0).normal(size=(44, 8)).astype(np.float32)
+
+    def project(num_images):
+        return project_with_stored_reducer(
+            logits[:num_images],
+            paths[:num_images],
+            EmbeddingsModel.resnet50v2,
+            "dataset",
+            seed=0,
+        )
+
+    clusters, timings = project(40)
+    assert timings["fitted"] == 40
+
+    reused, timings = project(42)
+    assert (timings["fitted"], timings["projected"]) == (0, 2)
+    np.testing.assert_array_equal(reused[:40], clusters)
+
+    _, timings = project(44)
+    assert timings["fitted"] == 44
+
+
+def test_neighbour_overlap_of_perturbed_embeddings():
+    rng = np.random.default_rng(0)
+    reference = rng.normal(size=(50, 16))
+
+    assert neighbour_overlap(reference, reference, k=5).min() == 1
+    assert neighbour_overlap(reference, 3 * reference + 1e-6, k=5).mean() > 0.9
+    assert neighbour_overlap(reference, rng.normal(size=(50, 16)), k=5).mean() < 0.5
+
+
+def test_streamed_eigenimages_match_full_pca(tmp_path):
+    rng = np.random.default_rng(0)
+    patterns = rng.uniform(-40, 40, size=(3, 16, 16))
+    paths = []
+    for label in ("a", "b"):
+        (tmp_path / label).mkdir()
+        for idx in range(25):
+            image = 128 + np.tensordot(rng.normal(size=3), patterns, axes=1)
+            path = tmp_path / label / f"image_{idx}.png"
+            Image.fromarray(np.clip(image, 0, 255).astype(np.uint8)).save(path)
+            paths.append(path)
+
+    eigenimages = compute_eigenimages(
+        paths,
+        n_components=3,
+        size=(16, 16),
+        batch_size=4,
+    )["all"]
+
+    matrix = np.stack([load_grayscale(path, size=(16, 16)) for path in paths])
+    components = np.linalg.svd(matrix - matrix.mean(axis=0))[2][:3]
+    cosines = np.abs(np.sum(eigenimages.components.reshape(3, -1) * components, axis=1))
+    assert eigenimages.num_images == 50
+    assert np.allclose(cosines, 1, atol=1e-3)
+    assert eigenimages.explained_variance_ratio.sum() > 0.99
+
+    per_label = compute_eigenimages(
+        paths,
+        per_label=True,
+        n_components=3,
+        size=(16, 16),
+    )
+    assert sorted(per_label) == ["a", "b"]
+
+
+def test_rank_deviations_finds_outliers_in_chunks(tmp_path, monkeypatch):
+    rng = np.random.default_rng(0)
+    base = rng.integers(100, 156, size=(16, 16, 3), dtype=np.uint8)
+    paths = []
+    for idx in range(12):
+        image = base + rng.integers(0, 4, size=base.shape, dtype=np.uint8)
+        if idx in (3, 8):
+            image[:8] = 255 - image[:8]
+        path = tmp_path / f"image_{idx}.png"
+        Image.fromarray(image).save(path)
+        paths.append(path)
+    mean_image = base.astype(np.float32) + 1.5
+
+    assert np.allclose(deviation_scores(base[np.newaxis], base), 0, atol=1e-6)
+
+    monkeypatch.setattr(settings, "deviation_chunk_bytes", 5 * base.size * 4)
+    scores, top = rank_deviations(
+        paths,
+        mean_image,
+        metric=DeviationMetric.ssim,
+        top_k=2,
+    )
+    monkeypatch.setattr(settings, "deviation_chunk_bytes", 1 << 30)
+    full_scores, _ = rank_deviations(paths, mean_image)
+
+    assert sorted(top) == [3, 8]
+    assert np.allclose(scores, full_scores)
+
+
+def test_rank_deviations_rejects_other_shapes(tmp_path):
+    mean_image = np.full((16, 16, 3), 128, dtype=np.float32)
+    rgb, grayscale, rgba, smaller = write_images(
+        tmp_path,
+        [(16, 16, 3), (16, 16), (16, 16, 4), (8, 16, 3)],
+    )
+
+    assert rank_deviations([rgb], mean_image)[0].shape == (1, 3)
+    for path in (grayscale, rgba):
+        with pytest.raises(ChannelNotFoundError):
+            rank_deviations([rgb, path], mean_image)
+    with pytest.raises(HeightWidthMismatchError):
+        rank_deviations([smaller], mean_image)
+
+    # the 16-bit images would be truncated to the 8 bits of the chunks
+    deep = tmp_path / "deep.png"
+    Image.fromarray(np.full((16, 16), 1000, dtype=np.uint16)).save(deep)
+    with pytest.raises(ChannelNotFoundError):
+        rank_deviations([deep], mean_image[..., 0])
+    with pytest.raises(EmptyDatasetError):
+        rank_deviations([], mean_image)
+
+
+def test_class_sums_match_per_class_passes(tmp_path):
+    paths = {}
+    for label, seed in (("a", 0), ("b", 1), ("c", 2)):
+        (tmp_path / label).mkdir()
+        paths[label] = write_images(tmp_path / label, [(8, 6, 3)] * 4, seed=seed)
+
+    accumulators = accumulate_class_sums(sum(paths.values(), []))
+
+    assert list(accumulators) == ["a", "b", "c"]
+    for label, label_paths in paths.items():
+        images_sum, num_images = accumulate_images_sum(label_paths)
+        pixels = np.stack([np.array(Image.open(path)) for path in label_paths])
+        pixels = pixels.reshape(-1, 3).astype(np.float64)
+        expected = np.concatenate([pixels.mean(axis=0), pixels.std(axis=0)])
+
+        assert accumulators[label].num_images == num_images
+        assert np.array_equal(accumulators[label].images_sum, images_sum)
+        assert np.allclose(accumulators[label].channels_stats(), expected)
+
+    contrasts = compute_contrast_images(accumulators)
+    assert sorted(contrasts) == [("a", "b"), ("a", "c"), ("b", "c")]
+    expected_contrast = (
+        accumulators["a"].mean_image() - accumulators["b"].mean_image()
+    ).mean(axis=-1)
+    assert np.allclose(contrasts[("a", "b")], expected_contrast, atol=1e-4)
+
+
+def test_neighbours_index_is_updated_incrementally(tmp_path):
+    rng = np.random.default_rng(0)
+    paths = []
+    for idx in range(60):
+        path = tmp_path / f"image_{idx}.bin"
+        path.write_bytes(b"x")
+        paths.append(path)
+    embeddings = rng.normal(size=(60, 32)).astype(np.float32)
+
+    store = EmbeddingStore(
+        model=EmbeddingsModel.resnet50v2,
+        directory=tmp_path / "store",
+    )
+    store.update(paths[:50], embeddings[:50])
+    index = NeighboursIndex(
+        model=EmbeddingsModel.resnet50v2,
+        directory=tmp_path / "index",
+        store=store,
+    )
+
+    assert index.query(embeddings[:1], k=3)[0][0] == (str(paths[0]), pytest.approx(0))
+
+    # 10 new images, and a changed one
+    paths[3].write_bytes(b"changed")
+    embeddings[3] = -embeddings[3]
+    store.update(
+        paths[3:4] + paths[50:],
+        np.concatenate([embeddings[3:4], embeddings[50:]]),
+    )
+
+    neighbours = index.query(embeddings[[3, 55]], k=1)
+    assert [row[0][0] for row in neighbours] == [str(paths[3]), str(paths[55])]
+    assert len(index.refresh()["paths"]) == 60
+
+
+def test_deleted_images_are_pruned_from_the_store(tmp_path):
+    paths = write_images(tmp_path, [(4, 4, 3)] * 8)
+    embeddings = np.random.default_rng(0).normal(size=(8, 16)).astype(np.float32)
+    store = EmbeddingStore(
+        model=EmbeddingsModel.resnet50v2,
+        directory=tmp_path / "store",
+    )
+    store.update(paths, embeddings)
+    index = NeighboursIndex(
+        model=EmbeddingsModel.resnet50v2,
+        directory=tmp_path / "index",
+        store=store,
+    )
+    assert len(index.refresh()["paths"]) == 8
+
+    for idx in (1, 4):
+        paths[idx].unlink()
+    kept = [path for path in paths if path.exists()]
+    assert store.prune(kept) == 2
+    assert store.prune(kept) == 0
+
+    stored, missing = store.lookup(kept)
+    assert missing == []
+    np.testing.assert_array_equal(stored, np.delete(embeddings, [1, 4], axis=0))
+
+    # the rows were renumbered, so the graph is built again
+    state = index.refresh()
+    assert state["paths"] == [str(path) for path in kept]
+    neighbours = index.query(embeddings[[5]], k=1, state=state)
+    assert neighbours[0][0] == (str(paths[5]), pytest.approx(0, abs=1e-6))
+
+
+def test_near_pairs_match_brute_force():
+    rng = np.random.default_rng(0)
+    hashes = rng.integers(0, 1 << 62, size=2000, dtype=np.uint64)
+    flips = rng.integers(0, 64, size=(500, 3)).astype(np.uint64)
+    near = hashes[:500] ^ np.bitwise_or.reduce(np.uint64(1) << flips, axis=1)
+    hashes = np.unique(np.concatenate([hashes, near]))
+
+    distances = hamming_distance(hashes[:, np.newaxis], hashes[np.newaxis, :])
+    expected = np.argwhere(np.triu(distances <= 6, k=1))
+
+    assert np.array_equal(near_pairs(hashes, max_distance=6), expected)
+
+
+def test_find_duplicates_groups_copies_across_labels(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "hashes_cache_dir", str(tmp_path / "hashes"))
+    rng = np.random.default_rng(0)
+    paths = []
+    for label in ("a", "b"):
+        (tmp_path / label).mkdir()
+        for idx in range(6):
+            low = rng.integers(0, 256, size=(4, 4, 3), dtype=np.uint8)
+            path = tmp_path / label / f"image_{idx}.png"
+            Image.fromarray(low).resize((48, 48), Image.BILINEAR).save(path)
+            paths.append(path)
+
+    original = np.array(Image.open(paths[0]), dtype=np.int16)
+    paths.append(tmp_path / "b" / "brighter.png")
+    Image.fromarray(np.clip(original + 3, 0, 255).astype(np.uint8)).save(paths[-1])
+    paths.append(tmp_path / "b" / "copy.png")
+    paths[-1].write_bytes(paths[1].read_bytes())
+
+    groups, num_hashed = find_duplicates(paths, max_distance=4)
+    assert num_hashed == len(paths)
+    assert sorted((sorted(group), kind) for kind, group in groups) == [
+        ([0, 12], DuplicateKind.near),
+        ([1, 13], DuplicateKind.exact),
+    ]
+
+    cached_groups, num_hashed = find_duplicates(paths, max_distance=4)
+    assert num_hashed == 0
+    assert cached_groups == groups
+
+
+def test_metrics_are_added_up_over_the_workers(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "metrics_dir", str(tmp_path))
+    monkeypatch.setattr(settings, "metrics_flush_interval", 3600.0)
+    monkeypatch.setattr(metrics, "_REGISTRY", None)
+
+    @span("session_run", images=4)
+    def run_batch():
+        pass
+
+    run_batch()
+    with span("decode") as current:
+        current.images = 3
+    registry = get_registry()
+    registry.flush()
+    # the file of another gunicorn worker, which recorded the same stages
+    (tmp_path / "1.json").write_text(registry.path.read_text())
+    # and the file of a process of its pools
+    (tmp_path / "1-2.json").write_text(registry.path.read_text())
+
+    text = render_prometheus(aggregate_metrics())
+    assert 'eda_images_total{stage="decode"} 9' in text
+    assert 'eda_images_total{stage="session_run"} 12' in text
+    assert 'eda_stage_duration_seconds_bucket{stage="decode",le="0.005"} 3' in text
+    assert 'eda_stage_duration_seconds_bucket{stage="decode",le="+Inf"} 3' in text
+    assert 'eda_stage_duration_seconds_count{stage="session_run"} 3' in text
+    assert "# TYPE eda_stage_duration_seconds histogram" in text
+
+    # a worker reusing the pid of a dead one carries on from its counters
+    assert MetricsRegistry().counters == registry.counters
+
+    # the metrics of an exited worker are merged, and keep adding up
+    merge_worker_metrics(1)
+    merge_worker_metrics(os.getpid())
+    assert [path.name for path in tmp_path.glob("*.json")] == ["exited.json"]
+    assert render_prometheus(aggregate_metrics()) == text
+
+
+def test_metrics_of_exited_processes_are_cleared(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, "_is_running", lambda pid: pid == 1)
+    for name in ("1", "1-2", "3", "3-4", "exited"):
+        (tmp_path / f"{name}.json").write_text("{}")
+
+    clear_metrics(tmp_path, keep_running=True)
+    assert sorted(path.stem for path in tmp_path.glob("*.json")) == ["1", "1-2"]
+
+    clear_metrics(tmp_path)
+    assert not list(tmp_path.glob("*.json"))
+
+
+@pytest.fixture
+def tiny_model(tmp_path, monkeypatch):
+    model_path = build_tiny_model(tmp_path / "tiny.onnx", embedding_dim=8)
+    monkeypatch.setattr(settings, "optimized_models_dir", str(tmp_path / "optimized"))
+    monkeypatch.setattr(
+        settings,
+        "session_profiles",
+        {
+            "cached": {
+                "graph_optimization_level": "basic",
+                "cache_optimized_model": True,
+            },
+            "pinned": {"intra_op_num_threads": 1, "inter_op_num_threads": 1},
+            "unknown_level": {"graph_optimization_level": "fastest"},
+        },
+    )
+    return model_path
+
+
+def test_create_session_applies_the_profile(tiny_model, monkeypatch):
+    monkeypatch.setattr(os, "cpu_count", lambda: 8)
+    monkeypatch.setenv("WEB_CONCURRENCY", "4")
+
+    session, model_file = create_session(str(tiny_model), [settings.cpu], "pinned")
+    options = session.get_session_options()
+    assert model_file == str(tiny_model)
+    assert (options.intra_op_num_threads, options.inter_op_num_threads) == (1, 1)
+
+    # 0 threads share the cores between the gunicorn workers
+    session, _ = create_session(str(tiny_model), [settings.cpu], "cached")
+    options = session.get_session_options()
+    assert (options.intra_op_num_threads, options.inter_op_num_threads) == (2, 2)
+
+    with pytest.raises(ValueError):
+        create_session(str(tiny_model), [settings.cpu], "unknown_level")
+    with pytest.raises(ValueError):
+        create_session(str(tiny_model), [settings.cpu], "missing")
+
+
+def test_create_session_reuses_the_optimized_model(tiny_model):
+    optimized_path = optimized_models_dir() / "tiny-basic.onnx"
+
+    _, model_file = create_session(str(tiny_model), [settings.cpu], "cached")
+    assert model_file == str(tiny_model)
+    assert optimized_path.exists()
+    assert not list(optimized_path.parent.glob("*.tmp"))
+
+    session, model_file = create_session(str(tiny_model), [settings.cpu], "cached")
+    assert model_file == str(optimized_path)
+    assert session.get_session_options().graph_optimization_level == (
+        GRAPH_OPTIMIZATION_LEVELS["disable"]
+    )
+    dummy = np.zeros((2, 224, 224, 3), dtype=np.float32)
+    assert session.run(["avg_pool"], {"input": dummy})[0].shape == (2, 8)
+
+    # a modified model discards the optimized graph
+    later = optimized_path.stat().st_mtime_ns + 10**9
+    os.utime(tiny_model, ns=(later, later))
+    _, model_file = create_session(str(tiny_model), [settings.cpu], "cached")
+    assert model_file == str(tiny_model)
+
+
+class SlowSession:
+    """Session running batches in a fixed time per batch size."""
+
+    def __init__(self, durations):
+        self.durations = durations
+        self.batch_sizes = []
+
+    def run(self, outputs, inputs):
+        batch_size = len(inputs["input"])
+        self.batch_sizes.append(batch_size)
+        time.sleep(self.durations[batch_size])
+
+
+def test_autotune_keeps_the_fastest_batch_size(tiny_model, monkeypatch):
+    monkeypatch.setattr(settings, "resnet50v2", str(tiny_model))
+    monkeypatch.setattr(settings, "session_profile", "pinned")
+    engine = EmbeddingEngine(EmbeddingsModel.resnet50v2, Providers.cpu)
+
+    assert engine.autotune(batch_sizes=[2, 1], runs=1) in (1, 2)
+    assert sorted(engine.batch_throughputs)[0] == 1
+
+    # 8 images/s, 40 images/s, 20 images/s: the search stops past 8
+    engine.loaded_model = SlowSession({1: 0.125, 8: 0.2, 16: 0.8, 32: 0.8})
+    assert engine.autotune(batch_sizes=[32, 16, 8, 1], runs=2) == 8
+    assert engine.batch_size == 8
+    assert sorted(engine.batch_throughputs) == [1, 8, 16]
+    assert 32 not in engine.loaded_model.batch_sizes
@@ -0,0 +1,131 @@
+import os
+import threading
+import time
+
+import arrow
+import pytest
+from fastapi.testclient import TestClient
+
+from app.config import settings
+from app.dependancies import jobs
+from app.dependancies.jobs import Job, beat, cleanup_jobs, get_job, recover_jobs
+from app.main import app
+from app.pydantic_models import JobKind, JobStatus
+
+client = TestClient(app)
+
+
+@pytest.fixture
+def jobs_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "jobs_dir", str(tmp_path))
+    monkeypatch.setattr(settings, "jobs_progress_interval", 0.0)
+    return tmp_path
+
+
+def fake_mean_image_job(params, job):
+    job.set_total(3)
+    job.advance(3)
+    return b"mean image", {"decoded_images": "3"}
+
+
+def wait_for(job_id, status=JobStatus.done):
+    deadline = time.monotonic() + 30
+    while get_job(job_id)["status"] != status.value:
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+    return get_job(job_id)
+
+
+def test_submitted_job_reports_its_progress_and_result(jobs_dir, monkeypatch):
+    release = threading.Event()
+
+    def blocked_job(params, job):
+        release.wait(timeout=30)
+        return fake_mean_image_job(params, job)
+
+    monkeypatch.setitem(jobs.JOB_FUNCTIONS, JobKind.dataset_mean_image, blocked_job)
+
+    response = client.post("/jobs/dataset_mean_image?extension=.png&scale=2")
+    assert response.status_code == 202
+    job_id = response.json()["job_id"]
+    assert response.json()["params"] == {"extension": ".png", "scale": 2}
+
+    wait_for(job_id, status=JobStatus.running)
+    assert client.get(f"/jobs/{job_id}/result").status_code == 409
+
+    release.set()
+    state = wait_for(job_id)
+    assert (state["done"], state["total"]) == (3, 3)
+
+    response = client.get(f"/jobs/{job_id}")
+    assert response.status_code == 200
+    assert response.json()["status"] == JobStatus.done.value
+    assert response.json()["media_type"] == "image/png"
+
+    response = client.get(f"/jobs/{job_id}/result")
+    assert response.status_code == 200
+    assert response.content == b"mean image"
+    assert response.headers["content-type"] == "image/png"
+    assert response.headers["decoded_images"] == "3"
+
+    assert client.get("/jobs/unknown").status_code == 404
+
+
+def test_jobs_of_expired_owners_are_requeued(jobs_dir, monkeypatch):
+    monkeypatch.setitem(
+        jobs.JOB_FUNCTIONS,
+        JobKind.dataset_mean_image,
+        fake_mean_image_job,
+    )
+    params = {"extension": ".png", "scale": 1}
+
+    # a worker of a previous run of the server, whose lease expired
+    dead = Job.create(kind=JobKind.dataset_mean_image, params=params)
+    dead.state.update(status=JobStatus.running.value, owner="dead")
+    dead.save()
+    (jobs_dir / "heartbeats").mkdir(exist_ok=True)
+    (jobs_dir / "heartbeats" / "dead").touch()
+    expired = time.time() - settings.jobs_lease_timeout - 1
+    os.utime(jobs_dir / "heartbeats" / "dead", (expired, expired))
+
+    # a worker which died without any heartbeat, e.g. an old state with a pid
+    orphan = Job.create(kind=JobKind.dataset_mean_image, params=params)
+    orphan.state.pop("owner")
+    orphan.save()
+
+    # another live worker
+    alive = Job.create(kind=JobKind.dataset_mean_image, params=params)
+    alive.state.update(status=JobStatus.running.value, owner="alive")
+    alive.save()
+    (jobs_dir / "heartbeats" / "alive").touch()
+
+    beat()
+    assert sorted(recover_jobs()) == sorted([dead.job_id, orphan.job_id])
+    wait_for(dead.job_id)
+    wait_for(orphan.job_id)
+    assert get_job(alive.job_id)["status"] == JobStatus.running.value
+
+
+def test_expired_jobs_are_deleted(jobs_dir, monkeypatch):
+    monkeypatch.setattr(settings, "jobs_ttl", 3600)
+    params = {"extension": ".png", "scale": 1}
+
+    old, recent, running = (
+        Job.create(kind=JobKind.dataset_mean_image, params=params) for _ in range(3)
+    )
+    for job, finished_at in ((old, arrow.now().shift(hours=-2)), (recent, arrow.now())):
+        result_path = Job.path(job.job_id).with_suffix(".png")
+        result_path.write_bytes(b"result")
+        job.state.update(
+            status=JobStatus.done.value,
+            finished_at=finished_at.isoformat(),
+            result_path=str(result_path),
+            media_type="image/png",
+        )
+        job.save()
+
+    assert cleanup_jobs() == [old.job_id]
+    assert not Job.path(old.job_id).exists()
+    assert not Job.path(old.job_id).with_suffix(".png").exists()
+    assert get_job(recent.job_id) is not None
+    assert get_job(running.job_id) is not None
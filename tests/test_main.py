@@ -1,6 +1,17 @@
+import io
+import threading
+import time
+
+import pytest
+from fastapi import HTTPException
 from fastapi.testclient import TestClient
+from PIL import Image
 
+from app.config import settings
+from app.dependancies import metrics
+from app.dependancies.errors import ChannelNotFoundError, EmptyDatasetError
 from app.main import app
+from app.routes import eda, embedding
 
 client = TestClient(app)
 
@@ -8,3 +19,148 @@ client = TestClient(app)
 def test_read_main():
     response = client.get("/healthcheck/")
     assert response.status_code == 200
+
+
+def test_metrics(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "metrics_dir", str(tmp_path))
+    monkeypatch.setattr(metrics, "_REGISTRY", None)
+    client.get("/healthcheck")
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    assert (
+        'eda_request_duration_seconds_count{method="GET",route="/healthcheck",'
+        + 'status="200"}'
+    ) in response.text
+
+
+def test_healthcheck_answers_during_a_blocking_dataset_call(monkeypatch):
+    started = threading.Event()
+    release = threading.Event()
+
+    def blocking_cache_key(endpoint, params):
+        started.set()
+        release.wait(timeout=30)
+        raise HTTPException(status_code=404)
+
+    monkeypatch.setattr(eda, "dataset_cache_key", blocking_cache_key)
+
+    # a single client shares one event loop between the two requests
+    with TestClient(app) as shared_client:
+        responses = []
+        dataset_request = threading.Thread(
+            target=lambda: responses.append(
+                shared_client.get("/eda/dataset_mean_image?extension=.png"),
+            ),
+        )
+        dataset_request.start()
+        assert started.wait(timeout=30)
+
+        start = time.perf_counter()
+        response = shared_client.get("/healthcheck")
+        elapsed = time.perf_counter() - start
+
+        assert response.status_code == 200
+        assert not release.is_set() and dataset_request.is_alive()
+        assert elapsed < 5
+
+        release.set()
+        dataset_request.join(timeout=30)
+        assert responses[0].status_code == 404
+
+
+def test_corrupt_archive_is_a_bad_request():
+    response = client.post(
+        "/eda/mean_values_archive?archive_format=zip",
+        data=b"not a zip archive",
+    )
+    assert response.status_code == 400
+    assert "zip" in response.json()["detail"]
+
+
+@pytest.mark.parametrize(
+    "error, status_code",
+    [
+        (ChannelNotFoundError((16, 16), (16, 16, 3)), 422),
+        (EmptyDatasetError(".png"), 404),
+    ],
+)
+def test_deviations_of_invalid_datasets_are_rejected(error, status_code, monkeypatch):
+    def invalid_dataset(**kwargs):
+        raise error
+
+    monkeypatch.setattr(eda, "dataset_cache_key", lambda endpoint, params: "invalid")
+    monkeypatch.setattr(eda, "_compute_deviations", invalid_dataset)
+
+    response = client.get("/eda/mean_image_deviations?extension=.png")
+    assert response.status_code == status_code
+
+
+def test_dataset_paths_are_not_resolved(tmp_path, monkeypatch):
+    (tmp_path / "dataset" / "label").mkdir(parents=True)
+    (tmp_path / "dataset" / "label" / "1.png").write_bytes(b"image")
+    (tmp_path / "link").symlink_to(tmp_path / "dataset")
+    monkeypatch.setattr(settings, "data_dir", str(tmp_path / "link"))
+
+    # like the paths of the dataset index, so that the query image is excluded
+    assert embedding._dataset_path("label/./1.png") == tmp_path / "link/label/1.png"
+    for image in (
+        "../dataset/label/1.png",
+        str(tmp_path / "link/label/1.png"),
+        "label",
+    ):
+        with pytest.raises(HTTPException):
+            embedding._dataset_path(image)
+
+
+def test_failed_requests_are_recorded(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "metrics_dir", str(tmp_path))
+    monkeypatch.setattr(metrics, "_REGISTRY", None)
+
+    def failing_cache_key(endpoint, params):
+        raise RuntimeError("index unavailable")
+
+    monkeypatch.setattr(eda, "dataset_cache_key", failing_cache_key)
+
+    failing_client = TestClient(app, raise_server_exceptions=False)
+    assert (
+        failing_client.get("/eda/dataset_mean_image?extension=.png").status_code == 500
+    )
+
+    response = client.get("/metrics")
+    failed = [
+        line
+        for line in response.text.splitlines()
+        if line.startswith("eda_request_duration_seconds_count")
+        and 'status="500"' in line
+    ]
+    assert len(failed) == 1
+    assert "dataset_mean_image" in failed[0] and failed[0].endswith(" 1")
+
+
+def test_images_without_rgb_channels_are_skipped_in_batches():
+    files = []
+    for name, mode in (("rgb.png", "RGB"), ("gray.png", "L"), ("deep.png", "I;16")):
+        buffer = io.BytesIO()
+        Image.new(mode, (8, 6)).save(buffer, format="PNG")
+        files.append(("files", (name, buffer.getvalue(), "image/png")))
+
+    response = client.post("/eda/mean_values_batch", files=files)
+    assert response.status_code == 200
+    assert response.json()["filenames"] == ["rgb.png"]
+    assert sorted(response.json()["skipped"]) == ["deep.png", "gray.png"]
+
+    response = client.post("/eda/mean_values_batch?batch_size=0", files=files)
+    assert response.status_code == 422
+
+
+def test_neighbours_of_invalid_uploads_are_rejected():
+    buffer = io.BytesIO()
+    Image.new("L", (8, 6)).save(buffer, format="PNG")
+    url = "/embedding/neighbours?model=resnet50v2&provider=CPUExecutionProvider"
+
+    response = client.post(url, files={"file": ("gray.png", buffer.getvalue())})
+    assert response.status_code == 422
+    response = client.post(url, files={"file": ("notes.txt", b"not an image")})
+    assert response.status_code == 400